@@ -0,0 +1,170 @@
+# A pipelined asyncio client for the socket server.
+#
+# client.py sends a request and waits for its reply before sending the next,
+# so a bot built on it never has more than one request in flight, and every
+# request costs a full round trip. AsyncClient tags every request with a
+# request_id (see framing.py) and hands back a future of its response right
+# away, so a caller can keep hundreds of requests in flight on a single
+# connection. The server may answer tagged requests out of order (a cluster
+# worker answers local requests while forwarded ones are still out), and
+# each reply is matched up with its future by id.
+
+import asyncio
+
+import coding
+import framing
+import idle
+
+RECV_SIZE = 65536
+
+class AsyncClient:
+    """
+    One connection to the server, speaking protocol version 1. Use submit
+    to send a request and get a future of its response, or await call to
+    send one and wait for it.
+    NOTE: Untagged frames from the server are messages pushed after a
+    subscribe. They are put in the pushes queue, as MessagesResponses.
+    """
+    def __init__(self, host, port, compression=False, heartbeats=True):
+        self.host = host
+        self.port = port
+        self.compression = compression # Offer zlib in a hello frame
+        self.heartbeats = heartbeats # Send one every HEARTBEAT_SECONDS, so the server doesn't drop a quiet connection
+        self.reader = None
+        self.writer = None
+        self.compressed = False
+        self.decoder = framing.FrameDecoder()
+        self.last_id = 0
+        self.pending = {} # request_id -> future of the response
+        self.pushes = asyncio.Queue()
+        self.error = None # Why the connection is unusable, once it is
+        self.tasks = []
+
+    async def connect(self):
+        """
+        Connects (and negotiates compression, if asked to). Returns the client.
+        """
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.compression:
+            self.writer.write(framing.frame(framing.hello()))
+            data = await self.next_frame()
+            if data is None or not framing.is_hello(data):
+                raise Exception("Server closed connection")
+            self.compressed = framing.negotiate(framing.parse_hello(data)) is not None
+        self.tasks.append(asyncio.ensure_future(self.read_replies()))
+        if self.heartbeats:
+            self.tasks.append(asyncio.ensure_future(self.send_heartbeats()))
+        return self
+
+    def next_id(self):
+        """
+        The next request_id, wrapping around but skipping those still in flight
+        """
+        while True:
+            self.last_id = self.last_id % framing.MAX_REQUEST_ID + 1
+            if self.last_id not in self.pending:
+                return self.last_id
+
+    def submit(self, request, op):
+        """
+        Sends a request for op without waiting for anything. Returns a future
+        of its (unmarshaled) response.
+        NOTE: Nothing waits for the bytes to leave, so a caller submitting a
+        lot should await drain now and then (call does)
+        """
+        if self.writer is None:
+            raise Exception("Not connected")
+        future = asyncio.get_running_loop().create_future()
+        if self.error is not None:
+            future.set_exception(self.error)
+            return future
+        request_id = self.next_id()
+        self.pending[request_id] = future
+        self.writer.write(framing.frame(framing.tag(request_id, coding.marshal_request(request, op, coding.VERSION_1)), self.compressed))
+        return future
+
+    async def call(self, request, op):
+        """
+        Sends a request for op and returns its response
+        """
+        future = self.submit(request, op)
+        await self.drain()
+        return await future
+
+    async def drain(self):
+        """
+        Waits until the socket can take more requests
+        """
+        if self.error is None:
+            await self.writer.drain()
+
+    async def next_frame(self):
+        """
+        The next frame from the server, or None once it closed the connection
+        """
+        data = self.decoder.next_frame()
+        while data is None:
+            received = await self.reader.read(RECV_SIZE)
+            if not received:
+                return None
+            self.decoder.feed(received)
+            data = self.decoder.next_frame()
+        return data
+
+    async def read_replies(self):
+        """
+        Hands every reply to the future waiting for it, and every pushed
+        message to the pushes queue
+        """
+        try:
+            while True:
+                data = await self.next_frame()
+                if data is None:
+                    raise Exception("Server closed connection")
+                if framing.is_tagged(data):
+                    request_id, data = framing.untag(data)
+                    future = self.pending.pop(request_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(coding.unmarshal_response(bytes(data)))
+                else:
+                    self.pushes.put_nowait(coding.unmarshal_response(bytes(data)))
+        except Exception as e:
+            self.fail(e)
+
+    async def send_heartbeats(self):
+        """
+        Sends a heartbeat every HEARTBEAT_SECONDS, until the connection closes
+        """
+        while True:
+            await asyncio.sleep(idle.HEARTBEAT_SECONDS)
+            if self.error is not None or self.writer.is_closing():
+                return
+            self.writer.write(framing.frame(framing.HEARTBEAT))
+
+    def fail(self, error):
+        """
+        Fails every request still in flight, and any made from now on
+        """
+        self.error = error
+        pending = self.pending
+        self.pending = {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.fail(Exception("Client closed"))
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *args):
+        await self.close()
@@ -0,0 +1,225 @@
+# An asyncio version of the socket server.
+#
+# The threaded Server parks one thread in recv per connection, and every
+# logged in client holds two connections, so it stops accepting new clients
+# once its ThreadPoolExecutor runs out of workers. AsyncServer serves every
+# connection from a single event loop instead, which makes an idle connection
+# cost little more than its socket and a small receive buffer.
+
+import asyncio
+
+import coding
+import framing
+import mailboxes
+import message_log
+from server import Server, Session
+
+try:
+    import resource
+except ImportError:
+    resource = None # Not available on Windows
+
+INITIAL_BUFFER_SIZE = 1024 # Idle connections keep their buffer, so start small
+LISTEN_BACKLOG = 4096
+
+class ChatProtocol(asyncio.BufferedProtocol):
+    """
+    One client connection. Bytes are received straight into the connection's
+    FrameDecoder, and every complete request is answered as soon as it arrives
+    with one write per chunk, exactly like Server.handle_connection.
+    Once a subscribe succeeds, new messages for the user are pushed as they
+    arrive (see watch).
+    """
+    def __init__(self, server):
+        self.server = server
+        self.session = Session()
+        self.decoder = framing.FrameDecoder(capacity=INITIAL_BUFFER_SIZE)
+        self.transport = None
+        self.watching = False
+        self.push_scheduled = False
+        self.paused = False
+        self.committing = False # Replies are waiting for the log to be committed
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if not self.session.trusted:
+            print("New connection")
+            self.server.metrics.session_started()
+            self.server.track(self.session, transport.abort) # A dead client would never let close flush
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.decoder.buffer_updated(nbytes)
+        self.server.metrics.received(nbytes)
+        self.server.touch(self.session)
+        try:
+            out = self.server.handle_frames(self.decoder, self.session)
+        except Exception as e:
+            print("Error:", e.args[0])
+            self.transport.close()
+            return
+        if out is not None:
+            commit = self.server.log_barrier()
+            if commit is not None:
+                # Stop reading so that later replies can't overtake these
+                self.committing = True
+                self.transport.pause_reading()
+                commit.add_done_callback(lambda future : self.write_committed(future, out))
+                return
+            self.write(out)
+        self.watch()
+
+    def write_committed(self, commit, out):
+        """
+        Writes replies that were waiting for the log to be committed
+        """
+        self.committing = False
+        if self.transport.is_closing():
+            return
+        if commit.exception() is not None:
+            print("Error:", commit.exception())
+            self.transport.close()
+            return
+        self.write(out)
+        if not self.paused:
+            self.transport.resume_reading()
+        self.watch()
+
+    def write(self, data):
+        """
+        Writes framed bytes to the client, counting them
+        """
+        self.server.metrics.sent(len(data))
+        self.transport.write(data)
+
+    def write_replies(self, replies):
+        """
+        Writes marshaled responses to the client
+        """
+        self.write(framing.frame_all(replies, self.session.compressed))
+
+    def watch(self):
+        """
+        Starts pushing messages once the connection has subscribed. Instead
+        of a thread waiting on the user's event, the server calls
+        schedule_push whenever a message is sent to the user.
+        NOTE: Only the latest subscription of a user is pushed to
+        """
+        if self.watching or self.session.subscription is None:
+            return
+        self.watching = True
+        request, _ = self.session.subscription
+        self.server.watchers[request.user_id] = self.schedule_push
+        self.schedule_push() # The subscribe response may not have drained everything
+
+    def schedule_push(self):
+        """
+        Pushes on the next turn of the event loop, so that a burst of sends
+        (e.g. a pipelined batch) goes out in a single push
+        """
+        if not self.push_scheduled:
+            self.push_scheduled = True
+            asyncio.get_running_loop().call_soon(self.push)
+
+    def push(self):
+        self.push_scheduled = False
+        if self.paused or self.transport.is_closing():
+            return # Messages stay in the mailbox until the client catches up
+        out = self.server.pending_push(self.session)
+        if out is not None:
+            self.write_replies([out])
+            self.schedule_push() # A full response may have left more behind
+
+    def pause_writing(self):
+        """
+        The client isn't reading its replies, so stop reading its requests
+        (and stop pushing messages to it)
+        """
+        self.paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.paused = False
+        if not self.committing:
+            self.transport.resume_reading()
+        if self.watching:
+            self.schedule_push()
+
+    def connection_lost(self, exc):
+        if self.watching:
+            request, _ = self.session.subscription
+            if self.server.watchers.get(request.user_id) == self.schedule_push:
+                del self.server.watchers[request.user_id]
+        if not self.session.trusted:
+            print("Error:", "Client closed connection" if exc is None else exc)
+            self.server.metrics.session_ended()
+            self.server.untrack(self.session)
+        self.server.end_session(self.session)
+
+class AsyncServer(Server):
+    """
+    A Server that handles every connection on one asyncio event loop.
+    NOTE: The handlers are shared with Server and never block for long
+    (they only hold a lock while touching the in-memory state), so they
+    are simply called from the event loop. Waiting for the log to reach the
+    disk does block, so that happens on the default executor's threads.
+    """
+    def __init__(self, host, port, codec=coding, compression=True, mailbox_capacity=None, overflow=mailboxes.REJECT, log_path=None, fsync=message_log.ALWAYS, checkpoint_interval=mailboxes.DEFAULT_CHECKPOINT_INTERVAL, metrics_port=None, idle_timeout=None, preencode=False):
+        super().__init__(host, port, executor=None, codec=codec, compression=compression, mailbox_capacity=mailbox_capacity, overflow=overflow, log_path=log_path, fsync=fsync, checkpoint_interval=checkpoint_interval, metrics_port=metrics_port, idle_timeout=idle_timeout, preencode=preencode)
+        self.reaper = None
+
+    def log_barrier(self):
+        """
+        A future that is done once every change logged so far is durable, or
+        None if replies don't need to wait. Connections that commit at the
+        same time share an fsync, as their commits run on separate threads.
+        """
+        if self.log is None or not self.log.pending():
+            return None
+        if not self.log.waits():
+            return None # Synced in the background
+        return asyncio.get_running_loop().run_in_executor(None, self.log.commit, self.log.appended)
+
+    def start_reaping(self):
+        """
+        Reaps idle connections every tick of the timer wheel, from the event
+        loop (transports can't be closed from another thread)
+        """
+        if self.idle is not None and self.reaper is None:
+            self.reaper = asyncio.ensure_future(self.reap_ticks())
+
+    async def reap_ticks(self):
+        while True:
+            await asyncio.sleep(self.idle.resolution)
+            self.reap_idle()
+
+    async def serve(self):
+        """
+        Accepts and serves connections until cancelled
+        NOTE: With port 0 the OS picks a free port, which is then stored in self.port
+        """
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: ChatProtocol(self), self.host, self.port, backlog=LISTEN_BACKLOG)
+        self.port = server.sockets[0].getsockname()[1]
+        self.start_reaping()
+        async with server:
+            await server.serve_forever()
+
+    def start(self):
+        raise_fd_limit()
+        asyncio.run(self.serve())
+
+def raise_fd_limit():
+    """
+    Raises the open file limit as far as we are allowed to, since every
+    connection takes a file descriptor (the default is often only 1024)
+    """
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass # e.g. an unlimited hard limit, which can't be the soft limit
@@ -0,0 +1,75 @@
+"""
+Measures how long list takes to find a page of accounts, by scanning every
+account (as list did before the substring index) and through the index, for
+a range of registry sizes and wildcards. Prints microseconds per page, and
+then the microseconds it takes to add an account to the index and remove it
+again at each size.
+
+Run from the repository root with `python benchmarks/account_search.py`.
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import schema
+import user_registry
+
+PAGE_SIZE = 4
+
+def make_registry(users, seed=0):
+    rng = random.Random(seed)
+    registry = user_registry.UserRegistry()
+    while len(registry) < users:
+        user_id = "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 8)))
+        registry.add(schema.Account(user_id=user_id, is_logged_in=False))
+    return registry
+
+def time_per_update(registry, count=2000):
+    """
+    The time to add an account and remove it again, averaged over count accounts
+    """
+    user_ids = ["{}_new".format(i) for i in range(count)]
+    start = time.perf_counter()
+    for user_id in user_ids:
+        registry.add(schema.Account(user_id=user_id, is_logged_in=False))
+    for user_id in user_ids:
+        registry.remove(user_id)
+    return (time.perf_counter() - start) / count * 1e6
+
+def time_per_call(fn, seconds):
+    calls = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        fn()
+        calls += 1
+    return (time.perf_counter() - start) / calls * 1e6
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--wildcards", nargs="+", default=["", "a", "ab", "abc", "abcd", "zzzzz"], help="wildcards to search for")
+    parser.add_argument("--page", type=int, default=0)
+    parser.add_argument("--seconds", type=float, default=0.5, help="time spent on each measurement")
+    args = parser.parse_args()
+
+    start, stop = args.page * PAGE_SIZE, (args.page + 1) * PAGE_SIZE
+    print("{:>8}{:>10}{:>10}{:>12}{:>12}".format("users", "wildcard", "matches", "scan us", "index us"))
+    updates = []
+    for users in args.users:
+        registry = make_registry(users)
+        updates.append((users, time_per_update(registry)))
+        for wildcard in args.wildcards:
+            matches = len(registry.scan(wildcard))
+            scan = time_per_call(lambda : registry.scan(wildcard)[start:stop], args.seconds)
+            index = time_per_call(lambda : registry.find(wildcard, start, stop), args.seconds)
+            print("{:>8}{:>10}{:>10}{:>12.1f}{:>12.1f}".format(users, repr(wildcard), matches, scan, index))
+
+    print()
+    print("{:>8}{:>14}".format("users", "add+remove us"))
+    for users, update in updates:
+        print("{:>8}{:>14.1f}".format(users, update))
@@ -0,0 +1,101 @@
+"""
+Measures how many requests per second a freshly started server answers when
+several client processes keep it busy at once, to compare the single
+process async server with a cluster of worker processes. Every client sends
+pipelined send requests to random users, so with N workers about (N-1)/N of
+them are forwarded to another worker.
+
+Run from the repository root, e.g.
+`python benchmarks/cluster_throughput.py --mode cluster --processes 4`.
+NOTE: A cluster only helps with more than one CPU, and the clients need CPUs
+of their own too, so use --clients no larger than the spare cores.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import coding
+import framing
+import schema
+
+SERVER = """
+import sys
+sys.path.insert(0, {root!r})
+import async_server, cluster
+if {mode!r} == "async":
+    s = async_server.AsyncServer("127.0.0.1", {port})
+else:
+    s = cluster.Cluster("127.0.0.1", {port}, workers={processes})
+s.start()
+"""
+
+USERS = ["user{}".format(i) for i in range(64)]
+
+def round_trip(sock, decoder, requests):
+    """
+    Sends pipelined requests and waits for every reply
+    """
+    sock.sendall(framing.frame_all(requests))
+    for _ in requests:
+        framing.recv_frame(sock, decoder)
+
+def client(port, seconds, window, version, results):
+    """
+    Keeps window requests in flight for the given time, then reports how many were answered
+    """
+    sock = socket.create_connection(("127.0.0.1", port))
+    decoder = framing.FrameDecoder()
+    rng = random.Random(os.getpid())
+    done = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        requests = [
+            coding.marshal_request(schema.SendRequest(user_id=rng.choice(USERS), recipient_id=rng.choice(USERS), text="hello there"), "send", version)
+            for _ in range(window)
+        ]
+        round_trip(sock, decoder, requests)
+        done += window
+    sock.close()
+    results.put(done)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["async", "cluster"], default="cluster")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="worker processes in cluster mode")
+    parser.add_argument("--clients", type=int, default=4, help="client processes, one connection each")
+    parser.add_argument("--window", type=int, default=32, help="requests each client keeps in flight")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--version", choices=[coding.VERSION, coding.VERSION_1], default=coding.VERSION_1)
+    parser.add_argument("--port", type=int, default=65434)
+    args = parser.parse_args()
+
+    source = SERVER.format(root=ROOT, mode=args.mode, port=args.port, processes=args.processes)
+    proc = subprocess.Popen([sys.executable, "-c", source], stdout=subprocess.DEVNULL)
+    try:
+        time.sleep(1.5)
+        # Create every user once, so that sends succeed on whichever worker owns them
+        sock = socket.create_connection(("127.0.0.1", args.port))
+        round_trip(sock, framing.FrameDecoder(), [coding.marshal_request(schema.Request(user_id), "create", args.version) for user_id in USERS])
+        sock.close()
+
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=client, args=(args.port, args.seconds, args.window, args.version, results)) for _ in range(args.clients)]
+        for c in clients:
+            c.start()
+        total = sum(results.get() for _ in clients)
+        for c in clients:
+            c.join()
+
+        print("mode: {}{}".format(args.mode, " ({} processes)".format(args.processes) if args.mode == "cluster" else ""))
+        print("clients: {} x {} in flight, version {}".format(args.clients, args.window, args.version))
+        print("throughput: {:.0f} requests/s".format(total / args.seconds))
+    finally:
+        proc.terminate()
+        proc.wait()
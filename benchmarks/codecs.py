@@ -0,0 +1,229 @@
+"""
+Micro-benchmarks for every codec we ship: the string (coding.py) and struct
+(struct_coding.py) version 0 codecs, the version 1 codec and the protobuf
+messages used by part 2.
+
+For every op and corpus entry this measures, in both directions:
+- ops/sec, best of a few timeit runs
+- bytes on the wire
+- bytes allocated while handling one message (peak, measured with tracemalloc)
+
+Results are written as JSON (sorted, one row per codec/op/case/message) so
+runs can be diffed between releases, or compared with --compare.
+
+Run from the repository root with `python benchmarks/codecs.py`.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.append(os.path.join(ROOT, "part2"))
+import coding
+import struct_coding
+import schema
+import schema_pb2
+import google.protobuf
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", "codecs.json")
+
+SHORT_TEXT = "hi"
+LONG_TEXT = "The quick brown fox jumps over the lazy dog. " * 6 # Just under 280 chars
+LARGE_ACCOUNT_COUNT = 200
+
+# Which version 0 function marshals the response to each op
+RESPONSE_MARSHALERS = {
+    "create": "marshal_response",
+    "login": "marshal_response",
+    "delete": "marshal_response",
+    "send": "marshal_response",
+    "get": "marshal_message_response",
+    "list": "marshal_list_response",
+}
+
+def corpus():
+    """
+    The fixed corpus of messages. Each entry is (op, case, message, obj),
+    where message is "request" or "response" and obj is a schema.py object.
+    """
+    accounts = [schema.Account(user_id="user{}".format(i), is_logged_in=False) for i in range(LARGE_ACCOUNT_COUNT)]
+    entries = []
+    for op in ["create", "login", "delete"]:
+        entries.append((op, "ok", "request", schema.Request(user_id="ream")))
+        entries.append((op, "ok", "response", schema.Response(user_id="ream", success=True, error_message="")))
+        entries.append((op, "error", "response", schema.Response(user_id="ream", success=False, error_message="User does not exist")))
+    entries.append(("get", "poll", "request", schema.Request(user_id="ream")))
+    entries.append(("get", "empty", "response", schema.Message(author_id="ream", recipient_id="ream", text="", success=False)))
+    entries.append(("get", "short", "response", schema.Message(author_id="mark", recipient_id="ream", text=SHORT_TEXT, success=True)))
+    entries.append(("get", "long", "response", schema.Message(author_id="mark", recipient_id="ream", text=LONG_TEXT, success=True)))
+    entries.append(("send", "short", "request", schema.SendRequest(user_id="ream", recipient_id="mark", text=SHORT_TEXT)))
+    entries.append(("send", "long", "request", schema.SendRequest(user_id="ream", recipient_id="mark", text=LONG_TEXT)))
+    entries.append(("send", "ok", "response", schema.Response(user_id="ream", success=True, error_message="")))
+    entries.append(("list", "all", "request", schema.ListRequest(user_id="ream", wildcard="", page=0)))
+    entries.append(("list", "empty", "response", schema.ListResponse(user_id="ream", success=True, error_message="", accounts=[])))
+    entries.append(("list", "large", "response", schema.ListResponse(user_id="ream", success=True, error_message="", accounts=accounts)))
+    return entries
+
+def v0_codec(module):
+    """
+    Returns (encode, decode) callables for a version 0 codec module
+    """
+    def prepare(op, message, obj):
+        if message == "request":
+            marshal = getattr(module, "marshal_{}_request".format(op))
+            return (lambda: marshal(obj)), module.unmarshal_request
+        marshal = getattr(module, RESPONSE_MARSHALERS[op])
+        return (lambda: marshal(obj)), module.unmarshal_response
+    return prepare
+
+def v1_prepare(op, message, obj):
+    """
+    Returns (encode, decode) callables for the version 1 codec
+    """
+    if message == "request":
+        return (lambda: coding.marshal_request_v1(obj, op)), coding.unmarshal_request_v1
+    return (lambda: coding.marshal_response_v1(obj)), coding.unmarshal_response_v1
+
+def to_protobuf(op, message, obj):
+    """
+    Builds the part 2 protobuf message equivalent to a schema.py object
+    """
+    if message == "request":
+        if op == "send":
+            return schema_pb2.Message(author_id=obj.user_id, recipient_id=obj.recipient_id, text=obj.text)
+        if op == "list":
+            return schema_pb2.ListRequest(wildcard=obj.wildcard)
+        return schema_pb2.Credentials(user_id=obj.user_id)
+    if op == "get":
+        return schema_pb2.Message(author_id=obj.author_id, recipient_id=obj.recipient_id, text=obj.text)
+    if op == "list":
+        accounts = [schema_pb2.Account(user_id=account.user_id, is_logged_in=account.is_logged_in) for account in obj.accounts]
+        return schema_pb2.ListResponse(success=obj.success, error_message=obj.error_message, accounts=accounts)
+    return schema_pb2.BasicResponse(success=obj.success, error_message=obj.error_message)
+
+def protobuf_prepare(op, message, obj):
+    """
+    Returns (encode, decode) callables for the protobuf messages
+    NOTE: The protobuf object is built up front, so only serialization is timed
+    """
+    pb = to_protobuf(op, message, obj)
+    return pb.SerializeToString, type(pb).FromString
+
+CODECS = {
+    "string_v0": v0_codec(coding),
+    "struct_v0": v0_codec(struct_coding),
+    "string_v1": v1_prepare,
+    "protobuf": protobuf_prepare,
+}
+
+MIN_RUN_SECONDS = 0.05
+
+def ops_per_sec(fn, repeat):
+    """
+    The best rate over a few timeit runs, each lasting at least MIN_RUN_SECONDS
+    """
+    timer = timeit.Timer(fn)
+    number = 1
+    while timer.timeit(number) < MIN_RUN_SECONDS:
+        number *= 4
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return int(number / best)
+
+def alloc_bytes(fn, samples=20):
+    """
+    Peak bytes allocated by a single call of fn, above what was live before it
+    """
+    fn() # Warm up any caches first
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(samples):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+    finally:
+        tracemalloc.stop()
+    return min(peaks)
+
+def run(codecs, repeat):
+    """
+    Benchmarks every corpus entry with every codec. Returns the result rows.
+    """
+    rows = []
+    for op, case, message, obj in corpus():
+        for name in codecs:
+            encode, unmarshal = CODECS[name](op, message, obj)
+            data = encode()
+            decode = lambda: unmarshal(data)
+            rows.append({
+                "codec": name,
+                "op": op,
+                "case": case,
+                "message": message,
+                "bytes": len(data),
+                "encode_ops_per_sec": ops_per_sec(encode, repeat),
+                "decode_ops_per_sec": ops_per_sec(decode, repeat),
+                "encode_alloc_bytes": alloc_bytes(encode),
+                "decode_alloc_bytes": alloc_bytes(decode),
+            })
+    return rows
+
+def row_key(row):
+    return (row["op"], row["case"], row["message"], row["codec"])
+
+def print_rows(rows):
+    print("{:<8}{:<7}{:<10}{:<11}{:>7}{:>12}{:>12}{:>9}{:>9}".format(
+        "op", "case", "message", "codec", "bytes", "enc/s", "dec/s", "enc B", "dec B"))
+    for row in rows:
+        print("{:<8}{:<7}{:<10}{:<11}{:>7}{:>12}{:>12}{:>9}{:>9}".format(
+            row["op"], row["case"], row["message"], row["codec"], row["bytes"],
+            row["encode_ops_per_sec"], row["decode_ops_per_sec"],
+            row["encode_alloc_bytes"], row["decode_alloc_bytes"]))
+
+def print_comparison(old_rows, rows):
+    """
+    Prints how every metric changed relative to an earlier results file
+    """
+    old = {row_key(row): row for row in old_rows}
+    print("{:<8}{:<7}{:<10}{:<11}{:>9}{:>9}{:>9}".format("op", "case", "message", "codec", "bytes", "enc/s", "dec/s"))
+    for row in rows:
+        before = old.get(row_key(row))
+        if before is None:
+            continue
+        changes = [
+            "{:+.0%}".format(row[metric] / before[metric] - 1) if before[metric] else "n/a"
+            for metric in ["bytes", "encode_ops_per_sec", "decode_ops_per_sec"]
+        ]
+        print("{:<8}{:<7}{:<10}{:<11}{:>9}{:>9}{:>9}".format(row["op"], row["case"], row["message"], row["codec"], *changes))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the wire codecs")
+    parser.add_argument("--codec", action="append", choices=sorted(CODECS), help="Only run this codec (repeatable)")
+    parser.add_argument("--repeat", type=int, default=3, help="timeit runs per measurement")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="Where to write the JSON results")
+    parser.add_argument("--compare", help="An earlier results file to compare against")
+    args = parser.parse_args()
+
+    rows = sorted(run(args.codec or list(CODECS), args.repeat), key=row_key)
+    print_rows(rows)
+    if args.compare:
+        with open(args.compare) as f:
+            print()
+            print_comparison(json.load(f)["results"], rows)
+
+    results = {
+        "python": platform.python_version(),
+        "protobuf": google.protobuf.__version__,
+        "results": rows,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
@@ -0,0 +1,72 @@
+"""
+Shows the CPU vs bandwidth trade-off of compressing frames: for large list,
+get_many and send_batch payloads (in both protocol versions) and their
+protobuf equivalents, how much smaller zlib makes them at a few levels and
+what that costs to compress and decompress.
+
+Run from the repository root with `python benchmarks/compression.py`.
+"""
+import os
+import sys
+import timeit
+import zlib
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.append(os.path.join(ROOT, "part2"))
+import coding
+import framing
+import schema
+import schema_pb2
+
+LEVELS = [1, 6, 9]
+TEXTS = [
+    "hey, are you coming to section later?",
+    "yeah! running a few minutes late though",
+    "no worries, we saved you a seat",
+    "did anyone finish the wire protocol part?",
+]
+
+def payloads():
+    """
+    Typical large payloads as (label, bytes)
+    """
+    accounts = [schema.Account(user_id="user{}".format(i), is_logged_in=False) for i in range(200)]
+    lst = schema.ListResponse(user_id="ream", success=True, error_message="", accounts=accounts)
+    messages = [schema.Message(author_id="mark", recipient_id="ream", text=TEXTS[i % len(TEXTS)], success=True) for i in range(100)]
+    many = schema.MessagesResponse(user_id="ream", success=True, error_message="", messages=messages)
+    sends = [schema.SendRequest(user_id="ream", recipient_id="user{}".format(i), text=TEXTS[i % len(TEXTS)]) for i in range(100)]
+    batch = schema.BatchSendRequest(user_id="ream", messages=sends)
+    pb_list = schema_pb2.ListResponse(success=True, accounts=[schema_pb2.Account(user_id=account.user_id) for account in accounts])
+    pb_batch = schema_pb2.MessageBatch(messages=[schema_pb2.Message(author_id=msg.user_id, recipient_id=msg.recipient_id, text=msg.text) for msg in sends])
+    return [
+        ("list x200 v0", coding.marshal_list_response(lst)),
+        ("list x200 v1", coding.marshal_response_v1(lst)),
+        ("list x200 protobuf", pb_list.SerializeToString()),
+        ("get_many x100 v0", coding.marshal_messages_response(many)),
+        ("get_many x100 v1", coding.marshal_response_v1(many)),
+        ("send_batch x100 v0", coding.marshal_batch_send_request(batch)),
+        ("send_batch x100 v1", coding.marshal_request_v1(batch, "send_batch")),
+        ("send_batch x100 protobuf", pb_batch.SerializeToString()),
+    ]
+
+def microseconds(fn):
+    """
+    Best time of one call of fn, in microseconds
+    """
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number * 1e6
+
+if __name__ == "__main__":
+    print("Frames under {} bytes are never compressed (framing.COMPRESSION_THRESHOLD)".format(framing.COMPRESSION_THRESHOLD))
+    print("Level {} is what the socket server uses (framing.COMPRESSION_LEVEL)".format(framing.COMPRESSION_LEVEL))
+    print()
+    print("{:<26}{:>8}{:>7}{:>10}{:>8}{:>10}{:>10}".format("payload", "raw", "level", "zlib", "ratio", "comp us", "decomp us"))
+    for label, data in payloads():
+        for level in LEVELS:
+            compressed = zlib.compress(data, level)
+            print("{:<26}{:>8}{:>7}{:>10}{:>7.1f}x{:>10.1f}{:>10.1f}".format(
+                label, len(data), level, len(compressed), len(data) / len(compressed),
+                microseconds(lambda: zlib.compress(data, level)),
+                microseconds(lambda: zlib.decompress(compressed))))
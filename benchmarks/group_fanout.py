@@ -0,0 +1,62 @@
+"""
+Measures sending one text to every member of a group: once as a send frame
+per member, the way a client had to before groups, and once as a single
+send_group frame. Both go through Server.handle_frame, for groups of 10 to
+10000 members. Prints the time to reach every member and the memory the
+queued messages take, as counted by tracemalloc.
+
+Run from the repository root with `python benchmarks/group_fanout.py`.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import coding
+import schema
+import server
+
+def run(members, rounds, grouped):
+    """
+    Returns the seconds per round and the bytes allocated for the queued messages
+    """
+    s = server.Server("127.0.0.1", 0, None)
+    user_ids = ["m{}".format(i) for i in range(members)]
+    for user_id in ["author"] + user_ids:
+        s.handle_create(schema.Request(user_id=user_id))
+        s.handle_join_group(schema.GroupRequest(user_id=user_id, group_id="all"))
+    text = "x" * 200
+    if grouped:
+        frames = [coding.marshal_request(schema.GroupSendRequest(user_id="author", group_id="all", text=text), "send_group", coding.VERSION_1)]
+    else:
+        frames = [coding.marshal_request(schema.SendRequest(user_id="author", recipient_id=user_id, text=text), "send", coding.VERSION_1) for user_id in user_ids]
+    session = server.Session()
+    elapsed = 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for data in frames:
+            s.handle_frame(memoryview(data), session)
+        elapsed += time.perf_counter() - start
+        for user_id in user_ids:
+            s.msgs_cache[user_id].take()
+    tracemalloc.start()
+    for data in frames:
+        s.handle_frame(memoryview(data), session)
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return elapsed / rounds, allocated
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    print("{:>10}{:>16}{:>16}{:>16}{:>16}".format("members", "sends ms", "send_group ms", "sends KiB", "send_group KiB"))
+    for members in args.members:
+        sends, sends_memory = run(members, args.rounds, grouped=False)
+        group, group_memory = run(members, args.rounds, grouped=True)
+        print("{:>10}{:>16.3f}{:>16.3f}{:>16.1f}{:>16.1f}".format(members, sends * 1e3, group * 1e3, sends_memory / 1024, group_memory / 1024))
@@ -0,0 +1,104 @@
+"""
+Opens many idle connections to a freshly started server, then checks that
+a new client is still served and how much memory the server is using.
+With a thread per connection the threaded server stops answering once its
+workers are used up, while the async server keeps going.
+
+Run from the repository root, e.g.
+`python benchmarks/idle_connections.py --mode async --connections 10000`.
+NOTE: Every connection takes a file descriptor in both this process and the
+server, so --connections is limited by `ulimit -n`.
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import coding
+import framing
+import schema
+from async_server import raise_fd_limit
+
+SERVER = """
+import sys
+sys.path.insert(0, {root!r})
+from concurrent import futures
+import server, async_server
+if {mode!r} == "async":
+    s = async_server.AsyncServer("127.0.0.1", {port})
+else:
+    s = server.Server("127.0.0.1", {port}, futures.ThreadPoolExecutor(max_workers={workers}))
+s.start()
+"""
+
+def server_rss_kb(pid):
+    """
+    The resident memory of a process in KiB (Linux only)
+    """
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def round_trip(port, timeout):
+    """
+    Creates an account on a new connection. Returns the seconds it took,
+    or None if the server never answered.
+    """
+    sock = socket.create_connection(("127.0.0.1", port), timeout=timeout)
+    try:
+        start = time.perf_counter()
+        sock.sendall(framing.frame(coding.marshal_create_request(schema.Request(user_id="probe"))))
+        data = framing.recv_frame(sock, framing.FrameDecoder())
+        if data is None:
+            return None
+        return time.perf_counter() - start
+    except socket.timeout:
+        return None
+    finally:
+        sock.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["async", "threaded"], default="async")
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--workers", type=int, default=None, help="thread pool size in threaded mode (default: Python's)")
+    parser.add_argument("--port", type=int, default=65433)
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds to wait for the probe's answer")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    source = SERVER.format(root=ROOT, mode=args.mode, port=args.port, workers=args.workers)
+    proc = subprocess.Popen([sys.executable, "-c", source], stdout=subprocess.DEVNULL)
+    try:
+        time.sleep(1)
+        base_rss = server_rss_kb(proc.pid)
+        start = time.perf_counter()
+        idle = []
+        for _ in range(args.connections):
+            idle.append(socket.create_connection(("127.0.0.1", args.port)))
+        opened = time.perf_counter() - start
+        time.sleep(1)
+        rss = server_rss_kb(proc.pid)
+        latency = round_trip(args.port, args.timeout)
+
+        print("mode: {}".format(args.mode))
+        print("idle connections: {} (opened in {:.1f}s)".format(len(idle), opened))
+        if base_rss is not None and rss is not None:
+            print("server memory: {} KiB idle, {} KiB with connections ({:.1f} KiB each)".format(base_rss, rss, (rss - base_rss) / max(1, len(idle))))
+        if latency is None:
+            print("new client: NOT SERVED within {}s".format(args.timeout))
+        else:
+            print("new client: served in {:.2f} ms".format(latency * 1000))
+        for sock in idle:
+            sock.close()
+    finally:
+        proc.kill()
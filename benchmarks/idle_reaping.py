@@ -0,0 +1,86 @@
+"""
+Measures what finding idle connections costs as the number of connections
+grows. Every connection is added to a TimerWheel, and each second (on a
+simulated clock) the connections whose turn it is send a heartbeat, as the
+client does every HEARTBEAT_SECONDS, and the wheel is expired. A share of
+the connections never send anything; they are dropped and then added again,
+standing in for new clients. Prints the time per touch and per tick (and the
+connections dropped per tick), next to a tick that scans every connection's
+last_active the way a plain loop would.
+
+Run from the repository root, e.g.
+`python benchmarks/idle_reaping.py --connections 100 1000 10000 100000`.
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import idle
+
+class Connection:
+    last_active = None
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def run(connections, timeout, ticks, quiet_share):
+    """
+    Returns the seconds per touch, seconds per wheel tick, connections
+    dropped per tick and seconds per scanning tick
+    """
+    clock = Clock()
+    wheel = idle.TimerWheel(timeout, resolution=1.0, clock=clock)
+    tracked = [Connection() for _ in range(connections)]
+    for i, connection in enumerate(tracked):
+        clock.now = i * timeout / connections # Spread their deadlines out, like real arrivals
+        wheel.add(connection)
+    beating = tracked[int(connections * quiet_share):]
+    # The first timeout ticks only warm the wheel up, until every deadline comes from a touch
+    touches = 0
+    touch_time = 0
+    tick_time = 0
+    scan_time = 0
+    dropped = 0
+    for tick in range(int(timeout) + ticks):
+        measuring = tick >= timeout
+        clock.now += 1.0
+        active = beating[tick % idle.HEARTBEAT_SECONDS::idle.HEARTBEAT_SECONDS]
+        start = time.perf_counter()
+        for connection in active:
+            wheel.touch(connection)
+        if measuring:
+            touch_time += time.perf_counter() - start
+            touches += len(active)
+        start = time.perf_counter()
+        expired = wheel.expire()
+        for connection in expired:
+            wheel.add(connection)
+        if measuring:
+            tick_time += time.perf_counter() - start
+            dropped += len(expired)
+        start = time.perf_counter()
+        deadline = clock.now - timeout
+        [connection for connection in tracked if connection.last_active <= deadline]
+        if measuring:
+            scan_time += time.perf_counter() - start
+    return touch_time / max(1, touches), tick_time / ticks, dropped / ticks, scan_time / ticks
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--timeout", type=float, default=idle.DEFAULT_IDLE_TIMEOUT)
+    parser.add_argument("--ticks", type=int, default=200, help="seconds of simulated time")
+    parser.add_argument("--quiet-share", type=float, default=0.01, help="share of the connections that never send a heartbeat")
+    args = parser.parse_args()
+
+    print("{:>12}{:>12}{:>14}{:>14}{:>14}".format("connections", "touch us", "tick us", "dropped", "scan tick us"))
+    for connections in args.connections:
+        touch, tick, dropped, scan = run(connections, args.timeout, args.ticks, args.quiet_share)
+        print("{:>12}{:>12.3f}{:>14.1f}{:>14.0f}{:>14.1f}".format(connections, touch * 1e6, tick * 1e6, dropped, scan * 1e6))
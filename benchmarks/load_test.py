@@ -0,0 +1,484 @@
+"""
+A headless load generator for both servers. It simulates many users at once:
+every online user holds a subscription (a subscribe connection to the socket
+server, a Subscribe stream from the gRPC server) and messages are sent
+between them at a fixed total rate over a few pipelined sender connections.
+Users can go offline and come back (churn), in which case their messages
+wait in their mailbox and are drained when they subscribe again.
+
+Each message carries the time it was due to be sent, so the latency from
+send to delivery is measured without being hidden by a backed up sender
+(the sends are open loop: they don't wait for earlier ones). Prints the
+sends and deliveries per second and the p50/p99/p99.9 latency, and saves
+them as JSON, by default to benchmarks/results/load_<target>.json, so that
+a later run can be compared with --compare.
+
+Targets: "async", "threaded" and "cluster" start server.py in that mode,
+"grpc" starts part2/server.py, each in a subprocess. Pass --external to
+load a server that is already running at --host and --port instead.
+
+Recipients are picked with --pattern:
+- uniform: any user, equally likely
+- zipf: a few users receive most messages (Zipf with exponent --zipf)
+- hotspot: --hot-share of the messages go to the first --hot-users users
+  (fan-in), the rest are uniform
+
+Run from the repository root, e.g.
+`python benchmarks/load_test.py --target async --users 2000 --rate 5000`.
+NOTE: Latency includes the time a message waited for an offline recipient,
+so use --churn 0 (the default) to measure delivery to online users only.
+Every online user takes a file descriptor here and in the server.
+"""
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import os
+import platform
+import random
+import signal
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.append(os.path.join(ROOT, "part2"))
+import coding
+import framing
+import schema
+from async_server import raise_fd_limit
+from cluster import read_frame
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+TICK = 0.005 # Seconds between batches of sends
+LOGIN_ATTEMPTS = 100 # A user coming back online may have to wait for the server to see them leave
+LOGIN_RETRY_SECONDS = 0.02
+SETUP_CHUNK = 256 # Accounts created per round trip
+
+SERVER = """
+import sys
+sys.path.insert(0, {root!r})
+from concurrent import futures
+import server, async_server, cluster
+if {target!r} == "async":
+    s = async_server.AsyncServer("127.0.0.1", {port})
+elif {target!r} == "cluster":
+    s = cluster.Cluster("127.0.0.1", {port}, workers={processes})
+else:
+    s = server.Server("127.0.0.1", {port}, futures.ThreadPoolExecutor(max_workers={workers}))
+s.start()
+"""
+
+GRPC_SERVER = """
+import sys
+sys.path.insert(0, {root!r})
+sys.path.insert(0, {part2!r})
+import server
+server.serve(port={port}, workers={workers})
+"""
+
+BACKGROUND = set() # Tasks nothing else holds on to, which the loop only keeps weak references to
+
+def spawn(coro):
+    """
+    Runs a coroutine in the background
+    """
+    task = asyncio.ensure_future(coro)
+    BACKGROUND.add(task)
+    task.add_done_callback(BACKGROUND.discard)
+    return task
+
+def user_ids(count):
+    return ["u{}".format(i) for i in range(count)]
+
+def recipient_picker(users, pattern, rng, zipf, hot_users, hot_share):
+    """
+    A function returning the recipient of the next message
+    """
+    if pattern == "uniform":
+        return lambda : rng.choice(users)
+    if pattern == "zipf":
+        weights = itertools.accumulate(1 / rank ** zipf for rank in range(1, len(users) + 1))
+        cumulative = list(weights)
+        return lambda : users[bisect.bisect(cumulative, rng.random() * cumulative[-1])]
+    hot = users[:hot_users]
+    return lambda : rng.choice(hot) if rng.random() < hot_share else rng.choice(users)
+
+def text_of(due, size):
+    """
+    A message text carrying the time it was due, padded to size characters
+    """
+    stamp = "{:.6f}".format(due)
+    return stamp + " " + "x" * max(0, size - len(stamp) - 1)
+
+class Recorder:
+    """
+    Counts what happens during the measured part of a run
+    NOTE: Sends and deliveries are counted if they happen between start and
+    end, and a latency is kept for every message that was due in that time
+    """
+    def __init__(self):
+        self.start = None
+        self.end = None
+        self.acked = 0
+        self.failed = 0
+        self.delivered = 0
+        self.due = 0 # Sends that were due while measuring
+        self.latencies = []
+
+    def measuring(self, when):
+        return self.start is not None and self.start <= when and (self.end is None or when < self.end)
+
+    def sent(self, due):
+        if self.measuring(due):
+            self.due += 1
+
+    def ack(self, success):
+        now = time.perf_counter()
+        if self.measuring(now):
+            if success:
+                self.acked += 1
+            else:
+                self.failed += 1
+
+    def deliver(self, text):
+        now = time.perf_counter()
+        due = float(text.split(" ", 1)[0])
+        if self.measuring(now):
+            self.delivered += 1
+        if self.measuring(due):
+            self.latencies.append(now - due)
+
+    def results(self):
+        seconds = self.end - self.start
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 3)
+        return {
+            "sends_per_sec": round(self.acked / seconds),
+            "deliveries_per_sec": round(self.delivered / seconds),
+            "send_failures": self.failed,
+            "undelivered": self.due - len(latencies),
+            "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99),
+            "p999_ms": percentile(0.999),
+            "max_ms": percentile(1),
+        }
+
+class SocketTarget:
+    """
+    Drives server.py in any mode, in protocol version 1
+    """
+    def __init__(self, host, port, recorder):
+        self.host = host
+        self.port = port
+        self.recorder = recorder
+        self.senders = []
+
+    async def connect(self):
+        return await asyncio.open_connection(self.host, self.port)
+
+    async def call(self, reader, writer, requests):
+        """
+        Sends pipelined requests and returns their responses
+        """
+        writer.write(framing.frame_all(requests))
+        return [coding.unmarshal_response(await read_frame(reader)) for _ in requests]
+
+    async def setup(self, users, connections):
+        """
+        Creates every account (logged out) and opens the sender connections
+        """
+        reader, writer = await self.connect()
+        for start in range(0, len(users), SETUP_CHUNK):
+            chunk = users[start:start + SETUP_CHUNK]
+            await self.call(reader, writer, [coding.marshal_request(schema.Request(user_id), "create", coding.VERSION_1) for user_id in chunk])
+            await self.call(reader, writer, [coding.marshal_request(schema.Request(user_id), "logout", coding.VERSION_1) for user_id in chunk])
+        writer.close()
+        for _ in range(connections):
+            reader, writer = await self.connect()
+            spawn(self.read_acks(reader))
+            self.senders.append(writer)
+
+    async def read_acks(self, reader):
+        try:
+            while True:
+                self.recorder.ack(coding.unmarshal_response(await read_frame(reader)).success)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+
+    async def send(self, index, messages):
+        """
+        Pipelines (due, author_id, recipient_id, text) sends on one of the sender connections
+        """
+        writer = self.senders[index % len(self.senders)]
+        writer.write(framing.frame_all([
+            coding.marshal_request(schema.SendRequest(user_id=author_id, recipient_id=recipient_id, text=text), "send", coding.VERSION_1)
+            for _, author_id, recipient_id, text in messages
+        ]))
+        await writer.drain()
+
+    async def go_online(self, user_id, first):
+        """
+        Logs in and subscribes on a connection of the user's own. Returns
+        something to pass to go_offline.
+        """
+        reader, writer = await self.connect()
+        for _ in range(LOGIN_ATTEMPTS):
+            (resp,) = await self.call(reader, writer, [coding.marshal_request(schema.Request(user_id), "login", coding.VERSION_1)])
+            if resp.success:
+                break
+            await asyncio.sleep(LOGIN_RETRY_SECONDS)
+        request = schema.GetManyRequest(user_id=user_id, max_count=256, max_bytes=256 * 1024)
+        writer.write(framing.frame(coding.marshal_request(request, "subscribe", coding.VERSION_1)))
+        task = spawn(self.read_pushes(reader))
+        return writer, task
+
+    async def read_pushes(self, reader):
+        try:
+            while True:
+                for msg in coding.unmarshal_response(await read_frame(reader)).messages:
+                    self.recorder.deliver(msg.text)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+
+    def go_offline(self, handle):
+        writer, task = handle
+        task.cancel()
+        writer.close()
+
+    async def close(self):
+        for writer in self.senders:
+            writer.close()
+
+class GrpcTarget:
+    """
+    Drives part2/server.py over one channel
+    NOTE: Sends are unary calls, so --connections times --window of them
+    are kept in flight at most
+    """
+    def __init__(self, host, port, recorder, window):
+        import grpc
+        import schema_pb2
+        import schema_pb2_grpc
+        self.pb = schema_pb2
+        self.channel = grpc.aio.insecure_channel("{}:{}".format(host, port))
+        self.stub = schema_pb2_grpc.ChatHandlerStub(self.channel)
+        self.recorder = recorder
+        self.in_flight = None
+        self.window = window
+
+    async def setup(self, users, connections):
+        """
+        Creates every account (which logs it in)
+        """
+        self.in_flight = asyncio.Semaphore(connections * self.window)
+        for start in range(0, len(users), SETUP_CHUNK):
+            await asyncio.gather(*[self.stub.Create(self.pb.Credentials(user_id=user_id)) for user_id in users[start:start + SETUP_CHUNK]])
+
+    async def send_one(self, author_id, recipient_id, text):
+        try:
+            resp = await self.stub.Send(self.pb.Message(author_id=author_id, recipient_id=recipient_id, text=text))
+            self.recorder.ack(resp.success)
+        except Exception:
+            self.recorder.ack(False)
+        finally:
+            self.in_flight.release()
+
+    async def send(self, index, messages):
+        for _, author_id, recipient_id, text in messages:
+            await self.in_flight.acquire()
+            spawn(self.send_one(author_id, recipient_id, text))
+
+    async def go_online(self, user_id, first):
+        """
+        Logs in (accounts start logged in) and subscribes
+        """
+        if not first:
+            for _ in range(LOGIN_ATTEMPTS):
+                if (await self.stub.Login(self.pb.Credentials(user_id=user_id))).success:
+                    break
+                await asyncio.sleep(LOGIN_RETRY_SECONDS)
+        call = self.stub.Subscribe(self.pb.Credentials(user_id=user_id))
+        spawn(self.read_pushes(call))
+        return call
+
+    async def read_pushes(self, call):
+        try:
+            async for msg in call:
+                self.recorder.deliver(msg.text)
+        except Exception:
+            pass # Cancelled by go_offline
+
+    def go_offline(self, call):
+        call.cancel() # The server logs the user out
+
+    async def close(self):
+        # Closing the channel under calls that are still being cancelled can
+        # hang the grpc poller thread, so let them all end first
+        await asyncio.gather(*BACKGROUND, return_exceptions=True)
+        await self.channel.close()
+
+class Population:
+    """
+    Which users are online, and their churn
+    """
+    def __init__(self, target, users, rng):
+        self.target = target
+        self.users = users
+        self.rng = rng
+        self.online = {} # user_id -> what go_offline needs
+        self.seen = set() # Users that were online before
+        self.stopped = False # Whether users have stopped coming back online
+
+    async def bring_online(self, user_ids):
+        if self.stopped:
+            return
+        handles = await asyncio.gather(*[self.target.go_online(user_id, user_id not in self.seen) for user_id in user_ids])
+        for user_id, handle in zip(user_ids, handles):
+            self.online[user_id] = handle
+            self.seen.add(user_id)
+
+    async def churn(self, rate, offline_seconds, deadline):
+        """
+        Every online user goes offline at the given rate (per second), and
+        comes back after offline_seconds on average
+        """
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(0.1)
+            expected = len(self.online) * rate * 0.1
+            count = int(expected) + (self.rng.random() < expected - int(expected))
+            for user_id in self.rng.sample(list(self.online), min(count, len(self.online))):
+                self.target.go_offline(self.online.pop(user_id))
+                asyncio.get_running_loop().call_later(self.rng.expovariate(1 / offline_seconds), lambda user_id=user_id : spawn(self.bring_online([user_id])))
+
+async def send_loop(target, users, pick, rate, size, recorder, rng, deadline):
+    """
+    Sends rate messages per second between random users until the deadline,
+    in a batch every TICK on each sender connection in turn
+    """
+    start = time.perf_counter()
+    count = 0
+    index = 0
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            return
+        batch = []
+        while start + count / rate <= now:
+            due = start + count / rate
+            batch.append((due, rng.choice(users), pick(), text_of(due, size)))
+            recorder.sent(due)
+            count += 1
+        if batch:
+            await target.send(index, batch)
+            index += 1
+        await asyncio.sleep(TICK)
+
+async def run(args, recorder):
+    rng = random.Random(args.seed)
+    users = user_ids(args.users)
+    if args.target == "grpc":
+        target = GrpcTarget(args.host, args.port, recorder, args.window)
+    else:
+        target = SocketTarget(args.host, args.port, recorder)
+    await target.setup(users, args.connections)
+    population = Population(target, users, rng)
+    await population.bring_online(rng.sample(users, int(len(users) * args.online)))
+    print("{} users, {} online".format(len(users), len(population.online)))
+
+    pick = recipient_picker(users, args.pattern, rng, args.zipf, args.hot_users, args.hot_share)
+    start = time.perf_counter()
+    recorder.start = start + args.warmup
+    recorder.end = start + args.warmup + args.seconds
+    tasks = [asyncio.ensure_future(send_loop(target, users, pick, args.rate, args.text_size, recorder, rng, recorder.end))]
+    if args.churn > 0:
+        tasks.append(asyncio.ensure_future(population.churn(args.churn, args.offline_seconds, recorder.end)))
+    await asyncio.gather(*tasks)
+    await asyncio.sleep(args.drain) # Let messages sent at the end arrive
+    population.stopped = True
+    for handle in population.online.values():
+        target.go_offline(handle)
+    await target.close()
+    rest = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in rest:
+        task.cancel() # e.g. users still coming back online
+    await asyncio.gather(*rest, return_exceptions=True)
+
+def print_results(results):
+    for metric, value in results.items():
+        print("{:<20}{:>12}".format(metric, "n/a" if value is None else value))
+
+def print_comparison(old, results):
+    """
+    Prints how every metric changed relative to an earlier results file
+    """
+    print("{:<20}{:>12}{:>12}{:>9}".format("metric", "baseline", "now", "change"))
+    for metric, value in results.items():
+        before = old.get(metric)
+        change = "{:+.0%}".format(value / before - 1) if before and value is not None else "n/a"
+        print("{:<20}{:>12}{:>12}{:>9}".format(metric, "n/a" if before is None else before, "n/a" if value is None else value, change))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load a chat server with simulated users")
+    parser.add_argument("--target", choices=["async", "threaded", "cluster", "grpc"], default="async")
+    parser.add_argument("--external", action="store_true", help="load a server already running at --host and --port instead of starting one")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=65435)
+    parser.add_argument("--processes", type=int, default=2, help="worker processes of a cluster target")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--online", type=float, default=1.0, help="share of the users online at the start")
+    parser.add_argument("--rate", type=float, default=2000, help="messages sent per second, in total")
+    parser.add_argument("--text-size", type=int, default=32, help="characters per message")
+    parser.add_argument("--pattern", choices=["uniform", "zipf", "hotspot"], default="uniform", help="how recipients are picked")
+    parser.add_argument("--zipf", type=float, default=1.1, help="exponent of the zipf pattern")
+    parser.add_argument("--hot-users", type=int, default=10, help="recipients of the hotspot pattern")
+    parser.add_argument("--hot-share", type=float, default=0.5, help="share of the messages sent to the hot users")
+    parser.add_argument("--churn", type=float, default=0.0, help="rate at which each online user goes offline, per second")
+    parser.add_argument("--offline-seconds", type=float, default=2.0, help="how long a user stays offline on average")
+    parser.add_argument("--connections", type=int, default=4, help="sender connections")
+    parser.add_argument("--window", type=int, default=64, help="sends in flight per sender connection (grpc only)")
+    parser.add_argument("--warmup", type=float, default=1.0, help="seconds of load before measuring")
+    parser.add_argument("--seconds", type=float, default=10.0, help="seconds of load measured")
+    parser.add_argument("--drain", type=float, default=2.0, help="seconds to wait for the last deliveries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="where to write the JSON results (default: benchmarks/results/load_<target>.json)")
+    parser.add_argument("--compare", help="an earlier results file to compare against")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    proc = None
+    if not args.external:
+        if args.target == "grpc":
+            source = GRPC_SERVER.format(root=ROOT, part2=os.path.join(ROOT, "part2"), port=args.port, workers=args.users + args.connections * args.window + 16)
+        else:
+            source = SERVER.format(root=ROOT, target=args.target, port=args.port, processes=args.processes, workers=args.users + args.connections + 16)
+        proc = subprocess.Popen([sys.executable, "-c", source], stdout=subprocess.DEVNULL, start_new_session=True)
+        time.sleep(1.5)
+    recorder = Recorder()
+    try:
+        asyncio.run(run(args, recorder))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                os.killpg(proc.pid, signal.SIGKILL) # A cluster worker can miss its SIGTERM, so take the whole group
+                proc.wait()
+
+    results = recorder.results()
+    print_results(results)
+    if args.compare:
+        with open(args.compare) as f:
+            print()
+            print_comparison(json.load(f)["results"], results)
+    output = args.output or os.path.join(RESULTS, "load_{}.json".format(args.target))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"python": platform.python_version(), "config": vars(args), "results": results}, f, indent=2, sort_keys=True)
+        f.write("\n")
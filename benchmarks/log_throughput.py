@@ -0,0 +1,74 @@
+"""
+Measures how much logging messages to disk costs: threads send messages as
+fast as they can, each waiting for its send to be committed to the log like
+a connection does before replying, for every fsync policy and a range of
+thread counts. Prints the sends per second and how many sends each write to
+the log covered on average (more than one means commits were grouped).
+
+"off" is a server without a log, for comparison.
+
+Run from the repository root with `python benchmarks/log_throughput.py`.
+NOTE: The log goes to the system's temporary directory unless --dir is
+given, and fsync speed depends entirely on the disk under it.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import message_log
+import schema
+import server
+
+def run(policy, threads, seconds, directory):
+    """
+    Returns (sends per second, sends per write to the log)
+    """
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        log_path = None if policy == "off" else os.path.join(tmp, "chat.log")
+        s = server.Server("127.0.0.1", 0, None, log_path=log_path, fsync=message_log.ALWAYS if policy == "off" else policy)
+        for i in range(threads):
+            s.handle_create(schema.Request(user_id="u{}".format(i)))
+        stop = threading.Event()
+        sends = [0] * threads
+
+        def send_loop(index):
+            request = schema.SendRequest(user_id="u{}".format(index), recipient_id="u{}".format((index + 1) % threads), text="x" * 64)
+            mailbox = s.msgs_cache[request.recipient_id]
+            while not stop.is_set():
+                s.handle_send(request)
+                s.commit_log()
+                mailbox.take() # So that the mailboxes don't grow without bound
+                sends[index] += 1
+
+        workers = [threading.Thread(target=send_loop, args=(i,)) for i in range(threads)]
+        start_syncs = s.log.syncs if s.log is not None else 0
+        for worker in workers:
+            worker.start()
+        time.sleep(seconds)
+        stop.set()
+        for worker in workers:
+            worker.join()
+        if s.log is None:
+            return sum(sends) / seconds, 0
+        syncs = s.log.syncs - start_syncs
+        s.log.close()
+        return sum(sends) / seconds, sum(sends) / max(1, syncs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--policies", nargs="+", default=["off"] + message_log.FSYNC_POLICIES, help='fsync policies to compare ("off" for no log)')
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 8, 32], help="sending thread counts to compare")
+    parser.add_argument("--seconds", type=float, default=2.0)
+    parser.add_argument("--dir", default=None, help="directory to put the log in")
+    args = parser.parse_args()
+
+    print("{:>10}{:>9}{:>10}{:>16}".format("fsync", "threads", "sends/s", "sends/write"))
+    for policy in args.policies:
+        for threads in args.threads:
+            sends, per_write = run(policy, threads, args.seconds, args.dir)
+            print("{:>10}{:>9}{:>10.0f}{:>16.1f}".format(policy, threads, sends, per_write))
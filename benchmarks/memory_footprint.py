@@ -0,0 +1,120 @@
+"""
+Measures how much memory each account and each waiting message takes, as
+counted by tracemalloc. Accounts are created and messages sent through
+Server.handle_frame, as a client would (and through the servicer's RPCs for
+the gRPC server), so the user_ids and texts are decoded from frames rather
+than shared string constants. Every account is first sent one message, and
+then the rest are sent. Prints the bytes per (empty) account, what an
+account's mailbox costs once something waits in it, beyond the message
+itself, and the bytes per queued message, for each server.
+
+Pass --max-account-bytes and --max-message-bytes to exit with an error when
+the socket server goes over them, so that a change that bloats the data
+model gets caught.
+
+Run from the repository root with `python benchmarks/memory_footprint.py`.
+"""
+import argparse
+import importlib.util
+import os
+import sys
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.append(os.path.join(ROOT, "part2")) # For schema_pb2, after the socket server's modules
+import coding
+import schema
+import schema_pb2
+import server
+
+# The gRPC server shares its module name with the socket server
+spec = importlib.util.spec_from_file_location("grpc_server", os.path.join(ROOT, "part2", "server.py"))
+grpc_server = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(grpc_server)
+
+def user_ids(accounts):
+    return ["u{}".format(i) for i in range(accounts)]
+
+def per_item(sizes, accounts, messages):
+    """
+    The bytes per account, per mailbox in use and per message, from the
+    memory in use at the start, after the accounts were created, after each
+    was sent a message and after the rest of the messages were sent
+    """
+    per_message = (sizes[3] - sizes[2]) / messages
+    return (sizes[1] - sizes[0]) / accounts, (sizes[2] - sizes[1]) / accounts - per_message, per_message
+
+def run_socket(accounts, messages, text, preencode):
+    """
+    Returns the bytes per account, per mailbox in use and per waiting message
+    """
+    s = server.Server("127.0.0.1", 0, None, preencode=preencode)
+    session = server.Session()
+    ids = user_ids(accounts)
+    creates = [coding.marshal_request(schema.Request(user_id), "create", coding.VERSION_1) for user_id in ids]
+    sends = [coding.marshal_request(schema.SendRequest(user_id=ids[i % accounts], recipient_id=ids[(i + 1) % accounts], text=text), "send", coding.VERSION_1) for i in range(accounts + messages)]
+    sizes = []
+    tracemalloc.start()
+    sizes.append(tracemalloc.get_traced_memory()[0])
+    for data in creates:
+        s.handle_frame(memoryview(data), session)
+    sizes.append(tracemalloc.get_traced_memory()[0])
+    for data in sends[:accounts]:
+        s.handle_frame(memoryview(data), session)
+    sizes.append(tracemalloc.get_traced_memory()[0])
+    for data in sends[accounts:]:
+        s.handle_frame(memoryview(data), session)
+    sizes.append(tracemalloc.get_traced_memory()[0])
+    tracemalloc.stop()
+    return per_item(sizes, accounts, messages)
+
+def run_grpc(accounts, messages, text, preencode):
+    """
+    Returns the bytes per account, per mailbox in use and per waiting message
+    """
+    s = grpc_server.ChatHandlerServicer(None, preencode=preencode)
+    ids = user_ids(accounts)
+    creates = [schema_pb2.Credentials(user_id=user_id).SerializeToString() for user_id in ids]
+    sends = [schema_pb2.Message(author_id=ids[i % accounts], recipient_id=ids[(i + 1) % accounts], text=text).SerializeToString() for i in range(accounts + messages)]
+    sizes = []
+    tracemalloc.start()
+    sizes.append(tracemalloc.get_traced_memory()[0])
+    for data in creates:
+        s.Create(schema_pb2.Credentials.FromString(data), None)
+    sizes.append(tracemalloc.get_traced_memory()[0])
+    for data in sends[:accounts]:
+        s.Send(schema_pb2.Message.FromString(data), None)
+    sizes.append(tracemalloc.get_traced_memory()[0])
+    for data in sends[accounts:]:
+        s.Send(schema_pb2.Message.FromString(data), None)
+    sizes.append(tracemalloc.get_traced_memory()[0])
+    tracemalloc.stop()
+    return per_item(sizes, accounts, messages)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--accounts", type=int, default=100000)
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--text-length", type=int, default=20)
+    parser.add_argument("--max-account-bytes", type=float, default=None, help="fail if an account of the socket server takes more")
+    parser.add_argument("--max-message-bytes", type=float, default=None, help="fail if a waiting message of the socket server takes more")
+    args = parser.parse_args()
+
+    text = "x" * args.text_length
+    print("{:>18}{:>14}{:>14}{:>14}".format("server", "B / account", "B / mailbox", "B / message"))
+    results = {}
+    for target, run, preencode in [("socket", run_socket, False), ("socket preencode", run_socket, True), ("grpc", run_grpc, False), ("grpc preencode", run_grpc, True)]:
+        results[target] = run(args.accounts, args.messages, text, preencode)
+        print("{:>18}{:>14.0f}{:>14.0f}{:>14.0f}".format(target, *results[target]))
+
+    per_account, _, per_message = results["socket"]
+    failed = False
+    if args.max_account_bytes is not None and per_account > args.max_account_bytes:
+        print("Error: {:.0f} bytes per account is over {:.0f}".format(per_account, args.max_account_bytes))
+        failed = True
+    if args.max_message_bytes is not None and per_message > args.max_message_bytes:
+        print("Error: {:.0f} bytes per message is over {:.0f}".format(per_message, args.max_message_bytes))
+        failed = True
+    if failed:
+        sys.exit(1)
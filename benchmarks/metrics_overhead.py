@@ -0,0 +1,80 @@
+"""
+Measures what recording metrics costs a server: threads push send and get
+frames through Server.handle_frame as fast as they can, counting the bytes
+in and out like a connection does, once with the metrics recorded and once
+with a Metrics that records nothing. Prints the requests per second of both
+and the time each request spent recording.
+
+Run from the repository root with `python benchmarks/metrics_overhead.py`.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import coding
+import metrics
+import schema
+import server
+
+class UnrecordedMetrics(metrics.Metrics):
+    """
+    Metrics that throw every observation away
+    """
+    def observe(self, op, seconds, success=True):
+        pass
+
+    def received(self, nbytes):
+        pass
+
+    def sent(self, nbytes):
+        pass
+
+def run(recorded, threads, seconds):
+    """
+    Returns the requests per second
+    """
+    s = server.Server("127.0.0.1", 0, None)
+    if not recorded:
+        s.metrics = UnrecordedMetrics([op.name for op in coding.OPS] + [metrics.DELIVER])
+    stop = threading.Event()
+    requests = [0] * threads
+
+    def loop(index):
+        user_id = "u{}".format(index)
+        s.handle_create(schema.Request(user_id=user_id))
+        session = server.Session()
+        frames = [
+            coding.marshal_request(schema.SendRequest(user_id=user_id, recipient_id=user_id, text="x" * 64), "send", coding.VERSION_1),
+            coding.marshal_request(schema.Request(user_id=user_id), "get", coding.VERSION_1),
+        ]
+        while not stop.is_set():
+            for data in frames:
+                s.metrics.received(len(data))
+                out = s.handle_frame(memoryview(data), session)
+                s.metrics.sent(len(out))
+            requests[index] += len(frames)
+
+    workers = [threading.Thread(target=loop, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return sum(requests) / seconds
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 8], help="thread counts to compare")
+    parser.add_argument("--seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    print("{:>9}{:>14}{:>14}{:>16}".format("threads", "off req/s", "on req/s", "us per request"))
+    for threads in args.threads:
+        off = run(False, threads, args.seconds)
+        on = run(True, threads, args.seconds)
+        print("{:>9}{:>14.0f}{:>14.0f}{:>16.2f}".format(threads, off, on, (1 / on - 1 / off) * 1e6))
@@ -0,0 +1,95 @@
+"""
+Measures what keeping requests in flight buys a single connection. Starts a
+server in a subprocess, then sends send requests to random users over one
+AsyncClient connection for a few seconds, with 1 (stop-and-wait, like
+client.py), 8, 64 and 256 requests in flight, and prints the requests
+answered per second and the p50/p99 time from submit to response.
+
+Against a cluster every request goes to worker 0, so about half of them are
+forwarded, and the local ones don't wait behind them.
+
+Run from the repository root, e.g.
+`python benchmarks/pipelining.py --mode cluster --processes 2`.
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import async_client
+import schema
+
+SERVER = """
+import sys
+sys.path.insert(0, {root!r})
+import async_server, cluster
+if {mode!r} == "async":
+    s = async_server.AsyncServer("127.0.0.1", {port})
+else:
+    s = cluster.Cluster("127.0.0.1", {port}, workers={processes})
+s.start()
+"""
+
+USERS = ["user{}".format(i) for i in range(64)]
+
+def percentile(latencies, share):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * share))]
+
+async def run(client, window, seconds):
+    """
+    Keeps window requests in flight for the given time. Returns the requests
+    answered and the latency of each, sorted
+    """
+    rng = random.Random(window)
+    latencies = []
+
+    async def one():
+        start = time.perf_counter()
+        await client.submit(schema.SendRequest(user_id=rng.choice(USERS), recipient_id=rng.choice(USERS), text="hello there"), "send")
+        latencies.append(time.perf_counter() - start)
+
+    async def sender(deadline):
+        while time.perf_counter() < deadline:
+            await one()
+
+    deadline = time.perf_counter() + seconds
+    tasks = [asyncio.ensure_future(sender(deadline)) for _ in range(window)]
+    while not all(task.done() for task in tasks):
+        await client.drain()
+        await asyncio.sleep(0.01)
+    await asyncio.gather(*tasks)
+    latencies.sort()
+    return len(latencies), latencies
+
+async def main(args):
+    client = await async_client.AsyncClient("127.0.0.1", args.port).connect()
+    await asyncio.gather(*[client.submit(schema.Request(user_id), "create") for user_id in USERS])
+    print("{:>10}{:>14}{:>12}{:>12}".format("in flight", "requests/s", "p50 us", "p99 us"))
+    for window in args.windows:
+        done, latencies = await run(client, window, args.seconds)
+        print("{:>10}{:>14.0f}{:>12.0f}{:>12.0f}".format(window, done / args.seconds, percentile(latencies, 0.5) * 1e6, percentile(latencies, 0.99) * 1e6))
+    await client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["async", "cluster"], default="async")
+    parser.add_argument("--processes", type=int, default=2, help="worker processes in cluster mode")
+    parser.add_argument("--windows", type=int, nargs="+", default=[1, 8, 64, 256], help="requests in flight to try")
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--port", type=int, default=65435)
+    args = parser.parse_args()
+
+    source = SERVER.format(root=ROOT, mode=args.mode, port=args.port, processes=args.processes)
+    proc = subprocess.Popen([sys.executable, "-c", source], stdout=subprocess.DEVNULL)
+    try:
+        time.sleep(1.5)
+        print("mode: {}{}".format(args.mode, " ({} processes)".format(args.processes) if args.mode == "cluster" else ""))
+        asyncio.run(main(args))
+    finally:
+        proc.terminate()
+        proc.wait()
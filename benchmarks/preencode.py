@@ -0,0 +1,89 @@
+"""
+Measures what delivering messages costs with and without pre-encoding. A
+200 character text is sent to every member of a group, and each member then
+drains their mailbox the way a version 1 client does, through
+handle_get_many and marshal_response_v1. The same is done for the gRPC
+server, where delivery is Subscribe serializing each message. Prints the
+time to send and the time for every member to receive, for groups of 10 to
+10000 members.
+
+Run from the repository root with `python benchmarks/preencode.py`.
+"""
+import argparse
+import importlib.util
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.append(os.path.join(ROOT, "part2")) # For schema_pb2, after the socket server's modules
+import coding
+import schema
+import schema_pb2
+import server
+
+# The gRPC server shares its module name with the socket server
+spec = importlib.util.spec_from_file_location("grpc_server", os.path.join(ROOT, "part2", "server.py"))
+grpc_server = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(grpc_server)
+
+TEXT = "x" * 200
+
+def run_socket(members, rounds, preencode):
+    """
+    Returns the seconds per group send and per drain of every mailbox
+    """
+    s = server.Server("127.0.0.1", 0, None, preencode=preencode)
+    user_ids = ["m{}".format(i) for i in range(members)]
+    for user_id in ["author"] + user_ids:
+        s.handle_create(schema.Request(user_id=user_id))
+        s.handle_join_group(schema.GroupRequest(user_id=user_id, group_id="all"))
+    requests = [schema.GetManyRequest(user_id=user_id, max_count=100, max_bytes=1 << 20) for user_id in user_ids]
+    send_time = 0
+    drain_time = 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        s.handle_send_group(schema.GroupSendRequest(user_id="author", group_id="all", text=TEXT))
+        send_time += time.perf_counter() - start
+        start = time.perf_counter()
+        for request in requests:
+            coding.marshal_response_v1(s.handle_get_many(request))
+        drain_time += time.perf_counter() - start
+    return send_time / rounds, drain_time / rounds
+
+def run_grpc(members, rounds, preencode):
+    """
+    Returns the seconds per SendGroup and per serialization of the message
+    for every member, as their Subscribe would
+    """
+    s = grpc_server.ChatHandlerServicer(None, preencode=preencode)
+    user_ids = ["m{}".format(i) for i in range(members)]
+    for user_id in ["author"] + user_ids:
+        s.Create(schema_pb2.Credentials(user_id=user_id), None)
+        s.JoinGroup(schema_pb2.GroupRequest(user_id=user_id, group_id="all"), None)
+    send_time = 0
+    drain_time = 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        s.SendGroup(schema_pb2.Message(author_id="author", recipient_id="all", text=TEXT), None)
+        send_time += time.perf_counter() - start
+        start = time.perf_counter()
+        for user_id in user_ids:
+            for msg in s.msgs_cache[user_id].take():
+                grpc_server.serialize_message(msg)
+        drain_time += time.perf_counter() - start
+    return send_time / rounds, drain_time / rounds
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    print("{:>8}{:>10}{:>14}{:>14}{:>14}{:>14}".format("server", "members", "send ms", "pre send ms", "drain ms", "pre drain ms"))
+    for target, run in [("socket", run_socket), ("grpc", run_grpc)]:
+        for members in args.members:
+            send, drain = run(members, args.rounds, preencode=False)
+            pre_send, pre_drain = run(members, args.rounds, preencode=True)
+            print("{:>8}{:>10}{:>14.3f}{:>14.3f}{:>14.3f}{:>14.3f}".format(target, members, send * 1e3, pre_send * 1e3, drain * 1e3, pre_drain * 1e3))
@@ -0,0 +1,104 @@
+"""
+Measures contention on the user registry: worker threads log their own
+users in and out as fast as they can while other threads keep listing every
+account, for a range of thread counts and shard counts. Prints the logins
+and lists per second and the 99.9th percentile and worst login latency of
+each combination.
+
+"legacy" reproduces the registry before it was sharded: one lock, held for
+the whole list scan, so every login waits for the scan in progress.
+
+Run from the repository root with `python benchmarks/user_contention.py`.
+NOTE: Python threads share one interpreter lock, so more threads can't add
+throughput here. What sharding removes is waiting on a lock whose holder is
+not running (e.g. a long list scan, or a thread descheduled mid-update).
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import schema
+import server
+
+class LegacyServer(server.Server):
+    """
+    A Server whose list holds the one user lock for the whole scan
+    """
+    def __init__(self, host, port, executor):
+        super().__init__(host, port, executor, user_shards=1)
+
+    def handle_list(self, request):
+        with self.users.lock(request.user_id):
+            shard = self.users.shards[0]
+            satisfying = filter(lambda user : request.wildcard in user.user_id, shard.accounts.values())
+            limited_to_page = list(satisfying)[request.page * self.ACCOUNT_PAGE_SIZE : (request.page + 1) * self.ACCOUNT_PAGE_SIZE]
+            return schema.ListResponse(user_id=request.user_id, success=True, error_message="", accounts=limited_to_page)
+
+def make_server(shards, users):
+    if shards == "legacy":
+        s = LegacyServer("127.0.0.1", 0, None)
+    else:
+        s = server.Server("127.0.0.1", 0, None, user_shards=int(shards))
+    for i in range(users):
+        s.handle_create(schema.Request(user_id="u{}".format(i)))
+        s.handle_logout(schema.Request(user_id="u{}".format(i)))
+    return s
+
+def run(shards, threads, listers, users, seconds):
+    """
+    Returns (logins per second, lists per second, p99.9 login latency in
+    microseconds, worst login latency in milliseconds)
+    """
+    s = make_server(shards, users)
+    stop = threading.Event()
+    latencies = [[] for _ in range(threads)]
+    lists = [0] * listers
+
+    def login_loop(index):
+        request = schema.Request(user_id="u{}".format(index))
+        samples = latencies[index]
+        while not stop.is_set():
+            start = time.perf_counter()
+            s.handle_login(request)
+            samples.append(time.perf_counter() - start)
+            s.handle_logout(request)
+
+    def list_loop(index):
+        request = schema.ListRequest(user_id="u0", wildcard="zzz") # Scans everything, matches nothing
+        while not stop.is_set():
+            s.handle_list(request)
+            lists[index] += 1
+
+    workers = [threading.Thread(target=login_loop, args=(i,)) for i in range(threads)]
+    workers += [threading.Thread(target=list_loop, args=(i,)) for i in range(listers)]
+    for worker in workers:
+        worker.start()
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+
+    samples = sorted(sample for thread_samples in latencies for sample in thread_samples)
+    if not samples:
+        return 0, sum(lists) / seconds, 0, 0
+    return len(samples) / seconds, sum(lists) / seconds, samples[int(len(samples) * 0.999)] * 1e6, samples[-1] * 1e3
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", nargs="+", default=["legacy", "1", "16"], help='shard counts to compare ("legacy" for the old single lock)')
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8], help="login thread counts to compare")
+    parser.add_argument("--listers", type=int, default=1, help="threads listing every account meanwhile")
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    print("{} users, {} listing thread(s)".format(args.users, args.listers))
+    print("{:>8}{:>9}{:>12}{:>9}{:>12}{:>9}".format("shards", "threads", "logins/s", "lists/s", "p99.9 us", "max ms"))
+    for shards in args.shards:
+        for threads in args.threads:
+            logins, lists, p999, worst = run(shards, threads, args.listers, args.users, args.seconds)
+            print("{:>8}{:>9}{:>12.0f}{:>9.0f}{:>12.0f}{:>9.1f}".format(shards, threads, logins, lists, p999, worst))
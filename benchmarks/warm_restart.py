@@ -0,0 +1,74 @@
+"""
+Measures how long a server takes to get its mailboxes back on restart, by
+replaying a message log from the start (as it had to before snapshots) and
+by loading a snapshot, for a range of queued message counts. Also times
+writing the snapshot, which a running server does in the background.
+
+Run from the repository root with `python benchmarks/warm_restart.py`.
+NOTE: The files go to the system's temporary directory unless --dir is given.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import mailboxes
+import message_log
+import schema
+
+def make_message(author_id, recipient_id, text_bytes):
+    return schema.Message(author_id=author_id, recipient_id=recipient_id, text=None, success=True, text_bytes=text_bytes)
+
+def write_log(path, users, messages):
+    """
+    Logs the creation of users and then messages sent round-robin between them
+    """
+    user_ids = ["u{}".format(i).encode() for i in range(users)]
+    with open(path, "wb") as f:
+        f.write(b"".join(message_log.encode_record(message_log.CREATE, user_id) for user_id in user_ids))
+        text = b"x" * 64
+        for start in range(0, messages, 100000):
+            f.write(b"".join(
+                message_log.encode_record(message_log.SEND, user_ids[i % users], user_ids[(i + 1) % users], text)
+                for i in range(start, min(messages, start + 100000))
+            ))
+
+def restore(path):
+    """
+    Opens the log and restores the mailboxes from it. Returns the seconds it
+    took, and the mailboxes and log.
+    """
+    start = time.perf_counter()
+    log = message_log.MessageLog(path)
+    boxes = mailboxes.Mailboxes()
+    boxes.restore(log.snapshot, log.recovered, make_message)
+    return time.perf_counter() - start, boxes, log
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--messages", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--dir", default=None, help="directory to put the files in")
+    args = parser.parse_args()
+
+    print("{:>10}{:>12}{:>12}{:>14}{:>12}".format("messages", "log MB", "replay s", "snapshot MB", "load s"))
+    for messages in args.messages:
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+            path = os.path.join(tmp, "chat.log")
+            write_log(path, args.users, messages)
+            log_size = os.path.getsize(path) / 1e6
+            replay, boxes, log = restore(path)
+            write_start = time.perf_counter()
+            log.checkpoint(boxes.contents())
+            write = time.perf_counter() - write_start
+            snapshot_size = os.path.getsize(log.snapshot_path) / 1e6
+            log.close()
+            del boxes, log
+            load, boxes, log = restore(path)
+            assert sum(len(boxes[user_id]) for user_id in boxes.mailboxes) == messages
+            log.close()
+            print("{:>10}{:>12.1f}{:>12.2f}{:>14.1f}{:>12.2f}".format(messages, log_size, replay, snapshot_size, load))
+            print("{:>10}writing the snapshot took {:.2f} s".format("", write))
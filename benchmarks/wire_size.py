@@ -0,0 +1,55 @@
+"""
+Compares how many bytes each request and response takes in the version 0
+(padded) and version 1 (varint) wire formats.
+
+Run from the repository root with `python benchmarks/wire_size.py`.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import coding
+import schema
+
+def request_cases():
+    """
+    Typical requests, labelled by op
+    """
+    return [
+        ("create", "create", schema.Request(user_id="ream")),
+        ("login", "login", schema.Request(user_id="ream")),
+        ("get (poll)", "get", schema.Request(user_id="ream")),
+        ("get_many (poll)", "get_many", schema.GetManyRequest(user_id="ream", max_count=256, max_bytes=262144)),
+        ("list", "list", schema.ListRequest(user_id="ream", wildcard="ma", page=0)),
+        ("send \"hi\"", "send", schema.SendRequest(user_id="ream", recipient_id="mark", text="hi")),
+        ("send 280 chars", "send", schema.SendRequest(user_id="ream", recipient_id="mark", text="x" * 280)),
+        ("send_batch x10", "send_batch", schema.BatchSendRequest(user_id="ream", messages=[schema.SendRequest(user_id="ream", recipient_id="mark", text="hi") for _ in range(10)])),
+    ]
+
+def response_cases():
+    """
+    Typical responses, with their version 0 marshaling function
+    """
+    messages = [schema.Message(author_id="mark", recipient_id="ream", text="hi", success=True) for _ in range(10)]
+    accounts = [schema.Account(user_id=name, is_logged_in=False) for name in ["ream", "mark", "joe", "chloe"]]
+    return [
+        ("basic ok", coding.marshal_response, schema.Response(user_id="ream", success=True, error_message="")),
+        ("basic error", coding.marshal_response, schema.Response(user_id="ream", success=False, error_message="User does not exist")),
+        ("get (empty)", coding.marshal_message_response, schema.Message(author_id="ream", recipient_id="ream", text="", success=False)),
+        ("get \"hi\"", coding.marshal_message_response, messages[0]),
+        ("get_many x10", coding.marshal_messages_response, schema.MessagesResponse(user_id="ream", success=True, error_message="", messages=messages)),
+        ("list x4", coding.marshal_list_response, schema.ListResponse(user_id="ream", success=True, error_message="", accounts=accounts)),
+        ("send_batch x10", coding.marshal_batch_response, schema.BatchResponse(user_id="ream", success=True, error_message="", statuses=[True] * 10)),
+    ]
+
+def print_row(label, v0, v1):
+    print("{:<20}{:>8}{:>8}{:>9.1f}%".format(label, v0, v1, 100 * v1 / v0))
+
+if __name__ == "__main__":
+    print("{:<20}{:>8}{:>8}{:>10}".format("request", "v0", "v1", "v1/v0"))
+    for label, op, req in request_cases():
+        print_row(label, len(coding.marshal_request(req, op)), len(coding.marshal_request(req, op, coding.VERSION_1)))
+    print()
+    print("{:<20}{:>8}{:>8}{:>10}".format("response", "v0", "v1", "v1/v0"))
+    for label, marshal, resp in response_cases():
+        print_row(label, len(marshal(resp)), len(coding.marshal_response_v1(resp)))
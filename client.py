@@ -1,9 +1,12 @@
 # echo-client.py
 
 import socket
+import threading
 import utils
 import schema
 import coding
+import framing
+import idle
 
 from concurrent import futures
 
@@ -12,6 +15,10 @@ import time
 
 HOST = input("Enter Server Host Address: ")  # The server's hostname or IP address
 PORT = 65432  # The port used by the server
+PROTOCOL_VERSION = coding.VERSION_1  # Wire format used for requests (the server answers in kind)
+COMPRESSION = True  # Offer to compress large frames when connecting
+WATCH_MAX_COUNT = 256  # Most messages pushed in a single response
+WATCH_MAX_BYTES = 256 * 1024  # Most message bytes pushed in a single response
 
 class Client:
     """
@@ -23,7 +30,12 @@ class Client:
         self.executor = executor
         self.isocket = None # Interactive socket, used for sending requests and receiving responses
         self.wsocket = None # Watch socket, used for watching for messages ONLY
+        self.idecoder = None # Reassembles response frames arriving on the isocket
+        self.wdecoder = None # Reassembles response frames arriving on the wsocket
+        self.icompressed = False # Whether the server agreed to compress frames on the isocket
+        self.wcompressed = False # Whether the server agreed to compress frames on the wsocket
         self.user_id = ""
+        self.send_lock = threading.Lock() # Heartbeats are sent from their own thread
 
     def is_logged_in(self):
         """
@@ -44,22 +56,75 @@ class Client:
             self.wsocket.close()
             self.wsocket = None
         self.user_id = ""
+
+    def connect(self):
+        """
+        Opens a new socket to the server and negotiates frame compression.
+        Returns the socket, its frame decoder and whether frames are compressed.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((self.host, self.port))
+        decoder = framing.FrameDecoder()
+        if not COMPRESSION:
+            return sock, decoder, False
+        sock.sendall(framing.frame(framing.hello()))
+        data = framing.recv_frame(sock, decoder)
+        if data is None or not framing.is_hello(data):
+            sock.close()
+            raise Exception("Error: Server closed connection")
+        return sock, decoder, len(framing.parse_hello(data)) > 0
+
+    def send_request(self, message):
+        """
+        Sends a marshaled request over the interactive socket and waits
+        for the (framed) response
+        """
+        with self.send_lock:
+            self.isocket.sendall(framing.frame(message, self.icompressed))
+        data = framing.recv_frame(self.isocket, self.idecoder)
+        if data is None:
+            raise Exception("Error: Server closed connection")
+        return coding.unmarshal_response(data)
     
     def watch_messages(self):
         """
         A function that will be run in a separate thread to watch for messages
         NOTE: Takes advantage of the ThreadPoolExecutor to run this function
+        NOTE: After the subscribe request the server pushes every new message
+        down this connection as soon as it is sent, so nothing is polled
         """
+        request = coding.marshal_request(schema.GetManyRequest(self.user_id, WATCH_MAX_COUNT, WATCH_MAX_BYTES), "subscribe", PROTOCOL_VERSION)
+        with self.send_lock:
+            self.wsocket.sendall(framing.frame(request, self.wcompressed))
         while True:
-            message = coding.marshal_get_request(schema.Request(self.user_id))
-            self.wsocket.sendall(message)
-            data = self.wsocket.recv(1024)
-            if not data:
+            data = framing.recv_frame(self.wsocket, self.wdecoder)
+            if data is None:
                 raise Exception("Server closed connection")
-            message = coding.unmarshal_response(data)
-            if message.success:
+            resp = coding.unmarshal_response(data)
+            if not resp.success and len(resp.error_message) > 0:
+                raise Exception(resp.error_message)
+            for message in resp.messages:
                 utils.print_msg_box(message)
-            time.sleep(1)
+
+    def send_heartbeats(self):
+        """
+        Sends a heartbeat down both sockets every HEARTBEAT_SECONDS, so that
+        the server doesn't take a user who is just reading (or typing) for
+        a client that went away
+        NOTE: Runs in a daemon thread of its own for as long as the client
+        runs. The server never answers heartbeats, so they can't get mixed
+        up with responses.
+        """
+        while True:
+            time.sleep(idle.HEARTBEAT_SECONDS)
+            with self.send_lock:
+                for sock in [self.isocket, self.wsocket]:
+                    if sock is None:
+                        continue
+                    try:
+                        sock.sendall(framing.frame(framing.HEARTBEAT))
+                    except OSError:
+                        pass # The next request finds out
 
     def subscribe(self):
         """
@@ -68,8 +133,7 @@ class Client:
         if not self.is_logged_in() or not self.executor or not self.isocket:
             utils.print_error("Error: Something has gone wrong. You may need to restart your client")
             return
-        self.wsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.wsocket.connect((self.host, self.port))
+        self.wsocket, self.wdecoder, self.wcompressed = self.connect()
         self.executor.submit(self.watch_messages)
 
     def handle_create(self):
@@ -92,12 +156,8 @@ class Client:
         if "," in username:
             utils.print_error("Error: username cannot contain commas")
             return
-        message = coding.marshal_create_request(schema.Request(username))
-        self.isocket.sendall(message)
-        data = self.isocket.recv(1024)
-        if not data:
-            raise Exception("Error: Server closed connection")
-        resp = coding.unmarshal_response(data)
+        message = coding.marshal_request(schema.Request(username), "create", PROTOCOL_VERSION)
+        resp = self.send_request(message)
 
         if not resp.success:
             utils.print_error("Error: {}".format(resp.error_message))
@@ -121,12 +181,8 @@ class Client:
         if len(username) <= 0:
             utils.print_error("Error: username cannot be empty")
             return
-        message = coding.marshal_login_request(schema.Request(username))
-        self.isocket.sendall(message)
-        data = self.isocket.recv(1024)
-        if not data:
-            raise Exception("Error: Server closed connection")
-        resp = coding.unmarshal_response(data)
+        message = coding.marshal_request(schema.Request(username), "login", PROTOCOL_VERSION)
+        resp = self.send_request(message)
         if not resp.success:
             utils.print_error("Error: {}".format(resp.error_message))
             return
@@ -145,12 +201,8 @@ class Client:
         if confirm != "y":
             utils.print_error("Aborting delete")
             return
-        message = coding.marshal_delete_request(schema.Request(self.user_id))
-        self.isocket.sendall(message)
-        data = self.isocket.recv(1024)
-        if not data:
-            raise Exception("Error: Server closed connection")
-        resp = coding.unmarshal_response(data)
+        message = coding.marshal_request(schema.Request(self.user_id), "delete", PROTOCOL_VERSION)
+        resp = self.send_request(message)
         if not resp.success:
             utils.print_error("Error: {}".format(resp.error_message))
             return
@@ -176,12 +228,8 @@ class Client:
         except:
             utils.print_error("Error: page must be an integer")
             return
-        message = coding.marshal_list_request(schema.ListRequest(user_id=self.user_id, wildcard=wildcard, page=page_int))
-        self.isocket.sendall(message)
-        data = self.isocket.recv(1024)
-        if not data:
-            raise Exception("Error: Server closed connection")
-        resp = coding.unmarshal_response(data)
+        message = coding.marshal_request(schema.ListRequest(user_id=self.user_id, wildcard=wildcard, page=page_int), "list", PROTOCOL_VERSION)
+        resp = self.send_request(message)
         if not resp.success:
             utils.print_error("Error: {}".format(resp.error_message))
             return
@@ -201,17 +249,79 @@ class Client:
         if len(text) > 280:
             utils.print_error("Error: Message cannot be longer than 280 characters")
             return
-        message = coding.marshal_send_request(schema.SendRequest(user_id=self.user_id, recipient_id=recipient, text=text))
-        self.isocket.sendall(message)
-        data = self.isocket.recv(1024)
-        if not data:
-            raise Exception("Error: Server closed connection")
-        resp = coding.unmarshal_response(data)
+        message = coding.marshal_request(schema.SendRequest(user_id=self.user_id, recipient_id=recipient, text=text), "send", PROTOCOL_VERSION)
+        resp = self.send_request(message)
         if not resp.success:
             utils.print_error("Error: {}".format(resp.error_message))
             return
         utils.print_success("Success! Message sent")
 
+    def handle_join(self):
+        """
+        Joins a group, creating it if nobody is in it yet
+        """
+        if not self.is_logged_in():
+            utils.print_error("Error: You must be logged in to join a group")
+            return
+        group = input("> Group id: ")
+        if len(group) <= 0 or len(group) > 8:
+            utils.print_error("Error: Group id must be 1 to 8 characters")
+            return
+        message = coding.marshal_request(schema.GroupRequest(user_id=self.user_id, group_id=group), "join_group", PROTOCOL_VERSION)
+        resp = self.send_request(message)
+        if not resp.success:
+            utils.print_error("Error: {}".format(resp.error_message))
+            return
+        utils.print_success("Success! Joined {}".format(group))
+
+    def handle_leave(self):
+        """
+        Leaves a group
+        """
+        if not self.is_logged_in():
+            utils.print_error("Error: You must be logged in to leave a group")
+            return
+        group = input("> Group id: ")
+        message = coding.marshal_request(schema.GroupRequest(user_id=self.user_id, group_id=group), "leave_group", PROTOCOL_VERSION)
+        resp = self.send_request(message)
+        if not resp.success:
+            utils.print_error("Error: {}".format(resp.error_message))
+            return
+        utils.print_success("Success! Left {}".format(group))
+
+    def handle_send_group(self):
+        """
+        Sends a message to every other member of a group
+        """
+        if not self.is_logged_in():
+            utils.print_error("Error: You must be logged in to send a message")
+            return
+        group = input("> Group id: ")
+        if len(group) <= 0:
+            utils.print_error("Error: Group id cannot be empty")
+            return
+        text = input("> What would you like to say?\n")
+        if len(text) > 280:
+            utils.print_error("Error: Message cannot be longer than 280 characters")
+            return
+        message = coding.marshal_request(schema.GroupSendRequest(user_id=self.user_id, group_id=group, text=text), "send_group", PROTOCOL_VERSION)
+        resp = self.send_request(message)
+        if not resp.success:
+            utils.print_error("Error: {}".format(resp.error_message))
+            return
+        utils.print_success("Success! Message sent to {}".format(group))
+
+    def handle_stats(self):
+        """
+        Prints the server's metrics
+        """
+        message = coding.marshal_request(schema.Request(user_id=self.user_id), "stats", PROTOCOL_VERSION)
+        resp = self.send_request(message)
+        if not resp.success:
+            utils.print_error("Error: {}".format(resp.error_message))
+            return
+        print(resp.text)
+
     def parse_input(self, input_str):
         if input_str == "create":
             return self.handle_create
@@ -223,6 +333,14 @@ class Client:
             return self.handle_list
         elif input_str == "send":
             return self.handle_send
+        elif input_str == "join":
+            return self.handle_join
+        elif input_str == "leave":
+            return self.handle_leave
+        elif input_str == "group":
+            return self.handle_send_group
+        elif input_str == "stats":
+            return self.handle_stats
         else:
             utils.print_error("Error: Invalid command")
         return None
@@ -241,8 +359,7 @@ class Client:
         multiplier = 1
         while True:
             try:
-                self.isocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.isocket.connect((self.host, self.port))
+                self.isocket, self.idecoder, self.icompressed = self.connect()
                 break
             except Exception:
                 utils.print_error("Error: Unable to connect socket to server.")
@@ -259,6 +376,7 @@ class Client:
         return True
 
     def start(self):
+        threading.Thread(target=self.send_heartbeats, daemon=True).start()
         self.reconnect(initial=True)
         while True:
             try:
@@ -0,0 +1,584 @@
+# A multi-process version of the socket server.
+#
+# Everything in a single Server shares one GIL, so extra threads never buy
+# more than one core. A cluster runs N worker processes instead, all
+# accepting connections on the same port (SO_REUSEPORT lets the kernel spread
+# new connections between them). Users are hash-partitioned between workers:
+# each worker's users, msgs_cache and user_events only hold the users it
+# owns. A request is handled by the worker that owns the user it is about
+# (see the route of each op in coding.OPS), so a worker that receives a
+# request for someone else's user forwards the frame, untouched, over a unix
+# socket to the owner and relays the reply back. list is gathered from every
+# worker and send_batch is split between the owners of its recipients. Each
+# worker only knows which of its own users are in a group, so send_group goes
+# to every worker, and each delivers to its own members.
+#
+# Replies to forwarded requests arrive later than local ones, so a connection
+# answers untagged requests strictly in order, and a slow forward holds up
+# every reply behind it. Tagged requests (see framing.py) are answered as
+# soon as their reply is ready instead.
+
+import asyncio
+import collections
+import functools
+import heapq
+import itertools
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import zlib
+
+import coding
+import framing
+import mailboxes
+import message_log
+import schema
+from async_server import AsyncServer, ChatProtocol, LISTEN_BACKLOG, raise_fd_limit
+from server import CODECS, Session
+
+PEER_CONNECT_SECONDS = 10 # How long a worker waits for the others to come up
+
+def owner_of(user_id, workers):
+    """
+    The index of the worker that owns a user. Python's own str hash is
+    randomized per process, so every worker has to agree on crc32 instead.
+    """
+    return zlib.crc32(user_id.encode()) % workers
+
+def reuseport_socket(host, port):
+    """
+    A listening socket that other worker processes can bind to as well
+    NOTE: asyncio only turns off Nagle's algorithm (TCP_NODELAY) for sockets
+    that say they are TCP, and replies are often written in several pieces
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise Exception("This platform does not support SO_REUSEPORT")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(LISTEN_BACKLOG)
+    sock.setblocking(False)
+    return sock
+
+async def read_frame(reader):
+    """
+    Reads one frame from a worker connection
+    """
+    header = await reader.readexactly(framing.FRAME_HEADER_LENGTH)
+    (length,) = framing.FRAME_HEADER.unpack(header)
+    return await reader.readexactly(length)
+
+class WorkerSession(Session):
+    """
+    The state of one connection to a worker
+    """
+    def __init__(self, trusted=False):
+        super().__init__(trusted=trusted)
+        self.upstream = None # (reader, writer) to the worker pushing this subscription, if another one owns the user
+
+class Peer:
+    """
+    A connection to another worker. Frames are forwarded as is and the
+    worker answers them in order, so replies are matched up first in,
+    first out.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+        self.waiting = collections.deque() # Futures for replies, in request order
+
+    async def connect(self):
+        """
+        Connects to the worker, retrying while it starts up
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + PEER_CONNECT_SECONDS
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path)
+                break
+            except OSError:
+                if loop.time() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+        asyncio.create_task(self.read_replies(reader))
+
+    async def read_replies(self, reader):
+        """
+        Hands every reply to the request waiting for it
+        """
+        try:
+            while True:
+                data = await read_frame(reader)
+                self.waiting.popleft().set_result(data)
+        except Exception:
+            self.writer = None
+            while self.waiting:
+                self.waiting.popleft().set_exception(Exception("Worker unavailable"))
+
+    def request(self, data):
+        """
+        Forwards a marshaled request. Returns a future for the marshaled reply.
+        """
+        future = asyncio.get_running_loop().create_future()
+        if self.writer is None:
+            future.set_exception(Exception("Worker unavailable"))
+            return future
+        self.waiting.append(future)
+        self.writer.write(framing.frame(data))
+        return future
+
+def after(commit, reply):
+    """
+    A future of a reply that is only ready once the log has been committed
+    """
+    future = commit.get_loop().create_future()
+    def done(commit):
+        if commit.exception() is not None:
+            future.set_exception(commit.exception())
+        else:
+            future.set_result(reply)
+    commit.add_done_callback(done)
+    return future
+
+class WorkerProtocol(ChatProtocol):
+    """
+    A connection to a worker. Replies to forwarded requests arrive later
+    than local ones, so replies are queued and written strictly in the
+    order the requests came in, except for those to tagged requests, which
+    are written as soon as they are ready.
+    """
+    def __init__(self, server, trusted=False):
+        super().__init__(server)
+        self.session = WorkerSession(trusted=trusted)
+        self.outbox = collections.deque() # Replies (bytes) or futures of them
+        self.waiting_on = None
+
+    def buffer_updated(self, nbytes):
+        self.decoder.buffer_updated(nbytes)
+        self.server.touch(self.session)
+        try:
+            replies = []
+            tagged = [] # (request_id, reply or future of it)
+            for data in self.decoder.frames():
+                if framing.is_tagged(data):
+                    try:
+                        request_id, data = framing.untag(data)
+                    except Exception as e:
+                        print("Error:", e.args[0])
+                        continue # Too short to answer, so only this frame is dropped
+                    reply = self.server.route_frame(data, self.session)
+                    tagged.append((request_id, reply if reply is not None else self.server.invalid_reply()))
+                    continue
+                reply = self.server.route_frame(data, self.session)
+                if reply is not None:
+                    replies.append(reply)
+        except Exception as e:
+            print("Error:", e.args[0])
+            self.transport.close()
+            return
+        commit = self.server.log_barrier()
+        if commit is not None:
+            # Local replies wait for the log (the owners of forwarded requests already did)
+            replies = [reply if isinstance(reply, asyncio.Future) else after(commit, reply) for reply in replies]
+            tagged = [(request_id, reply if isinstance(reply, asyncio.Future) else after(commit, reply)) for request_id, reply in tagged]
+        self.outbox.extend(replies)
+        self.flush()
+        self.answer(tagged)
+
+    def flush(self, _=None):
+        """
+        Writes every reply that is ready, up to the first one still pending
+        """
+        ready = []
+        while self.outbox:
+            head = self.outbox[0]
+            if isinstance(head, asyncio.Future):
+                if not head.done():
+                    if head is not self.waiting_on:
+                        self.waiting_on = head
+                        head.add_done_callback(self.flush)
+                    break
+                if head.exception() is not None:
+                    print("Error:", head.exception())
+                    self.transport.close()
+                    return
+                head = head.result()
+            self.outbox.popleft()
+            ready.append(head)
+        if ready and not self.transport.is_closing():
+            self.write(framing.frame_all(ready, self.session.compressed))
+        self.watch()
+
+    def answer(self, tagged):
+        """
+        Writes the replies to tagged requests that are ready, and each of the
+        others once it is
+        """
+        ready = []
+        for request_id, reply in tagged:
+            if isinstance(reply, asyncio.Future):
+                reply.add_done_callback(functools.partial(self.answer_later, request_id))
+            else:
+                ready.append(framing.tag(request_id, reply))
+        if ready and not self.transport.is_closing():
+            self.write(framing.frame_all(ready, self.session.compressed))
+        self.watch()
+
+    def answer_later(self, request_id, future):
+        if future.exception() is not None:
+            print("Error:", future.exception())
+            self.transport.close()
+            return
+        self.answer([(request_id, future.result())])
+
+    def write_replies(self, replies):
+        """
+        Queues pushed messages behind any reply still pending
+        """
+        self.outbox.extend(replies)
+        self.flush()
+
+    def watch(self):
+        """
+        Starts pushing messages once the connection has subscribed. If another
+        worker owns the user, that worker does the pushing and they are relayed.
+        """
+        if self.watching or self.session.subscription is None:
+            return
+        if self.session.upstream is None:
+            return super().watch()
+        self.watching = True
+        asyncio.ensure_future(self.relay(self.session.upstream[0]))
+
+    async def relay(self, reader):
+        """
+        Passes on the messages pushed by the worker owning the subscribed user
+        """
+        try:
+            while True:
+                self.write_replies([await read_frame(reader)])
+        except (asyncio.IncompleteReadError, OSError):
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        if self.session.upstream is not None:
+            self.session.upstream[1].close()
+        super().connection_lost(exc)
+
+class WorkerServer(AsyncServer):
+    """
+    One worker of a cluster, owning the users that hash to its index
+    """
+    def __init__(self, host, port, index, workers, socket_dir, codec=coding, compression=True, mailbox_capacity=None, overflow=mailboxes.REJECT, log_path=None, fsync=message_log.ALWAYS, checkpoint_interval=mailboxes.DEFAULT_CHECKPOINT_INTERVAL, metrics_port=None, idle_timeout=None, preencode=False):
+        super().__init__(host, port, codec=codec, compression=compression, mailbox_capacity=mailbox_capacity, overflow=overflow, log_path=log_path, fsync=fsync, checkpoint_interval=checkpoint_interval, metrics_port=metrics_port, idle_timeout=idle_timeout, preencode=preencode)
+        self.index = index
+        self.workers = workers
+        self.socket_dir = socket_dir
+        self.peers = {}
+
+    def socket_path(self, index):
+        return os.path.join(self.socket_dir, "worker{}.sock".format(index))
+
+    def owner(self, user_id):
+        return owner_of(user_id, self.workers)
+
+    async def serve(self):
+        """
+        Listens for clients and for the other workers, connects to every
+        other worker and then serves until cancelled
+        NOTE: With port 0 the OS picks a free port, which is then stored in self.port
+        """
+        loop = asyncio.get_running_loop()
+        sock = reuseport_socket(self.host, self.port)
+        self.port = sock.getsockname()[1]
+        server = await loop.create_server(lambda: WorkerProtocol(self), sock=sock)
+        peer_server = await loop.create_unix_server(lambda: WorkerProtocol(self, trusted=True), path=self.socket_path(self.index))
+        for index in range(self.workers):
+            if index != self.index:
+                self.peers[index] = Peer(self.socket_path(index))
+                await self.peers[index].connect()
+        self.start_reaping()
+        async with server, peer_server:
+            await server.serve_forever()
+
+    def error_reply(self, user_id, error_message, version, op):
+        """
+        A failed response of the type op answers with, for when a worker can't be reached
+        """
+        response = coding.OPS_BY_NAME[op].response
+        if response == "list":
+            resp = schema.ListResponse(user_id=user_id, success=False, error_message=error_message, accounts=[])
+        elif response == "batch":
+            resp = schema.BatchResponse(user_id=user_id, success=False, error_message=error_message, statuses=[])
+        elif response == "messages":
+            resp = schema.MessagesResponse(user_id=user_id, success=False, error_message=error_message, messages=[])
+        elif response == "message":
+            resp = schema.Message(author_id=user_id, recipient_id=user_id, text="", success=False)
+        else:
+            resp = schema.Response(user_id=user_id, success=False, error_message=error_message)
+        return self.marshal_response(resp, op, version)
+
+    def route_frame(self, data, session):
+        """
+        Handles a frame here if this worker owns what it is about, otherwise
+        sends it to the right worker(s). Returns the marshaled reply, a future
+        of it, or None if the frame was not a valid request.
+        """
+        if session.trusted or framing.is_hello(data) or framing.is_heartbeat(data):
+            return self.handle_frame(data, session)
+        try:
+            version = chr(data[0])
+            request, op = self.codec.view_request(data)
+            route = coding.OPS_BY_NAME[op].route
+            if coding.OPS_BY_NAME[op].internal:
+                raise Exception("Internal op")
+        except:
+            return self.handle_frame(data, session) # Reports the invalid request
+        if route == "all":
+            return asyncio.ensure_future(self.gather_list(request, version))
+        if route == "recipients":
+            return asyncio.ensure_future(self.split_batch(request, version))
+        if route == "members":
+            # The frame is only valid until the next recv, so work on a copy
+            data = bytes(data)
+            request, _ = self.codec.view_request(data)
+            return asyncio.ensure_future(self.send_group(data, request, version))
+        if route == "local":
+            return self.respond(request, op, version, session)
+        owner = self.owner(getattr(request, route))
+        if owner == self.index:
+            return self.respond(request, op, version, session)
+        if op == "subscribe":
+            return asyncio.ensure_future(self.subscribe_remote(owner, bytes(data), request, version, session))
+        # The frame is only valid until the next recv, so forward a copy
+        return asyncio.ensure_future(self.forward(owner, bytes(data), request, op, version, session))
+
+    async def forward(self, owner, data, request, op, version, session):
+        """
+        Relays a request to the worker that owns it and returns its reply
+        """
+        try:
+            reply = await self.peers[owner].request(data)
+        except Exception as e:
+            return self.error_reply(request.user_id, str(e), version, op)
+        if (op == "create" or op == "login") and coding.unmarshal_response(reply).success:
+            session.user_id = request.user_id
+        return reply
+
+    async def subscribe_remote(self, owner, data, request, version, session):
+        """
+        Subscribes on the worker that owns the user. This takes a connection of
+        its own, since that worker keeps pushing messages down it.
+        """
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.socket_path(owner))
+            writer.write(framing.frame(data))
+            reply = await read_frame(reader)
+        except (asyncio.IncompleteReadError, OSError):
+            return self.error_reply(request.user_id, "Worker unavailable", version, "subscribe")
+        if coding.unmarshal_response(reply).success:
+            session.subscription = (request, version)
+            session.upstream = (reader, writer)
+        else:
+            writer.close()
+        return reply
+
+    async def call(self, owner, request, op):
+        """
+        Runs a request on any worker (including this one) and returns its
+        response, decoded
+        """
+        if owner == self.index:
+            return self.handle_request_with_op(request, op)
+        reply = await self.peers[owner].request(coding.marshal_request(request, op, coding.VERSION_1))
+        return coding.unmarshal_response(reply)
+
+    async def gather_list(self, request, version):
+        """
+        Lists the matching accounts of every worker up to the end of the page,
+        merges them into user_id order and then pages them
+        NOTE: Timed as a list, while each worker times its own list_all
+        """
+        start = time.perf_counter()
+        query = schema.ListRequest(user_id=request.user_id, wildcard=request.wildcard, page=request.page)
+        try:
+            parts = await asyncio.gather(*[self.call(index, query, "list_all") for index in range(self.workers)])
+        except Exception as e:
+            self.metrics.observe("list", time.perf_counter() - start, False)
+            return self.error_reply(request.user_id, str(e), version, "list")
+        sorted_parts = []
+        for part in parts:
+            # Responses from other workers only carry the user_ids
+            sorted_parts.append([schema.Account(user_id=account, is_logged_in=False) if isinstance(account, str) else account for account in part.accounts])
+        accounts = heapq.merge(*sorted_parts, key=lambda account : account.user_id)
+        page = list(itertools.islice(accounts, request.page * self.ACCOUNT_PAGE_SIZE, (request.page + 1) * self.ACCOUNT_PAGE_SIZE))
+        resp = schema.ListResponse(user_id=request.user_id, success=True, error_message="", accounts=page)
+        out = self.marshal_response(resp, "list", version)
+        self.metrics.observe("list", time.perf_counter() - start, True)
+        return out
+
+    async def split_batch(self, request, version):
+        """
+        Sends each part of a batch to the worker owning its recipients and
+        puts the statuses back together in the original order
+        NOTE: Timed as a send_batch, while each worker times its own part
+        """
+        start = time.perf_counter()
+        by_owner = {}
+        for i, msg in enumerate(request.messages):
+            by_owner.setdefault(self.owner(msg.recipient_id), []).append(i)
+        statuses = [False] * len(request.messages)
+
+        async def send_part(owner, indices):
+            part = schema.BatchSendRequest(request.user_id, [request.messages[i] for i in indices])
+            try:
+                resp = await self.call(owner, part, "send_batch")
+            except Exception:
+                return # Leave these as failed
+            for i, status in zip(indices, resp.statuses):
+                statuses[i] = status
+
+        await asyncio.gather(*[send_part(owner, indices) for owner, indices in by_owner.items()])
+        if all(statuses):
+            resp = schema.BatchResponse(user_id=request.user_id, success=True, error_message="", statuses=statuses)
+        else:
+            resp = schema.BatchResponse(user_id=request.user_id, success=False, error_message="Some recipients do not exist", statuses=statuses)
+        out = self.marshal_response(resp, "send_batch", version)
+        self.metrics.observe("send_batch", time.perf_counter() - start, resp.success)
+        return out
+
+    async def send_group(self, data, request, version):
+        """
+        Has every worker deliver a group message to its own members of the
+        group, forwarding the frame as is, and combines their replies: the
+        send fails if no worker knows the group, or if any part of it failed
+        NOTE: Timed as a send_group, while each other worker times its own part
+        """
+        start = time.perf_counter()
+
+        async def send_part(index):
+            if index == self.index:
+                return self.handle_request_with_op(request, "send_group")
+            try:
+                return coding.unmarshal_response(await self.peers[index].request(data))
+            except Exception as e:
+                return schema.Response(user_id=request.user_id, success=False, error_message=str(e))
+
+        parts = await asyncio.gather(*[send_part(index) for index in range(self.workers)])
+        failed = [part for part in parts if not part.success and part.error_message != "Group does not exist"]
+        if failed:
+            resp = schema.Response(user_id=request.user_id, success=False, error_message=failed[0].error_message)
+        elif any(part.success for part in parts):
+            resp = schema.Response(user_id=request.user_id, success=True, error_message="")
+        else:
+            resp = schema.Response(user_id=request.user_id, success=False, error_message="Group does not exist")
+        out = self.marshal_response(resp, "send_group", version)
+        self.metrics.observe("send_group", time.perf_counter() - start, resp.success)
+        return out
+
+    def end_session(self, session):
+        """
+        Logs out the user whose connection closed, on whichever worker owns them
+        NOTE: A connection from another worker carries requests for many users,
+        so closing it logs nobody out
+        """
+        if session.trusted or len(session.user_id) == 0:
+            return
+        owner = self.owner(session.user_id)
+        if owner == self.index:
+            super().end_session(session)
+        else:
+            self.peers[owner].request(coding.marshal_request(schema.Request(session.user_id), "logout", coding.VERSION_1)).add_done_callback(logged_out)
+
+def logged_out(future):
+    """
+    Reports a forwarded logout that never reached the user's owner, which
+    leaves the user logged in there
+    """
+    if future.exception() is not None:
+        print("Error:", future.exception())
+
+def run_worker(host, port, index, workers, socket_dir, codec, compression, mailbox_capacity, overflow, log_path, fsync, checkpoint_interval, metrics_port, idle_timeout, preencode):
+    """
+    The entry point of each worker process
+    """
+    raise_fd_limit()
+    server = WorkerServer(host, port, index, workers, socket_dir, codec=CODECS[codec], compression=compression, mailbox_capacity=mailbox_capacity, overflow=overflow, log_path=log_path, fsync=fsync, checkpoint_interval=checkpoint_interval, metrics_port=metrics_port, idle_timeout=idle_timeout, preencode=preencode)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+
+class Cluster:
+    """
+    Starts and supervises the worker processes of a multi-process server
+    NOTE: With a log_path, each worker logs the users it owns to its own file
+    (log_path followed by its index), so a cluster has to be restarted with
+    the same number of workers to find them again. Likewise, each worker
+    keeps its own metrics, and serves them on metrics_port plus its index.
+    NOTE: codec is the name of a codec in server.CODECS rather than the
+    module itself, since modules can't be pickled, and workers started with
+    the spawn start method (the default on macOS) get their arguments pickled
+    """
+    def __init__(self, host, port, workers=None, codec="string", compression=True, mailbox_capacity=None, overflow=mailboxes.REJECT, log_path=None, fsync=message_log.ALWAYS, checkpoint_interval=mailboxes.DEFAULT_CHECKPOINT_INTERVAL, metrics_port=None, idle_timeout=None, preencode=False):
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.codec = codec
+        self.compression = compression
+        self.mailbox_capacity = mailbox_capacity
+        self.overflow = overflow
+        self.log_path = log_path
+        self.fsync = fsync
+        self.checkpoint_interval = checkpoint_interval
+        self.metrics_port = metrics_port
+        self.idle_timeout = idle_timeout
+        self.preencode = preencode
+        self.socket_dir = None
+        self.processes = []
+
+    def launch(self):
+        """
+        Starts every worker process without waiting for them
+        """
+        self.socket_dir = tempfile.mkdtemp(prefix="chat-cluster-")
+        for index in range(self.workers):
+            log_path = None if self.log_path is None else "{}.{}".format(self.log_path, index)
+            metrics_port = None if self.metrics_port is None else self.metrics_port + index
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(self.host, self.port, index, self.workers, self.socket_dir, self.codec, self.compression, self.mailbox_capacity, self.overflow, log_path, self.fsync, self.checkpoint_interval, metrics_port, self.idle_timeout, self.preencode),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+
+    def start(self):
+        """
+        Starts every worker and serves until they exit (or until interrupted)
+        NOTE: SIGTERM is turned into an exit so that the workers are stopped too
+        """
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.launch()
+        try:
+            for process in self.processes:
+                process.join()
+        finally:
+            self.stop()
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        if self.socket_dir is not None:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+            self.socket_dir = None
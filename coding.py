@@ -1,27 +1,98 @@
-from schema import Message, Request, ListRequest, SendRequest, Response, ListResponse
+from schema import Message, Request, ListRequest, SendRequest, GetManyRequest, BatchSendRequest, GroupRequest, GroupSendRequest, Response, ListResponse, BatchResponse, MessagesResponse, StatsResponse
 
 VERSION = "0"
 
 ERROR_MESSAGE_LENGTH = 64
 MAX_MESSAGE_LENGTH = 280
+# Size of one [ user_id, text ] entry in a batch or multi-message response
+MESSAGE_ENTRY_LENGTH = 8 + MAX_MESSAGE_LENGTH
 
-OP_TO_CODE_MAP = {
-    "create": "1",
-    "login": "2",
-    "delete": "3",
-    "get": "4",
-    "send": "5",
-    "list": "6",
-}
+# Field kinds. In version 0 strings and numbers are padded to their length,
+# and entries are a count (padded to its length) followed by that many
+# [ recipient_id - 8 bytes, text - 280 bytes ] entries.
+STRING = "string"
+NUMBER = "number"
+ENTRIES = "entries"
 
-CODE_TO_OP_MAP = {
-    "1": "create",
-    "2": "login",
-    "3": "delete",
-    "4": "get",
-    "5": "send",
-    "6": "list",
-}
+class Field:
+    """
+    One field of a request, following the common [ version, user_id, op_code ] header
+    """
+    def __init__(self, name, kind, length):
+        self.name = name
+        self.kind = kind
+        self.length = length
+
+class Op:
+    """
+    Everything that defines an op: its op_code, the fields that follow the
+    header, the Request class they are decoded into, the name of the Server
+    method that handles it and the type of response it answers with.
+    NOTE: Requests for lazy ops are wrapped in a RequestView rather than
+    decoded up front
+    NOTE: route says which worker of a cluster (see cluster.py) handles the op:
+    the owner of the named field ("user_id" or "recipient_id"), "local" for
+    whichever worker received it, "all" to gather from every worker,
+    "recipients" to split a batch between the owners of its recipients and
+    "members" to have every worker deliver to its own members of a group.
+    Internal ops are only accepted from other workers.
+    """
+    def __init__(self, name, code, request_class, fields, handler, response, lazy=False, route="user_id", internal=False):
+        self.name = name
+        self.code = code
+        self.request_class = request_class
+        self.fields = fields
+        self.handler = handler
+        self.response = response
+        self.lazy = lazy
+        self.route = route
+        self.internal = internal
+        # Version 0 offsets of every field (in characters, so bytes for ASCII)
+        self.offsets = {}
+        offset = 10
+        for field in fields:
+            self.offsets[field.name] = (offset, offset + field.length)
+            offset += field.length
+
+# Every op the server understands. Adding an op means adding an entry here
+# (and its handler to the Server), everything else is derived from it.
+OPS = [
+    Op("create", "1", Request, [], "handle_create", "basic"),
+    Op("login", "2", Request, [], "handle_login", "basic"),
+    Op("delete", "3", Request, [], "handle_delete", "basic"),
+    Op("get", "4", Request, [], "handle_get_messages", "message"),
+    Op("send", "5", SendRequest, [Field("recipient_id", STRING, 8), Field("text", STRING, MAX_MESSAGE_LENGTH)], "handle_send", "basic", lazy=True, route="recipient_id"),
+    Op("list", "6", ListRequest, [Field("wildcard", STRING, 8), Field("page", NUMBER, 8)], "handle_list", "list", route="all"),
+    Op("send_batch", "7", BatchSendRequest, [Field("messages", ENTRIES, 8)], "handle_send_batch", "batch", route="recipients"),
+    Op("get_many", "8", GetManyRequest, [Field("max_count", NUMBER, 8), Field("max_bytes", NUMBER, 8)], "handle_get_many", "messages"),
+    Op("health", "9", Request, [], "handle_health", "basic", route="local"),
+    Op("logout", "0", Request, [], "handle_logout", "basic"),
+    Op("list_all", "A", ListRequest, [Field("wildcard", STRING, 8), Field("page", NUMBER, 8)], "handle_list_all", "list", route="local", internal=True),
+    Op("subscribe", "B", GetManyRequest, [Field("max_count", NUMBER, 8), Field("max_bytes", NUMBER, 8)], "handle_subscribe", "messages"),
+    Op("stats", "C", Request, [], "handle_stats", "stats", route="local"),
+    Op("join_group", "D", GroupRequest, [Field("group_id", STRING, 8)], "handle_join_group", "basic"),
+    Op("leave_group", "E", GroupRequest, [Field("group_id", STRING, 8)], "handle_leave_group", "basic"),
+    Op("send_group", "F", GroupSendRequest, [Field("group_id", STRING, 8), Field("text", STRING, MAX_MESSAGE_LENGTH)], "handle_send_group", "basic", lazy=True, route="members"),
+]
+
+OPS_BY_NAME = {op.name: op for op in OPS}
+OPS_BY_CODE = {op.code: op for op in OPS}
+# Indexed by the op_code byte itself, so finding an op is one list lookup
+OPS_BY_BYTE = [None] * 256
+for op in OPS:
+    OPS_BY_BYTE[ord(op.code)] = op
+
+OP_TO_CODE_MAP = {op.name: op.code for op in OPS}
+CODE_TO_OP_MAP = {op.code: op.name for op in OPS}
+
+def find_op(op_byte):
+    """
+    Looks up the Op for an op_code byte
+    """
+    op = OPS_BY_BYTE[op_byte]
+    if op is None:
+        raise Exception("Unknown op code: {}".format(chr(op_byte)))
+    return op
 
 def pad_to_length(s, length):
     """
@@ -32,6 +103,15 @@ def pad_to_length(s, length):
         return s[:length]
     return s + (length - len(s)) * "\0"
 
+def pad_bytes_to_length(b, length):
+    """
+    Pads already encoded text to a given length in characters, exactly
+    like pad_to_length followed by encode() would
+    """
+    if b.isascii():
+        return b[:length].ljust(length, b"\0")
+    return pad_to_length(str(b, "utf-8"), length).encode()
+
 def unpad(s):
     """
     Removes padding from a string
@@ -54,121 +134,259 @@ def post_accounts(str):
     
     return str.split(",")
 
+def marshal_op_request(req: Request, op: Op):
+    """
+    Marshals a Request for any op into a byte string, following the op's fields
+    """
+    parts = [VERSION, pad_to_length(req.user_id, 8), op.code]
+    for field in op.fields:
+        value = getattr(req, field.name)
+        if field.kind == STRING:
+            parts.append(pad_to_length(value, field.length))
+        elif field.kind == NUMBER:
+            parts.append(pad_to_length(str(value), field.length))
+        else:
+            parts.append(pad_to_length(str(len(value)), field.length))
+            for msg in value:
+                parts.append(pad_to_length(msg.recipient_id, 8))
+                parts.append(pad_to_length(msg.text, MAX_MESSAGE_LENGTH))
+    return "".join(parts).encode()
+
 def marshal_create_request(req: Request):
     """
     Marshals a create Request into a byte string
     """
-    return "{}{}{}".format(
-        VERSION,
-        pad_to_length(req.user_id, 8),
-        OP_TO_CODE_MAP["create"],
-    ).encode()
+    return marshal_op_request(req, OPS_BY_NAME["create"])
 
 def marshal_login_request(req: Request):
     """
     Marshals a login Request into a byte string
     """
-    return "{}{}{}".format(
-        VERSION,
-        pad_to_length(req.user_id, 8),
-        OP_TO_CODE_MAP["login"],
-    ).encode()
+    return marshal_op_request(req, OPS_BY_NAME["login"])
 
 def marshal_delete_request(req: Request):
     """
     Marshals a delete Request into a byte string
     """
-    return "{}{}{}".format(
-        VERSION,
-        pad_to_length(req.user_id, 8),
-        OP_TO_CODE_MAP["delete"],
-    ).encode()
+    return marshal_op_request(req, OPS_BY_NAME["delete"])
 
 def marshal_list_request(req: ListRequest):
     """
     Marshals a list Request into a byte string
     """
-    return "{}{}{}{}{}".format(
-        VERSION,
-        pad_to_length(req.user_id, 8),
-        OP_TO_CODE_MAP["list"],
-        pad_to_length(req.wildcard, 8),
-        pad_to_length(str(req.page), 8),
-    ).encode()
+    return marshal_op_request(req, OPS_BY_NAME["list"])
 
-def marshal_subscribe_request(req: Request):
+def marshal_get_request(req: Request):
     """
-    Marshals a subscribe Request into a byte string
+    Marshals a get Request into a byte string
     """
-    return "{}{}{}".format(
-        VERSION,
-        pad_to_length(req.user_id, 8),
-        OP_TO_CODE_MAP["subscribe"],
-    ).encode()
+    return marshal_op_request(req, OPS_BY_NAME["get"])
 
-def marshal_get_request(req: Request):
+def marshal_get_many_request(req: GetManyRequest):
     """
-    Marshals a subscribe Request into a byte string
+    Marshals a get_many Request into a byte string
     """
-    return "{}{}{}".format(
-        VERSION,
-        pad_to_length(req.user_id, 8),
-        OP_TO_CODE_MAP["get"],
-    ).encode()
+    return marshal_op_request(req, OPS_BY_NAME["get_many"])
 
 def marshal_send_request(req: SendRequest):
     """
     Marshals a send Request into a byte string
     """
-    return "{}{}{}{}{}".format(
-        VERSION,
-        pad_to_length(req.user_id, 8),
-        OP_TO_CODE_MAP["send"],
-        pad_to_length(req.recipient_id, 8),
-        pad_to_length(req.text, MAX_MESSAGE_LENGTH),
-    ).encode()
+    return marshal_op_request(req, OPS_BY_NAME["send"])
+
+def marshal_batch_send_request(req: BatchSendRequest):
+    """
+    Marshals a batch of send Requests into a byte string
+    """
+    return marshal_op_request(req, OPS_BY_NAME["send_batch"])
+
+def marshal_health_request(req: Request):
+    """
+    Marshals a health Request into a byte string
+    """
+    return marshal_op_request(req, OPS_BY_NAME["health"])
+
+def marshal_logout_request(req: Request):
+    """
+    Marshals a logout Request into a byte string
+    """
+    return marshal_op_request(req, OPS_BY_NAME["logout"])
+
+def marshal_subscribe_request(req: GetManyRequest):
+    """
+    Marshals a subscribe GetManyRequest into a byte string
+    """
+    return marshal_op_request(req, OPS_BY_NAME["subscribe"])
+
+def marshal_stats_request(req: Request):
+    """
+    Marshals a stats Request into a byte string
+    """
+    return marshal_op_request(req, OPS_BY_NAME["stats"])
+
+def marshal_join_group_request(req: GroupRequest):
+    """
+    Marshals a join_group GroupRequest into a byte string
+    """
+    return marshal_op_request(req, OPS_BY_NAME["join_group"])
+
+def marshal_leave_group_request(req: GroupRequest):
+    """
+    Marshals a leave_group GroupRequest into a byte string
+    """
+    return marshal_op_request(req, OPS_BY_NAME["leave_group"])
+
+def marshal_send_group_request(req: GroupSendRequest):
+    """
+    Marshals a send_group GroupSendRequest into a byte string
+    """
+    return marshal_op_request(req, OPS_BY_NAME["send_group"])
 
 def unmarshal_request(data: bytes):
     """
     Unmarshals a byte string into a Request
     """
-    data = data.decode()
-    version = data[0]
+    if data[0] == VERSION_1_BYTE[0]:
+        return unmarshal_request_v1(data)
+    data = str(data, "utf-8")
     user_id = unpad(data[1:9])
-    op_code = data[9]
-    op = CODE_TO_OP_MAP[op_code]
-    if op == "create":
-        return Request(user_id), op
-    elif op == "login":
-        return Request(user_id), op
-    elif op == "delete":
-        return Request(user_id), op
-    elif op == "list":
-        wildcard = unpad(data[10:18])
-        page = unpad(data[18:26])
-        page_num = int(page)
-        return ListRequest(user_id, wildcard, page_num), op
-    elif op == "get":
-        return Request(user_id), op
-    elif op == "send":
-        recipient_id = unpad(data[10:18])
-        text = unpad(data[18:18+MAX_MESSAGE_LENGTH])
-        return SendRequest(user_id, recipient_id=recipient_id, text=text), op
-    else:
-        raise Exception("Unknown op code: {}".format(op_code))
-    
+    op = find_op(ord(data[9]))
+    values = {}
+    offset = 10
+    for field in op.fields:
+        raw = unpad(data[offset:offset+field.length])
+        offset += field.length
+        if field.kind == STRING:
+            values[field.name] = raw
+        elif field.kind == NUMBER:
+            values[field.name] = int(raw)
+        else:
+            count = int(raw)
+            if offset + count * MESSAGE_ENTRY_LENGTH > len(data):
+                raise Exception("Truncated batch") # More entries than the frame holds
+            messages = []
+            for _ in range(count):
+                recipient_id = unpad(data[offset:offset+8])
+                text = unpad(data[offset+8:offset+MESSAGE_ENTRY_LENGTH])
+                messages.append(SendRequest(user_id, recipient_id=recipient_id, text=text))
+                offset += MESSAGE_ENTRY_LENGTH
+            values[field.name] = messages
+    return op.request_class(user_id, **values), op.name
+
+class RequestView:
+    """
+    A lazily decoded request. Wraps the received bytes (usually a memoryview
+    into the connection's receive buffer) and decodes each field only the
+    first time it is read, so routing a request on its op and user_id never
+    touches the rest of it. Decoded fields are cached on the instance.
+    NOTE: A view is only valid for as long as the buffer it wraps
+    """
+    def __init__(self, data, user_id, op):
+        self.data = data
+        self.user_id = user_id
+        self.op = op
+
+    def materialize(self):
+        """
+        Eagerly unmarshals the whole request. Needed when a field is not ASCII,
+        since the fixed-width fields then no longer line up with bytes.
+        """
+        if "request" not in self.__dict__:
+            self.request = unmarshal_request(bytes(self.data))[0]
+        return self.request
+
+    def field(self, name, start, end):
+        """
+        Decodes the fixed-width ASCII field at data[start:end]
+        """
+        try:
+            return unpad(str(self.data[start:end], "ascii"))
+        except UnicodeDecodeError:
+            return getattr(self.materialize(), name)
+
+    def __getattr__(self, name):
+        """
+        Only called for fields that have not been decoded yet. A text field
+        is the last one, so it can be read through to the end of the data.
+        """
+        offsets = OPS_BY_NAME[self.op].offsets
+        if name == "text_bytes" and "text" in offsets:
+            # The encoded text without its padding. ASCII text is passed on
+            # as is, anything else goes through the (truncating) decoder
+            value = bytes(self.data[offsets["text"][0]:]).strip(b"\0")
+            if len(value) > MAX_MESSAGE_LENGTH or not value.isascii():
+                value = self.text.encode()
+        elif name == "text" and "text" in offsets:
+            start = offsets["text"][0]
+            try:
+                str(self.data[10:start], "ascii")
+                value = unpad(str(self.data[start:], "utf-8")[:MAX_MESSAGE_LENGTH])
+            except UnicodeDecodeError:
+                value = self.materialize().text
+        elif name in offsets:
+            value = self.field(name, *offsets[name])
+        else:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
+def view_request(data):
+    """
+    Wraps a byte string in a RequestView, decoding only user_id and op_code.
+    Returns the same (request, op) pair as unmarshal_request.
+    NOTE: Only lazy ops get a view. Ops without fields are built straight from
+    the user_id, and the rest (whose numbers should be validated up front) are
+    simply unmarshaled, as is anything whose user_id is not ASCII (which
+    shifts the op_code)
+    """
+    if data[0] == VERSION_1_BYTE[0]:
+        return view_request_v1(data)
+    try:
+        user_id = unpad(str(data[1:9], "ascii"))
+    except UnicodeDecodeError:
+        return unmarshal_request(data)
+    op = find_op(data[9])
+    if op.lazy:
+        return RequestView(data, user_id, op.name), op.name
+    if not op.fields:
+        return op.request_class(user_id), op.name
+    return unmarshal_request(data)
+
 RESP_TO_CODE_MAP = {
     "basic": "1",
     "list": "2",
     "message": "3",
+    "batch": "4",
+    "messages": "5",
+    "stats": "6",
 }
 
 CODE_TO_RESP_MAP = {
     "1": "basic",
     "2": "list",
     "3": "message",
+    "4": "batch",
+    "5": "messages",
+    "6": "stats",
 }
 
+# The function that marshals each type of response, by name so that any
+# codec module with the same functions as this one can be used
+RESPONSE_MARSHALERS = {
+    "basic": "marshal_response",
+    "list": "marshal_list_response",
+    "message": "marshal_message_response",
+    "batch": "marshal_batch_response",
+    "messages": "marshal_messages_response",
+    "stats": "marshal_stats_response",
+}
+
+def response_encoders(codec):
+    """
+    Maps every op to the function in the codec module that marshals its response
+    """
+    return {op.name: getattr(codec, RESPONSE_MARSHALERS[op.response]) for op in OPS}
+
 def marshal_response(resp: Response):
     """
     Marshals a Response into a byte string
@@ -194,10 +412,35 @@ def marshal_list_response(resp: ListResponse):
         prep_accounts(resp.accounts)
     ).encode()
 
+def marshal_batch_response(resp: BatchResponse):
+    """
+    Marshals a BatchResponse into a byte string
+    NOTE: The statuses follow the header as one "1" or "0" per message
+    """
+    return "{}{}{}{}{}{}".format(
+        VERSION,
+        pad_to_length(resp.user_id, 8),
+        RESP_TO_CODE_MAP[resp.type],
+        1 if resp.success else 0,
+        pad_to_length(resp.error_message, ERROR_MESSAGE_LENGTH),
+        "".join("1" if status else "0" for status in resp.statuses),
+    ).encode()
+
 def marshal_message_response(msg: Message):
     """
     Marshals a Message into a byte string
-    """
+    NOTE: Messages forwarded from a send request already carry their encoded
+    text, which is padded and copied over without being decoded
+    """
+    if msg.text_bytes is not None:
+        return "{}{}{}{}{}{}".format(
+            VERSION,
+            pad_to_length(msg.recipient_id, 8),
+            RESP_TO_CODE_MAP["message"],
+            1 if msg.success else 0,
+            pad_to_length("", ERROR_MESSAGE_LENGTH),
+            pad_to_length(msg.author_id, 8),
+        ).encode() + pad_bytes_to_length(msg.text_bytes, MAX_MESSAGE_LENGTH)
     return "{}{}{}{}{}{}{}".format(
         VERSION,
         pad_to_length(msg.recipient_id, 8),
@@ -208,11 +451,50 @@ def marshal_message_response(msg: Message):
         pad_to_length(msg.text, 280),
     ).encode()
 
+def marshal_messages_response(resp: MessagesResponse):
+    """
+    Marshals a MessagesResponse into a byte string
+    NOTE: The header is followed by a count and then one [ author_id, text ]
+    entry per message
+    """
+    header = "{}{}{}{}{}{}".format(
+        VERSION,
+        pad_to_length(resp.user_id, 8),
+        RESP_TO_CODE_MAP[resp.type],
+        1 if resp.success else 0,
+        pad_to_length(resp.error_message, ERROR_MESSAGE_LENGTH),
+        pad_to_length(str(len(resp.messages)), 8),
+    ).encode()
+    parts = [header]
+    for msg in resp.messages:
+        parts.append(pad_to_length(msg.author_id, 8).encode())
+        if msg.text_bytes is not None:
+            parts.append(pad_bytes_to_length(msg.text_bytes, MAX_MESSAGE_LENGTH))
+        else:
+            parts.append(pad_to_length(msg.text, MAX_MESSAGE_LENGTH).encode())
+    return b"".join(parts)
+
+def marshal_stats_response(resp: StatsResponse):
+    """
+    Marshals a StatsResponse into a byte string
+    NOTE: The text takes up the rest of the frame, unpadded
+    """
+    return "{}{}{}{}{}{}".format(
+        VERSION,
+        pad_to_length(resp.user_id, 8),
+        RESP_TO_CODE_MAP[resp.type],
+        1 if resp.success else 0,
+        pad_to_length(resp.error_message, ERROR_MESSAGE_LENGTH),
+        resp.text,
+    ).encode()
+
 def unmarshal_response(data):
     """
     Unmarshals a byte string into a Response
     """
-    data = data.decode()
+    if data[0] == VERSION_1_BYTE[0]:
+        return unmarshal_response_v1(data)
+    data = str(data, "utf-8")
     version = data[0]
     user_id = unpad(data[1:9])
     resp_code = data[9]
@@ -228,5 +510,304 @@ def unmarshal_response(data):
         author_id = unpad(data[11+ERROR_MESSAGE_LENGTH:11+ERROR_MESSAGE_LENGTH+8])
         text = unpad(data[11+ERROR_MESSAGE_LENGTH+8:])
         return Message(recipient_id=user_id, author_id=author_id, text=text, success=success)
+    elif resp_type == "messages":
+        count = int(unpad(data[11+ERROR_MESSAGE_LENGTH:11+ERROR_MESSAGE_LENGTH+8]))
+        messages = []
+        start = 11 + ERROR_MESSAGE_LENGTH + 8
+        for start in range(start, start + count * MESSAGE_ENTRY_LENGTH, MESSAGE_ENTRY_LENGTH):
+            author_id = unpad(data[start:start+8])
+            text = unpad(data[start+8:start+MESSAGE_ENTRY_LENGTH])
+            messages.append(Message(recipient_id=user_id, author_id=author_id, text=text, success=True))
+        return MessagesResponse(user_id=user_id, success=success, error_message=error_message, messages=messages)
+    elif resp_type == "batch":
+        statuses = [status == "1" for status in data[11+ERROR_MESSAGE_LENGTH:]]
+        return BatchResponse(user_id=user_id, success=success, error_message=error_message, statuses=statuses)
+    elif resp_type == "stats":
+        return StatsResponse(user_id=user_id, success=success, error_message=error_message, text=data[11+ERROR_MESSAGE_LENGTH:])
+    else:
+        raise Exception("Unknown response type: {}".format(resp_type))
+# Version 1 is a compact alternative to the format above. Nothing is padded:
+# strings are a varint byte length followed by their UTF-8 bytes, and numbers
+# are varints. Fields keep the same length limits as version 0 so that both
+# kinds of client can talk to the same server, which answers every request in
+# the version it arrived in.
+#
+# Requests:  [ version, op_code, user_id, ...op specific fields ]
+# Responses: [ version, resp_code, success, user_id, error_message, ...type specific fields ]
+
+VERSION_1 = "1"
+VERSION_1_BYTE = VERSION_1.encode()
+
+# Varints below 128 are a single byte, which covers nearly every length we send
+SMALL_VARINTS = [bytes((n,)) for n in range(128)]
+
+def pack_varint(n):
+    """
+    Encodes a non-negative integer as a LEB128 varint
+    """
+    if n < 128:
+        return SMALL_VARINTS[n]
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def read_varint(data, offset):
+    """
+    Decodes the varint at data[offset]. Returns the value and the offset
+    just past it.
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+def pack_bytes(b):
+    """
+    Encodes a length-prefixed byte string
+    """
+    return pack_varint(len(b)) + b
+
+def pack_string(s, length):
+    """
+    Encodes a length-prefixed UTF-8 string
+    NOTE: Like pad_to_length, if len(s) > length this will truncate the string
+    """
+    return pack_bytes(s[:length].encode())
+
+def read_bytes(data, offset):
+    """
+    Decodes the length-prefixed bytes at data[offset] without copying them.
+    Returns a slice of data and the offset just past it.
+    """
+    length, offset = read_varint(data, offset)
+    end = offset + length
+    if end > len(data):
+        raise Exception("Field runs past the end of the message")
+    return data[offset:end], end
+
+def read_string(data, offset):
+    """
+    Decodes the length-prefixed UTF-8 string at data[offset]
+    """
+    b, offset = read_bytes(data, offset)
+    return str(b, "utf-8"), offset
+
+def message_text_bytes(msg: Message):
+    """
+    The encoded text of a Message, without decoding forwarded messages
+    """
+    if msg.text_bytes is not None:
+        return msg.text_bytes
+    return msg.text[:MAX_MESSAGE_LENGTH].encode()
+
+def encode_message_v1(msg: Message):
+    """
+    The [ author_id, text ] part of a Message in version 1 responses, which
+    both a message response and each entry of a messages response end with
+    """
+    return pack_string(msg.author_id, 8) + pack_bytes(message_text_bytes(msg))
+
+def message_wire_v1(msg: Message):
+    """
+    The version 1 encoding of a Message, as stored by preencode or else made now
+    """
+    if msg.wire is not None:
+        return msg.wire
+    return encode_message_v1(msg)
+
+def preencode(msg: Message):
+    """
+    Encodes a Message for version 1 responses once, as it is sent, and keeps
+    the bytes on it. Delivering it then only copies them into the response.
+    Returns the message.
+    NOTE: Version 0 responses are padded to fixed widths, so they are still
+    encoded on delivery rather than storing 288 bytes for every message
+    """
+    msg.wire = encode_message_v1(msg)
+    return msg
+
+def marshal_request_v1(req: Request, op):
+    """
+    Marshals any Request for the given op into a version 1 byte string
+    """
+    op = OPS_BY_NAME[op]
+    parts = [VERSION_1_BYTE, op.code.encode(), pack_string(req.user_id, 8)]
+    for field in op.fields:
+        value = getattr(req, field.name)
+        if field.kind == STRING:
+            parts.append(pack_string(value, field.length))
+        elif field.kind == NUMBER:
+            parts.append(pack_varint(value))
+        else:
+            parts.append(pack_varint(len(value)))
+            for msg in value:
+                parts.append(pack_string(msg.recipient_id, 8))
+                parts.append(pack_string(msg.text, MAX_MESSAGE_LENGTH))
+    return b"".join(parts)
+
+def unmarshal_request_v1(data):
+    """
+    Unmarshals a version 1 byte string into a Request
+    """
+    op = find_op(data[1])
+    user_id, offset = read_string(data, 2)
+    values = {}
+    for field in op.fields:
+        if field.kind == STRING:
+            values[field.name], offset = read_string(data, offset)
+        elif field.kind == NUMBER:
+            values[field.name], offset = read_varint(data, offset)
+        else:
+            count, offset = read_varint(data, offset)
+            messages = []
+            for _ in range(count):
+                recipient_id, offset = read_string(data, offset)
+                text, offset = read_string(data, offset)
+                messages.append(SendRequest(user_id, recipient_id=recipient_id, text=text))
+            values[field.name] = messages
+    return op.request_class(user_id, **values), op.name
+
+class RequestViewV1(RequestView):
+    """
+    A lazily decoded version 1 request. Field boundaries are found up front
+    (which only reads the varint lengths) but nothing is decoded until read.
+    """
+    def __init__(self, data, user_id, op, offset):
+        super().__init__(data, user_id, op)
+        self.offset = offset # Where the op specific fields start
+
+    def __getattr__(self, name):
+        """
+        Only called for fields that have not been decoded yet. The first read
+        walks every field, keeping a text field encoded (as text_bytes) until
+        text itself is asked for.
+        """
+        op = OPS_BY_NAME[self.op]
+        if name == "text" and "text" in op.offsets:
+            self.text = str(self.text_bytes, "utf-8")
+            return self.text
+        if name not in op.offsets and not (name == "text_bytes" and "text" in op.offsets):
+            raise AttributeError(name)
+        offset = self.offset
+        for field in op.fields:
+            if field.kind == NUMBER:
+                value, offset = read_varint(self.data, offset)
+            elif field.name == "text":
+                text_bytes, offset = read_bytes(self.data, offset)
+                text_bytes = bytes(text_bytes)
+                if len(text_bytes) > MAX_MESSAGE_LENGTH or not text_bytes.isascii():
+                    # Validate (and truncate) anything that isn't plainly short ASCII
+                    text_bytes = str(text_bytes, "utf-8")[:MAX_MESSAGE_LENGTH].encode()
+                self.text_bytes = text_bytes
+                continue
+            else:
+                value, offset = read_string(self.data, offset)
+            setattr(self, field.name, value)
+        return self.__dict__[name]
+
+def view_request_v1(data):
+    """
+    Wraps a version 1 byte string in a RequestViewV1. Like view_request,
+    only lazy ops get a view, everything else is simply unmarshaled.
+    """
+    op = find_op(data[1])
+    if not op.lazy:
+        return unmarshal_request_v1(data)
+    user_id, offset = read_string(data, 2)
+    return RequestViewV1(data, user_id, op.name, offset), op.name
+
+def marshal_response_v1(resp):
+    """
+    Marshals any Response (or a Message) into a version 1 byte string
+    """
+    if resp.type == "message":
+        # Messages travel as their own response, addressed to the recipient
+        return b"".join((
+            VERSION_1_BYTE,
+            RESP_TO_CODE_MAP["message"].encode(),
+            b"\1" if resp.success else b"\0",
+            pack_string(resp.recipient_id, 8),
+            pack_varint(0),
+            message_wire_v1(resp),
+        ))
+    parts = [
+        VERSION_1_BYTE,
+        RESP_TO_CODE_MAP[resp.type].encode(),
+        b"\1" if resp.success else b"\0",
+        pack_string(resp.user_id, 8),
+        pack_string(resp.error_message, ERROR_MESSAGE_LENGTH),
+    ]
+    if resp.type == "list":
+        parts.append(pack_varint(len(resp.accounts)))
+        for account in resp.accounts:
+            parts.append(pack_string(account.user_id, 8))
+    elif resp.type == "messages":
+        parts.append(pack_varint(len(resp.messages)))
+        for msg in resp.messages:
+            parts.append(message_wire_v1(msg))
+    elif resp.type == "batch":
+        # One bit per message, least significant bit first
+        bits = bytearray((len(resp.statuses) + 7) // 8)
+        for i, status in enumerate(resp.statuses):
+            if status:
+                bits[i // 8] |= 1 << (i % 8)
+        parts.append(pack_varint(len(resp.statuses)))
+        parts.append(bytes(bits))
+    elif resp.type == "stats":
+        parts.append(pack_bytes(resp.text.encode("utf-8")))
+    return b"".join(parts)
+
+def unmarshal_response_v1(data):
+    """
+    Unmarshals a version 1 byte string into a Response
+    """
+    resp_type = CODE_TO_RESP_MAP[chr(data[1])]
+    success = data[2] == 1
+    user_id, offset = read_string(data, 3)
+    error_message, offset = read_string(data, offset)
+    if resp_type == "basic":
+        return Response(user_id=user_id, success=success, error_message=error_message)
+    elif resp_type == "list":
+        count, offset = read_varint(data, offset)
+        accounts = []
+        for _ in range(count):
+            account, offset = read_string(data, offset)
+            accounts.append(account)
+        return ListResponse(user_id=user_id, success=success, error_message=error_message, accounts=accounts)
+    elif resp_type == "message":
+        author_id, offset = read_string(data, offset)
+        text, offset = read_string(data, offset)
+        return Message(recipient_id=user_id, author_id=author_id, text=text, success=success)
+    elif resp_type == "messages":
+        count, offset = read_varint(data, offset)
+        messages = []
+        for _ in range(count):
+            author_id, offset = read_string(data, offset)
+            text, offset = read_string(data, offset)
+            messages.append(Message(recipient_id=user_id, author_id=author_id, text=text, success=True))
+        return MessagesResponse(user_id=user_id, success=success, error_message=error_message, messages=messages)
+    elif resp_type == "batch":
+        count, offset = read_varint(data, offset)
+        statuses = [bool(data[offset + i // 8] & (1 << (i % 8))) for i in range(count)]
+        return BatchResponse(user_id=user_id, success=success, error_message=error_message, statuses=statuses)
+    elif resp_type == "stats":
+        text, offset = read_string(data, offset)
+        return StatsResponse(user_id=user_id, success=success, error_message=error_message, text=text)
     else:
-        raise Exception("Unknown response type: {}".format(resp_type))
\ No newline at end of file
+        raise Exception("Unknown response type: {}".format(resp_type))
+
+def marshal_request(req: Request, op, version=VERSION):
+    """
+    Marshals any Request for the given op in the given protocol version
+    """
+    if version == VERSION_1:
+        return marshal_request_v1(req, op)
+    return marshal_op_request(req, OPS_BY_NAME[op])
@@ -0,0 +1,262 @@
+import struct
+import zlib
+
+# Every message on the wire is prefixed by its length as a 4 byte unsigned
+# big-endian integer: [ length - 4 bytes, payload - length bytes ]
+# The top bit of the length is set when the payload is zlib compressed.
+FRAME_HEADER = struct.Struct("!I")
+FRAME_HEADER_LENGTH = FRAME_HEADER.size
+MAX_FRAME_LENGTH = 1 << 20
+COMPRESSED_FLAG = 1 << 31
+LENGTH_MASK = COMPRESSED_FLAG - 1
+
+# Frames smaller than this are always sent raw, since zlib's own overhead
+# (and the CPU) outweighs what it saves on small messages
+COMPRESSION_THRESHOLD = 512
+COMPRESSION_LEVEL = 1 # Fastest, chat text compresses well regardless
+
+# A hello frame is the first frame a client sends to negotiate options.
+# It starts with a byte that is never a protocol version, followed by the
+# comma separated compressions the sender supports: [ 0xff, "zlib" ]
+# The server answers with a hello frame naming the one it picked (if any).
+HELLO_BYTE = b"\xff"
+COMPRESSIONS = ["zlib"]
+
+# A heartbeat frame is the single byte [ 0xfe ], which is never a protocol
+# version either. Clients send one on a connection that has been quiet for a
+# while, so the server can tell it apart from a dead one (see idle.py). It is
+# never answered.
+HEARTBEAT = b"\xfe"
+
+# A tagged frame wraps a request in a correlation id the client picked:
+# [ 0xfd, request_id - 4 bytes, request ]
+# The server answers it with a tagged frame carrying the same id around the
+# reply, and may answer tagged requests out of order, so a client can keep
+# many requests in flight on one connection and match the replies up by id
+# (see async_client.py). Untagged requests are still answered in order.
+TAGGED = b"\xfd"
+TAG_HEADER = struct.Struct("!cI")
+TAG_HEADER_LENGTH = TAG_HEADER.size
+MAX_REQUEST_ID = (1 << 32) - 1
+
+def compress(data):
+    """
+    Compresses a payload if that is worthwhile. Returns the payload and
+    the flag to set in its header.
+    """
+    if len(data) < COMPRESSION_THRESHOLD:
+        return data, 0
+    compressed = zlib.compress(data, COMPRESSION_LEVEL)
+    if len(compressed) >= len(data):
+        return data, 0
+    return compressed, COMPRESSED_FLAG
+
+def decompress(data):
+    """
+    Inflates a compressed payload, refusing anything that would inflate
+    past MAX_FRAME_LENGTH
+    """
+    inflater = zlib.decompressobj()
+    out = inflater.decompress(data, MAX_FRAME_LENGTH)
+    if inflater.unconsumed_tail:
+        raise Exception("Frame too large once decompressed")
+    return out
+
+def frame(data, compressed=False):
+    """
+    Prefixes a marshaled message with its length header, compressing
+    it first if compression was negotiated
+    """
+    flag = 0
+    if compressed:
+        data, flag = compress(data)
+    return FRAME_HEADER.pack(len(data) | flag) + data
+
+def frame_all(messages, compressed=False):
+    """
+    Frames a sequence of marshaled messages into a single byte string
+    so that they can be written with one sendall
+    """
+    parts = []
+    for data in messages:
+        flag = 0
+        if compressed:
+            data, flag = compress(data)
+        parts.append(FRAME_HEADER.pack(len(data) | flag))
+        parts.append(data)
+    return b"".join(parts)
+
+def hello(compressions=COMPRESSIONS):
+    """
+    Builds a hello frame payload offering (or picking) compressions
+    """
+    return HELLO_BYTE + ",".join(compressions).encode()
+
+def is_hello(data):
+    return len(data) > 0 and data[0] == HELLO_BYTE[0]
+
+def is_heartbeat(data):
+    return len(data) > 0 and data[0] == HEARTBEAT[0]
+
+def is_tagged(data):
+    return len(data) > 0 and data[0] == TAGGED[0]
+
+def tag(request_id, data):
+    """
+    Wraps a marshaled request or reply in a tagged frame payload
+    """
+    return TAG_HEADER.pack(TAGGED, request_id) + data
+
+def untag(data):
+    """
+    The request_id and the payload of a tagged frame. The payload is a view
+    into data when data is a memoryview.
+    """
+    if len(data) < TAG_HEADER_LENGTH:
+        raise Exception("Truncated tagged frame")
+    _, request_id = TAG_HEADER.unpack_from(data)
+    return request_id, data[TAG_HEADER_LENGTH:]
+
+def parse_hello(data):
+    """
+    The compressions named in a hello frame payload
+    """
+    names = str(data[1:], "utf-8")
+    return names.split(",") if names else []
+
+def negotiate(offered):
+    """
+    Picks the compression to use from those a peer offered, or None
+    """
+    for name in COMPRESSIONS:
+        if name in offered:
+            return name
+    return None
+
+class FrameDecoder:
+    """
+    Incrementally reassembles length-prefixed frames from a stream socket.
+    Bytes are received straight into a reusable buffer with recv_into, and
+    complete frames are handed out as memoryviews into that buffer, so a
+    single recv can yield many frames and partial frames are simply kept
+    until the rest arrives.
+    NOTE: A frame is only valid until the next call to recv_from, which may
+    reuse the memory it points at.
+    """
+    def __init__(self, capacity=4096):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # First byte that has not been handed out yet
+        self.end = 0 # One past the last byte received
+
+    def pending(self):
+        """
+        Number of received bytes that do not yet form a complete frame
+        """
+        return self.end - self.start
+
+    def make_room(self, needed):
+        """
+        Ensures there are at least `needed` free bytes at the end of the buffer,
+        moving leftover bytes of a partial frame to the front if necessary
+        """
+        leftover = self.end - self.start
+        if self.start > 0 and len(self.buffer) - self.end < needed:
+            self.view[:leftover] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = leftover
+        if len(self.buffer) - self.end < needed:
+            capacity = len(self.buffer)
+            while capacity - leftover < needed:
+                capacity *= 2
+            grown = bytearray(capacity)
+            grown[:leftover] = self.view[self.start:self.end]
+            self.buffer = grown
+            self.view = memoryview(grown)
+            self.start = 0
+            self.end = leftover
+
+    def get_buffer(self):
+        """
+        Returns a memoryview of the free space at the end of the buffer to
+        receive into, making room for at least the rest of the current frame
+        """
+        if self.start == self.end:
+            # Nothing outstanding, so start over at the front for free
+            self.start = 0
+            self.end = 0
+        needed = 1024
+        if self.end - self.start >= FRAME_HEADER_LENGTH:
+            (length,) = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            length &= LENGTH_MASK
+            needed = max(needed, FRAME_HEADER_LENGTH + length - (self.end - self.start))
+        self.make_room(needed)
+        return self.view[self.end:]
+
+    def buffer_updated(self, received):
+        """
+        Records that `received` bytes were written into the view from get_buffer
+        """
+        self.end += received
+
+    def recv_from(self, sock):
+        """
+        Receives whatever is available on the socket into the buffer.
+        Returns the number of bytes received (0 means the peer closed).
+        """
+        received = sock.recv_into(self.get_buffer())
+        self.buffer_updated(received)
+        return received
+
+    def feed(self, data):
+        """
+        Appends already received bytes to the buffer
+        """
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+        self.make_room(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def next_frame(self):
+        """
+        Returns a memoryview of the next complete frame, or None if
+        the buffer does not hold one yet
+        NOTE: Compressed frames are inflated into new bytes instead
+        """
+        available = self.end - self.start
+        if available < FRAME_HEADER_LENGTH:
+            return None
+        (header,) = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        length = header & LENGTH_MASK
+        if length > MAX_FRAME_LENGTH:
+            raise Exception("Frame too large: {} bytes".format(length))
+        if available - FRAME_HEADER_LENGTH < length:
+            return None
+        begin = self.start + FRAME_HEADER_LENGTH
+        self.start = begin + length
+        if header & COMPRESSED_FLAG:
+            return decompress(self.view[begin:self.start])
+        return self.view[begin:self.start]
+
+    def frames(self):
+        """
+        Yields every complete frame currently in the buffer
+        """
+        data = self.next_frame()
+        while data is not None:
+            yield data
+            data = self.next_frame()
+
+def recv_frame(sock, decoder):
+    """
+    Blocks until one whole frame has arrived on the socket.
+    Returns None if the peer closed the connection first.
+    """
+    data = decoder.next_frame()
+    while data is None:
+        if decoder.recv_from(sock) == 0:
+            return None
+        data = decoder.next_frame()
+    return data
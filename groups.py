@@ -0,0 +1,124 @@
+# Group conversations, for both the socket server and the gRPC server in
+# part2.
+#
+# Sending one text to every member of a group used to take a send per member,
+# each with a Message and a copy of the text of its own. A group send builds
+# a single Message instead, addressed to the group, and puts that very object
+# in every member's mailbox. Messages are never changed once they are sent, so
+# sharing one is safe, and Python's reference counting frees it once the last
+# member has taken it out of their mailbox.
+#
+# Each group keeps its members split by the shard of the user registry they
+# fall in (see user_registry.py), so a send takes each shard's lock once for
+# all of the members in it, rather than once per member. Holding that lock
+# keeps the accounts of those members (and so their mailboxes) from being
+# deleted halfway through.
+#
+# NOTE: Memberships only live in memory. Messages sent to a group are logged
+# like any other (a record per member, see message_log.py), but after a
+# restart the members have to join their groups again.
+
+from threading import Lock
+
+class Groups:
+    """
+    The members of every group, by group_id. A group exists for as long as
+    it has members: the first to join creates it.
+    NOTE: The lock is always taken after a shard lock of the registry, never
+    before, and is never held while sending
+    """
+    def __init__(self, users):
+        self.users = users # The UserRegistry the members come from
+        self.groups = {} # group_id -> {Shard: set of member user_ids}
+        self.joined = {} # user_id -> set of group_ids, so that a deleted user can leave them all
+        self.lock = Lock()
+
+    def join(self, group_id, user_id):
+        """
+        Adds a user to a group, creating the group if needed. Returns False
+        if they were a member already.
+        """
+        shard = self.users.shard(user_id)
+        with self.lock:
+            members = self.groups.setdefault(group_id, {}).setdefault(shard, set())
+            if user_id in members:
+                return False
+            members.add(user_id)
+            self.joined.setdefault(user_id, set()).add(group_id)
+            return True
+
+    def leave(self, group_id, user_id):
+        """
+        Removes a user from a group, and the group once nobody is left in it.
+        Returns False if they weren't a member.
+        """
+        with self.lock:
+            return self.discard(group_id, user_id)
+
+    def leave_all(self, user_id):
+        """
+        Removes a user from every group they are in, e.g. when their account is deleted
+        """
+        with self.lock:
+            for group_id in list(self.joined.get(user_id, ())):
+                self.discard(group_id, user_id)
+
+    def discard(self, group_id, user_id):
+        """
+        NOTE: Requires self.lock to be held
+        """
+        group = self.groups.get(group_id)
+        shard = self.users.shard(user_id)
+        if group is None or user_id not in group.get(shard, ()):
+            return False
+        group[shard].remove(user_id)
+        if not group[shard]:
+            del group[shard]
+        if not group:
+            del self.groups[group_id]
+        self.joined[user_id].remove(group_id)
+        if not self.joined[user_id]:
+            del self.joined[user_id]
+        return True
+
+    def members(self, group_id):
+        """
+        The members of a group as (shard, user_ids) pairs, copied out so that
+        they can be used without the lock. Empty if the group doesn't exist.
+        """
+        with self.lock:
+            return [(shard, list(user_ids)) for shard, user_ids in self.groups.get(group_id, {}).items()]
+
+    def fan_out(self, group_id, message, mailboxes, skip=None):
+        """
+        Puts message, as is, into the mailbox of every member of a group but
+        skip (usually its author), taking the lock of each registry shard
+        once for all of its members. Returns the user_ids whose mailbox took
+        it and the number of full mailboxes that refused it, or None if the
+        group doesn't exist.
+        NOTE: Requires no shard lock to be held
+        """
+        parts = self.members(group_id)
+        if not parts:
+            return None
+        delivered = []
+        refused = 0
+        for shard, user_ids in parts:
+            with shard.lock:
+                for user_id in user_ids:
+                    if user_id == skip:
+                        continue
+                    mailbox = mailboxes.get(user_id)
+                    if mailbox is None:
+                        continue # Deleted since the members were copied out
+                    if mailbox.put(message):
+                        delivered.append(user_id)
+                    else:
+                        refused += 1
+        return delivered, refused
+
+    def __contains__(self, group_id):
+        return group_id in self.groups
+
+    def __len__(self):
+        return len(self.groups)
@@ -0,0 +1,119 @@
+# Finds the client connections that have gone quiet, for the socket server.
+#
+# A client that vanishes without closing its connection (a laptop going to
+# sleep, a NAT forgetting the mapping) never sends a FIN, so without this its
+# connection stays open forever and its user stays logged in. Clients send a
+# heartbeat frame (see framing.py) on each connection every HEARTBEAT_SECONDS,
+# and the server drops connections it hasn't heard from in idle_timeout
+# seconds, which logs their users out.
+#
+# Connections are kept in a timer wheel: a ring of slots, one per resolution
+# seconds, each holding the connections whose deadline falls in it. Touching
+# a connection moves it to the slot of its new deadline, but only when that
+# is a different slot, so a busy connection moves at most once per resolution
+# and every other touch just records the time. When a slot comes due,
+# everything in it has expired. So adding, removing and touching a connection
+# take constant time, and a tick only costs as much as the connections it
+# drops, whether there are a hundred connections or a hundred thousand.
+
+import math
+import time
+from threading import Lock
+
+HEARTBEAT_SECONDS = 15 # How often clients send a heartbeat on each connection
+DEFAULT_IDLE_TIMEOUT = 60 # Seconds without a frame after which the server drops a connection
+DEFAULT_RESOLUTION = 1.0 # Seconds per slot, i.e. how late an idle connection may be dropped
+
+class TimerWheel:
+    """
+    Tracks when each item (e.g. a Session) was last active and finds those
+    that have been idle for more than timeout seconds
+    NOTE: Items need a last_active attribute, which touch sets. The times
+    come from clock, which has to be monotonic.
+    """
+    def __init__(self, timeout, resolution=DEFAULT_RESOLUTION, clock=time.monotonic):
+        self.timeout = timeout
+        self.resolution = resolution
+        self.clock = clock
+        # Enough slots that a deadline (at most timeout after the current
+        # tick is over) never wraps around onto the slot being expired
+        self.slots = [set() for _ in range(math.ceil(timeout / resolution) + 2)]
+        self.slot_of = {} # item -> the tick of the slot it is in
+        self.next_tick = self.tick_of(clock()) # The first tick not yet expired
+        self.lock = Lock()
+
+    def tick_of(self, when):
+        return math.floor(when / self.resolution)
+
+    def touch(self, item):
+        """
+        Records that an item was just active
+        NOTE: Only takes the lock when the item has to move to another slot,
+        so it can be called on every read
+        """
+        now = self.clock()
+        item.last_active = now
+        tick = self.tick_of(now + self.timeout)
+        old = self.slot_of.get(item)
+        if old is not None and old != tick:
+            with self.lock:
+                if item in self.slot_of: # Not removed in the meantime
+                    self.move(item, tick)
+
+    def add(self, item):
+        """
+        Starts tracking an item, as active now
+        """
+        item.last_active = self.clock()
+        with self.lock:
+            self.move(item, self.tick_of(item.last_active + self.timeout))
+
+    def move(self, item, tick):
+        """
+        Puts an item in the slot of the given tick (or the next one still to
+        come, if that has passed), taking it out of its old one
+        NOTE: Requires self.lock to be held
+        """
+        old = self.slot_of.get(item)
+        if old is not None:
+            self.slots[old % len(self.slots)].discard(item)
+        tick = max(tick, self.next_tick)
+        self.slot_of[item] = tick
+        self.slots[tick % len(self.slots)].add(item)
+
+    def remove(self, item):
+        """
+        Stops tracking an item, if it is tracked
+        """
+        with self.lock:
+            tick = self.slot_of.pop(item, None)
+            if tick is not None:
+                self.slots[tick % len(self.slots)].discard(item)
+
+    def expire(self):
+        """
+        Stops tracking every item idle for more than timeout, and returns them
+        NOTE: Goes through each slot due since the last call at most once,
+        so calling it rarely doesn't make it slower
+        """
+        now = self.clock()
+        expired = []
+        with self.lock:
+            last = self.tick_of(now) - 1 # The current tick is only due once it is over
+            first = max(self.next_tick, last - len(self.slots) + 1)
+            for tick in range(first, last + 1):
+                due = self.slots[tick % len(self.slots)]
+                self.slots[tick % len(self.slots)] = set()
+                self.next_tick = tick + 1
+                for item in due:
+                    del self.slot_of[item]
+                    if item.last_active + self.timeout <= now:
+                        expired.append(item)
+                    else:
+                        # Touched while this tick was being expired
+                        self.move(item, self.tick_of(item.last_active + self.timeout))
+            self.next_tick = max(self.next_tick, last + 1)
+        return expired
+
+    def __len__(self):
+        return len(self.slot_of)
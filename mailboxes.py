@@ -0,0 +1,268 @@
+# Mailboxes hold the messages waiting for each user, for both the socket
+# server and the gRPC server in part2.
+#
+# Each mailbox is a deque with a lock of its own, so taking a message off the
+# front is O(1) (slicing a list copied the whole mailbox every time) and
+# sending to one user never waits on another user's mailbox. The global lock
+# in Mailboxes is only taken to create or delete a mailbox.
+#
+# Most users have nothing waiting most of the time, while an empty deque
+# still takes a block of 64 slots (over 600 bytes). So an empty mailbox holds
+# the EMPTY tuple instead, and only gets a deque while messages are waiting.
+#
+# With a MessageLog attached (see message_log.py), every change is also
+# appended to the log under the same lock that makes it, and a restarted
+# server loads the last snapshot and replays the log after it to get its
+# mailboxes back.
+
+import collections
+import time
+from threading import Lock, Thread
+
+import message_log
+import snapshot
+
+DEFAULT_CHECKPOINT_INTERVAL = 300 # Seconds between snapshots of logged mailboxes
+EMPTY = () # The messages of an empty mailbox
+
+# A message restored from a log or snapshot while checkpointing, where only
+# its fields matter
+StoredMessage = collections.namedtuple("StoredMessage", ["author_id", "recipient_id", "text_bytes"])
+
+REJECT = "reject" # A full mailbox refuses new messages, so the send fails
+DROP_OLDEST = "drop_oldest" # A full mailbox discards its oldest messages to make room
+OVERFLOW_POLICIES = [REJECT, DROP_OLDEST]
+
+def check_settings(capacity, overflow):
+    """
+    Raises if a mailbox capacity or overflow policy is invalid
+    """
+    if overflow not in OVERFLOW_POLICIES:
+        raise Exception("Unknown overflow policy: {}".format(overflow))
+    if capacity is not None and capacity <= 0:
+        raise Exception("Mailbox capacity must be positive")
+
+class Mailbox:
+    """
+    The messages waiting for one user, oldest first
+    NOTE: capacity=None means the mailbox never fills up. Changes are only
+    logged if both user_id and log are given.
+    """
+    __slots__ = ("capacity", "overflow", "user_id", "log", "messages", "lock", "dropped")
+
+    def __init__(self, capacity=None, overflow=REJECT, user_id=None, log=None):
+        check_settings(capacity, overflow)
+        self.capacity = capacity
+        self.overflow = overflow
+        self.user_id = user_id
+        self.log = log
+        self.messages = EMPTY # A deque once something is waiting
+        self.lock = Lock()
+        self.dropped = 0 # Messages refused or discarded because the mailbox was full
+
+    def put(self, message):
+        """
+        Adds a message to the back of the mailbox. Returns False if it was
+        refused because the mailbox is full.
+        """
+        return self.put_many([message]) == 1
+
+    def put_many(self, messages):
+        """
+        Adds messages to the back of the mailbox, in order. Returns how many
+        were accepted: with the reject policy a full mailbox takes the first
+        ones that fit and refuses the rest.
+        """
+        with self.lock:
+            if self.capacity is None or self.overflow == DROP_OLDEST:
+                accepted = len(messages)
+                if self.capacity is not None:
+                    self.dropped += max(0, accepted - (self.capacity - len(self.messages)))
+            else:
+                accepted = max(0, min(self.capacity - len(self.messages), len(messages)))
+                self.dropped += len(messages) - accepted
+            if accepted == 0:
+                return 0
+            if self.messages is EMPTY:
+                # A bounded deque drops from the front by itself as it is appended to
+                self.messages = collections.deque(maxlen=self.capacity if self.overflow == DROP_OLDEST else None)
+            self.messages.extend(messages[:accepted])
+            if self.log is not None:
+                fields = [field for msg in messages[:accepted] for field in message_log.message_fields(msg)]
+                self.log.append(message_log.SEND, self.user_id.encode("utf-8"), *fields)
+            return accepted
+
+    def get(self):
+        """
+        Takes the oldest message out of the mailbox, or returns None if it is empty
+        """
+        with self.lock:
+            if self.messages:
+                self.log_delivery(1)
+                message = self.messages.popleft()
+                if not self.messages:
+                    self.messages = EMPTY
+                return message
+            return None
+
+    def take(self, limit=None):
+        """
+        Takes up to limit of the oldest messages out of the mailbox (all of
+        them if limit is None)
+        """
+        with self.lock:
+            count = len(self.messages) if limit is None else min(limit, len(self.messages))
+            if count == 0:
+                return []
+            self.log_delivery(count)
+            if count == len(self.messages):
+                taken = list(self.messages)
+                self.messages = EMPTY
+                return taken
+            popleft = self.messages.popleft
+            return [popleft() for _ in range(count)]
+
+    def log_delivery(self, count):
+        """
+        Logs that count messages were taken off the front
+        NOTE: Requires self.lock to be held. Nobody waits for a delivery to be
+        committed, so after a crash a message may be delivered again.
+        """
+        if self.log is not None and count > 0:
+            self.log.append(message_log.DELIVER, self.user_id.encode("utf-8"), str(count).encode())
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        """
+        Iterates over a snapshot of the waiting messages, without taking them
+        """
+        with self.lock:
+            return iter(list(self.messages))
+
+class Mailboxes:
+    """
+    Every user's mailbox, by user_id. Behaves like a read-only dict of
+    Mailbox objects.
+    """
+    def __init__(self, capacity=None, overflow=REJECT):
+        check_settings(capacity, overflow)
+        self.capacity = capacity
+        self.overflow = overflow
+        self.mailboxes = {}
+        self.lock = Lock()
+        self.log = None
+
+    def create(self, user_id):
+        """
+        Gives a user an empty mailbox, replacing any they had
+        """
+        with self.lock:
+            if self.log is not None:
+                self.log.append(message_log.CREATE, user_id.encode("utf-8")) # Before anyone can send to it
+            self.mailboxes[user_id] = Mailbox(self.capacity, self.overflow, user_id, self.log)
+
+    def delete(self, user_id):
+        """
+        Removes a user's mailbox, along with the messages in it
+        """
+        with self.lock:
+            mailbox = self.mailboxes.pop(user_id, None)
+            if self.log is not None and mailbox is not None:
+                with mailbox.lock:
+                    mailbox.log = None # Nothing sent to it from now on can follow the delete in the log
+                    self.log.append(message_log.DELETE, user_id.encode("utf-8"))
+
+    def attach(self, log, make_message, checkpoint_interval=None):
+        """
+        Rebuilds the mailboxes from what was recovered from a log, checkpoints
+        that state (unless nothing was logged since the snapshot), and from
+        then on logs every change to it (and checkpoints again every
+        checkpoint_interval seconds, if given).
+        make_message(author_id, recipient_id, text_bytes) recreates a logged
+        message. Returns the user_id of every mailbox, i.e. every account.
+        NOTE: Only call this before the mailboxes are used
+        """
+        self.restore(log.snapshot, log.recovered, make_message)
+        if log.snapshot is None or log.recovered:
+            log.checkpoint(self.contents())
+        for mailbox in self.mailboxes.values():
+            mailbox.log = log
+        self.log = log
+        if checkpoint_interval is not None:
+            Thread(target=self.checkpoint_loop, args=(checkpoint_interval,), daemon=True).start()
+        return list(self.mailboxes)
+
+    def restore(self, saved, records, make_message):
+        """
+        Loads a snapshot (if not None) and then replays log records after it
+        """
+        if saved is not None:
+            for user_id, messages in saved.users:
+                mailbox = self.mailboxes[user_id] = Mailbox(self.capacity, self.overflow, user_id)
+                mailbox.put_many([make_message(author_id, user_id, text) for author_id, text in messages])
+        for kind, fields in records:
+            user_id = str(fields[0], "utf-8")
+            if kind == message_log.CREATE:
+                self.mailboxes[user_id] = Mailbox(self.capacity, self.overflow, user_id)
+            elif kind == message_log.DELETE:
+                self.mailboxes.pop(user_id, None)
+            elif kind == message_log.SEND and user_id in self.mailboxes:
+                messages = [make_message(str(fields[i], "utf-8"), user_id, fields[i + 1]) for i in range(1, len(fields), 2)]
+                self.mailboxes[user_id].put_many(messages)
+            elif kind == message_log.DELIVER and user_id in self.mailboxes:
+                self.mailboxes[user_id].take(int(fields[1]))
+
+    def contents(self):
+        """
+        Every mailbox as it is now, in the form snapshot.write takes
+        """
+        for user_id, mailbox in list(self.mailboxes.items()):
+            yield user_id, [message_log.message_fields(msg) for msg in mailbox]
+
+    def checkpoint(self):
+        """
+        Snapshots the mailboxes as of now and drops the log before that point.
+        Returns whether there was anything new to snapshot.
+        NOTE: The snapshot is built from the last one and the log, not from
+        the live mailboxes, so nothing but the log rotation waits for it
+        """
+        generation = self.log.rotate()
+        if generation is None:
+            return False
+        shadow = Mailboxes(self.capacity, self.overflow)
+        shadow.restore(snapshot.load(self.log.snapshot_path), message_log.read_records(self.log.old_path)[0], StoredMessage)
+        self.log.finish_checkpoint(generation, shadow.contents())
+        return True
+
+    def checkpoint_loop(self, interval):
+        while not self.log.closed:
+            time.sleep(interval)
+            try:
+                self.checkpoint()
+            except Exception as e:
+                print("Error: checkpoint failed:", e) # The log still has everything, so try again next time
+
+    def get(self, user_id):
+        """
+        A user's mailbox, or None if they don't have one
+        """
+        return self.mailboxes.get(user_id)
+
+    def depths(self):
+        """
+        The number of messages waiting in each mailbox, e.g. for metrics
+        NOTE: Each length is read on its own, so they may not all be from
+        the same moment
+        """
+        return [len(mailbox) for mailbox in list(self.mailboxes.values())]
+
+    def __getitem__(self, user_id):
+        return self.mailboxes[user_id]
+
+    def __contains__(self, user_id):
+        return user_id in self.mailboxes
+
+    def __len__(self):
+        return len(self.mailboxes)
@@ -0,0 +1,331 @@
+# An append-only log of every change to the mailboxes, so that a server can
+# be restarted without losing the messages waiting in them. Used by both the
+# socket server and the gRPC server in part2 (see Mailboxes.attach).
+#
+# Each create, delete, send and deliver is appended to an in-memory buffer as
+# a record, under the lock of the mailbox it changes, so the log has the same
+# order as the mailboxes. Writing the buffer to disk happens later, in commit.
+# With the "always" policy every commit waits for an fsync covering its
+# records, but the threads committing at the same time share one fsync: the
+# first becomes the leader and writes and syncs everything buffered so far,
+# while the rest wait for it (group commit). So the number of fsyncs per
+# second stays about the same however many sends there are.
+#
+# Each record is framed as [ length - 4 bytes, crc32 - 4 bytes, payload ], and
+# the payload is a kind byte followed by fields, each [ length - 2 bytes,
+# bytes ]. A crash can leave a torn record at the end of the file, so reading
+# stops at the first record that is incomplete or fails its checksum, and the
+# log is truncated there before anything else is appended.
+#
+# To keep replaying quick, the log is checkpointed into a binary snapshot of
+# the mailboxes (see snapshot.py). Each log file starts with its generation,
+# and a checkpoint first rotates the log: the current file becomes PATH.old
+# and new records go to a fresh PATH of the next generation. Since rotating
+# happens under the log's lock, PATH.old ends at a consistent point, so the
+# snapshot can be built in the background from the last snapshot plus PATH.old,
+# without touching (or stalling) the live mailboxes. The new snapshot records
+# the generation that carries on from it, and PATH.old is deleted. On startup,
+# the snapshot is loaded and only the log files of that generation or later
+# are replayed, so a crash at any point of a checkpoint loses nothing.
+
+import os
+import struct
+import threading
+import time
+import zlib
+
+import snapshot
+
+ALWAYS = "always" # A commit waits until its records are written and fsynced
+INTERVAL = "interval" # A commit returns at once, and the log is fsynced every DEFAULT_INTERVAL seconds
+NEVER = "never" # A commit waits until its records are written, but the OS decides when they reach the disk
+FSYNC_POLICIES = [ALWAYS, INTERVAL, NEVER]
+DEFAULT_INTERVAL = 0.01
+
+CREATE = b"c" # user_id
+DELETE = b"d" # user_id
+SEND = b"s" # recipient_id, then author_id and text of each message
+DELIVER = b"t" # user_id, number of messages taken from the front of the mailbox
+GENERATION = b"g" # generation, the first record of every log file
+
+RECORD_HEADER = struct.Struct("!II")
+FIELD_HEADER = struct.Struct("!H")
+
+def encode_record(kind, *fields):
+    """
+    Frames a record of the given kind, whose fields are byte strings
+    """
+    parts = [kind]
+    for field in fields:
+        parts.append(FIELD_HEADER.pack(len(field)))
+        parts.append(field)
+    payload = b"".join(parts)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+def decode_record(payload):
+    """
+    The (kind, fields) of a record's payload
+    """
+    kind = payload[:1]
+    fields = []
+    offset = 1
+    while offset < len(payload):
+        (length,) = FIELD_HEADER.unpack_from(payload, offset)
+        offset += FIELD_HEADER.size
+        fields.append(payload[offset:offset + length])
+        offset += length
+    return kind, fields
+
+def read_records(path):
+    """
+    Reads every intact record of a log file. Returns the (kind, fields) of
+    each, and the length of the file up to the end of the last intact one.
+    """
+    _, records, length = read_segment(path)
+    return records, length
+
+def read_segment(path):
+    """
+    Like read_records, but also returns the generation of the file first
+    (0 for a file that doesn't say), and leaves out the generation record
+    """
+    if not os.path.exists(path):
+        return 0, [], 0
+    with open(path, "rb") as f:
+        data = f.read()
+    generation = 0
+    records = []
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, checksum = RECORD_HEADER.unpack_from(data, offset)
+        payload = data[offset + RECORD_HEADER.size : offset + RECORD_HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            break # Torn by a crash mid-write
+        kind, fields = decode_record(payload)
+        if kind == GENERATION:
+            generation = int(fields[0])
+        else:
+            records.append((kind, fields))
+        offset += RECORD_HEADER.size + length
+    return generation, records, offset
+
+def message_fields(msg):
+    """
+    The author_id and text of a message (socket or protobuf), as the byte
+    strings logged for it
+    """
+    text_bytes = getattr(msg, "text_bytes", None)
+    if text_bytes is None:
+        text_bytes = msg.text.encode("utf-8")
+    return msg.author_id.encode("utf-8"), text_bytes
+
+class MessageLog:
+    """
+    An append-only log file with group commit
+    NOTE: When it is opened, the last snapshot is loaded into self.snapshot
+    (None if there is none) and the records logged since then are read into
+    self.recovered, for the mailboxes to restore
+    """
+    def __init__(self, path, fsync=ALWAYS, interval=DEFAULT_INTERVAL):
+        if fsync not in FSYNC_POLICIES:
+            raise Exception("Unknown fsync policy: {}".format(fsync))
+        self.path = path
+        self.old_path = path + ".old"
+        self.snapshot_path = path + ".snapshot"
+        self.fsync = fsync
+        self.interval = interval
+        self.snapshot = snapshot.load(self.snapshot_path)
+        self.generation = 0 if self.snapshot is None else self.snapshot.generation
+        self.recovered = []
+        for segment in [self.old_path, path]:
+            generation, records, length = read_segment(segment)
+            if generation >= self.generation:
+                self.recovered.extend(records)
+                self.generation = generation
+            elif segment == path:
+                length = 0 # Everything in it is in the snapshot already, so start it over
+            elif os.path.exists(segment):
+                os.remove(segment) # Left behind by a crash just before a checkpoint finished
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        os.ftruncate(self.fd, length)
+        if length == 0:
+            os.write(self.fd, encode_record(GENERATION, str(self.generation).encode()))
+        self.rotated = 0 # Records appended before the last rotation
+        self.buffer = bytearray() # Records appended but not yet written
+        self.appended = 0 # Records appended so far
+        self.durable = 0 # Records written (and fsynced, unless the policy is never) so far
+        self.flushing = False # Whether a leader is writing right now
+        self.syncs = 0 # Writes to the file, each covering every record buffered at the time
+        self.error = None
+        self.closed = False
+        self.cond = threading.Condition()
+        if fsync == INTERVAL:
+            threading.Thread(target=self.sync_loop, daemon=True).start()
+
+    def append(self, kind, *fields):
+        """
+        Buffers a record. Returns its sequence number, to commit.
+        NOTE: Cheap enough to call while holding a mailbox lock, which is what
+        keeps the log in the same order as the mailboxes
+        """
+        record = encode_record(kind, *fields)
+        with self.cond:
+            if self.error is not None:
+                raise Exception("Message log failed: {}".format(self.error))
+            if self.closed:
+                raise Exception("Message log is closed")
+            self.buffer += record
+            self.appended += 1
+            return self.appended
+
+    def waits(self):
+        """
+        Whether commit blocks until the disk has caught up
+        """
+        return self.fsync != INTERVAL
+
+    def pending(self):
+        """
+        Whether records have been appended that are not yet durable
+        """
+        return self.durable < self.appended
+
+    def commit(self, seq=None):
+        """
+        Waits until every record up to seq (every record appended so far if
+        None) is as durable as the fsync policy promises
+        """
+        if self.fsync != INTERVAL:
+            self.flush(seq)
+
+    def flush(self, seq=None):
+        """
+        Writes (and, unless the policy is never, fsyncs) the buffer until
+        every record up to seq is durable. If another thread is already
+        writing, waits for it instead and only leads the next write if that
+        one didn't cover seq.
+        """
+        with self.cond:
+            if seq is None:
+                seq = self.appended
+            while self.durable < seq:
+                if self.error is not None:
+                    raise Exception("Message log failed: {}".format(self.error))
+                if self.flushing:
+                    self.cond.wait()
+                    continue
+                self.flushing = True
+                data = bytes(self.buffer)
+                self.buffer.clear()
+                upto = self.appended
+                self.cond.release()
+                try:
+                    self.write(data, self.fsync != NEVER)
+                except OSError as e:
+                    self.error = e
+                    raise
+                finally:
+                    self.cond.acquire()
+                    self.flushing = False
+                    if self.error is None:
+                        self.durable = upto
+                        self.syncs += 1
+                    self.cond.notify_all()
+
+    def sync_loop(self):
+        """
+        Makes the log durable every interval, for the interval policy
+        """
+        while not self.closed:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                return
+
+    def write(self, data, sync):
+        """
+        Writes to the end of the file, and fsyncs it if sync is set
+        """
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+        if sync:
+            os.fsync(self.fd)
+
+    def start_file(self, generation):
+        """
+        Replaces the current log file with an empty one of the given generation
+        """
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(encode_record(GENERATION, str(generation).encode()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        snapshot.sync_directory(self.path)
+        os.close(self.fd)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.generation = generation
+
+    def checkpoint(self, contents):
+        """
+        Replaces the snapshot with one of contents (see snapshot.write) and
+        starts the log over, e.g. right after restoring the mailboxes
+        NOTE: Only safe before anything has been appended
+        """
+        generation = self.generation + 1
+        snapshot.write(self.snapshot_path, generation, contents)
+        if os.path.exists(self.old_path):
+            os.remove(self.old_path)
+        self.start_file(generation)
+        self.snapshot = None
+        self.recovered = []
+
+    def rotate(self):
+        """
+        Starts the next generation of the log, and moves the current file to
+        PATH.old. Returns the new generation, or None if nothing was logged
+        since the last rotation or the last checkpoint isn't finished.
+        NOTE: Appending waits while this runs, which takes one fsync
+        """
+        with self.cond:
+            while self.flushing:
+                self.cond.wait()
+            if self.closed or self.appended == self.rotated or os.path.exists(self.old_path):
+                return None
+            if self.error is not None:
+                raise Exception("Message log failed: {}".format(self.error))
+            try:
+                self.write(bytes(self.buffer), True)
+                self.buffer.clear()
+                self.durable = self.rotated = self.appended
+                os.replace(self.path, self.old_path)
+                self.start_file(self.generation + 1)
+            except OSError as e:
+                self.error = e
+                raise
+            finally:
+                self.cond.notify_all()
+            return self.generation
+
+    def finish_checkpoint(self, generation, contents):
+        """
+        Writes the snapshot of the given generation (see rotate) and deletes
+        the log file it replaces
+        """
+        snapshot.write(self.snapshot_path, generation, contents)
+        os.remove(self.old_path)
+
+    def close(self):
+        """
+        Makes everything appended durable and closes the file
+        """
+        self.flush()
+        with self.cond:
+            while self.flushing:
+                self.cond.wait()
+            if self.fsync == NEVER:
+                os.fsync(self.fd)
+            self.closed = True # Under the lock, so that no rotation is halfway through
+            os.close(self.fd)
@@ -0,0 +1,194 @@
+# Counters and latency histograms for both the socket server and the gRPC
+# server in part2, exposed through the stats op, the Stats RPC and, with
+# --metrics-port, a Prometheus text endpoint on localhost.
+#
+# Recording is meant to stay on in production, so it only ever does a
+# bisect over a short list of bucket bounds and a couple of additions under
+# a lock that nothing else holds for longer than that. Every histogram has a
+# lock of its own, so requests for different ops never wait on each other.
+# Anything that would cost more, like the distribution of mailbox depths, is
+# worked out when the metrics are read rather than kept up to date.
+
+import bisect
+import http.server
+import threading
+import time
+from threading import Lock
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = [0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+# Upper bounds of the mailbox depth buckets, in messages
+DEPTH_BUCKETS = [0, 1, 10, 100, 1000, 10000]
+
+DELIVER = "deliver" # Pushes of messages to a subscriber, timed like an op
+
+class Histogram:
+    """
+    Counts observations into buckets with fixed upper bounds, and keeps
+    their sum
+    NOTE: bounds must be sorted. Anything above the last one lands in an
+    extra +Inf bucket. failures counts the observations of requests that
+    didn't succeed.
+    """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.failures = 0
+        self.lock = Lock()
+
+    def observe(self, value, success=True):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            if not success:
+                self.failures += 1
+
+    def read(self):
+        """
+        The (counts, sum, failures) so far, all from the same moment
+        """
+        with self.lock:
+            return list(self.counts), self.sum, self.failures
+
+class Metrics:
+    """
+    Everything one server records about itself
+    NOTE: ops are the names requests are timed under (ops for the socket
+    server, RPCs for the gRPC server). mailboxes, if given, is a Mailboxes
+    whose depths are read at render time.
+    """
+    def __init__(self, ops, mailboxes=None):
+        self.latency = {op: Histogram(LATENCY_BUCKETS) for op in ops}
+        self.mailboxes = mailboxes
+        self.lock = Lock() # Guards the counters below
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.sessions = 0 # Client connections open right now
+        self.delivered = 0 # Messages pushed to subscribers
+        self.started = time.time()
+
+    def observe(self, op, seconds, success=True):
+        """
+        Records how long a request for op took, and whether it succeeded
+        """
+        self.latency[op].observe(seconds, success)
+
+    def received(self, nbytes):
+        with self.lock:
+            self.bytes_in += nbytes
+
+    def sent(self, nbytes):
+        with self.lock:
+            self.bytes_out += nbytes
+
+    def session_started(self):
+        with self.lock:
+            self.sessions += 1
+
+    def session_ended(self):
+        with self.lock:
+            self.sessions -= 1
+
+    def deliver(self, seconds, count):
+        """
+        Records a push of count messages to a subscriber that took seconds
+        """
+        self.latency[DELIVER].observe(seconds)
+        with self.lock:
+            self.delivered += count
+
+    def render(self):
+        """
+        Every metric in the Prometheus text exposition format
+        """
+        lines = [
+            "# HELP chat_request_seconds Time spent handling requests, by op",
+            "# TYPE chat_request_seconds histogram",
+        ]
+        failures = []
+        for op, histogram in self.latency.items():
+            counts, total, failed = histogram.read()
+            lines.extend(histogram_lines("chat_request_seconds", 'op="{}",'.format(op), histogram.bounds, counts, total))
+            failures.append('chat_request_failures_total{{op="{}"}} {}'.format(op, failed))
+        lines.append("# HELP chat_request_failures_total Requests answered with success false, by op")
+        lines.append("# TYPE chat_request_failures_total counter")
+        lines.extend(failures)
+        with self.lock:
+            counters = [
+                ("chat_received_bytes_total", "counter", "Bytes read from connections", self.bytes_in),
+                ("chat_sent_bytes_total", "counter", "Bytes written to connections", self.bytes_out),
+                ("chat_sessions", "gauge", "Client connections open", self.sessions),
+                ("chat_delivered_messages_total", "counter", "Messages pushed to subscribers", self.delivered),
+            ]
+        counters.append(("chat_uptime_seconds", "gauge", "Seconds since the server started", round(time.time() - self.started, 3)))
+        for name, kind, description, value in counters:
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, kind))
+            lines.append("{} {}".format(name, value))
+        if self.mailboxes is not None:
+            depths = Histogram(DEPTH_BUCKETS)
+            for depth in self.mailboxes.depths():
+                depths.observe(depth)
+            counts, total, _ = depths.read()
+            lines.append("# HELP chat_mailbox_depth Messages waiting in each mailbox")
+            lines.append("# TYPE chat_mailbox_depth histogram")
+            lines.extend(histogram_lines("chat_mailbox_depth", "", depths.bounds, counts, total))
+        return "\n".join(lines) + "\n"
+
+def histogram_lines(name, labels, bounds, counts, total):
+    """
+    The cumulative bucket, sum and count lines of one histogram. labels are
+    put in front of the le label of each bucket.
+    """
+    lines = []
+    cumulative = 0
+    for bound, count in zip(bounds + ["+Inf"], counts):
+        cumulative += count
+        lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, bound, cumulative))
+    labels = "{{{}}}".format(labels.rstrip(",")) if labels else ""
+    lines.append("{}_sum{} {}".format(name, labels, total))
+    lines.append("{}_count{} {}".format(name, labels, cumulative))
+    return lines
+
+def parse(text):
+    """
+    The value of every sample in a rendered dump, by its name and labels
+    (e.g. 'chat_request_seconds_count{op="send"}')
+    """
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers every GET with the metrics of the server's Metrics
+    """
+    def do_GET(self):
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes would flood the console
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """
+    Serves the metrics in the Prometheus text format over HTTP, from a
+    daemon thread. Returns the HTTP server.
+    NOTE: Only listens on localhost by default, since the metrics name no
+    users but are nobody else's business either. With port 0 the OS picks a
+    free port, see server_address.
+    """
+    httpd = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    httpd.metrics = metrics
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
@@ -8,6 +8,9 @@ import pdb
 
 from concurrent.futures import ThreadPoolExecutor
 
+# Compression applied to every request (the server picks its own for responses)
+COMPRESSION = grpc.Compression.NoCompression
+
 # Helper function found here:
 # https://stackoverflow.com/questions/39969064/how-to-print-a-message-box-in-python
 def print_msg_box(msg, indent=1, width=None, title=None):
@@ -75,7 +78,7 @@ class Client:
         Helper function to check if the server is up
         """
         try:
-            self.stub.List(schema.ListRequest(wildcard=""))
+            next(self.stub.ListStream(schema.ListStreamRequest(wildcard="", page_size=1)))
             print_success("Connection to server is good")
             self.server_alive = True
         except:
@@ -173,13 +176,16 @@ class Client:
         NOTE: Expected to be run inside a safety_wrap
         """
         wildcard = input("> Input a text filter: ")
-        resp = self.stub.List(schema.ListRequest(wildcard=wildcard))
-        if not resp.success:
-            print_error("Error: {}".format(resp.error_message))
-            return
-        print_info("{} users matching '{}'".format(len(resp.accounts), wildcard))
-        for user in resp.accounts:
-            print(user.user_id)
+        user_ids = []
+        for page in self.stub.ListStream(schema.ListStreamRequest(wildcard=wildcard)):
+            if not page.success:
+                print_error("Error: {}".format(page.error_message))
+                return
+            user_ids.extend(user.user_id for user in page.accounts)
+        # Every page has to arrive before the count is known, and it is printed first
+        print_info("{} users matching '{}'".format(len(user_ids), wildcard))
+        for user_id in user_ids:
+            print(user_id)
 
     def handle_send(self):
         """
@@ -207,13 +213,83 @@ class Client:
             print_error("Error: {}".format(resp.error_message))
             return
         print_success("Success! Message sent")
+
+    def handle_join(self):
+        """
+        Joins a group, creating it if nobody is in it yet
+        NOTE: Expected to be run inside a safety_wrap
+        """
+        if not self.is_logged_in():
+            print_error("Error: You must be logged in to join a group")
+            return
+        group = input("> Group id: ")
+        if len(group) <= 0:
+            print_error("Error: Group id cannot be empty")
+            return
+        resp = self.stub.JoinGroup(schema.GroupRequest(user_id=self.user_id, group_id=group))
+        if not resp.success:
+            print_error("Error: {}".format(resp.error_message))
+            return
+        print_success("Success! Joined {}".format(group))
+
+    def handle_leave(self):
+        """
+        Leaves a group
+        NOTE: Expected to be run inside a safety_wrap
+        """
+        if not self.is_logged_in():
+            print_error("Error: You must be logged in to leave a group")
+            return
+        group = input("> Group id: ")
+        resp = self.stub.LeaveGroup(schema.GroupRequest(user_id=self.user_id, group_id=group))
+        if not resp.success:
+            print_error("Error: {}".format(resp.error_message))
+            return
+        print_success("Success! Left {}".format(group))
+
+    def handle_send_group(self):
+        """
+        Sends a message to every other member of a group
+        NOTE: Expected to be run inside a safety_wrap
+        """
+        if not self.is_logged_in():
+            print_error("Error: You must be logged in to send a message")
+            return
+        group = input("> Group id: ")
+        if len(group) <= 0:
+            print_error("Error: Group id cannot be empty")
+            return
+        text = input("> What would you like to say?\n")
+        if len(text) > 280:
+            print_error("Error: Message must be less than 280 characters")
+            return
+        resp = self.stub.SendGroup(schema.Message(
+            author_id=self.user_id,
+            recipient_id=group,
+            text=text
+        ))
+        if not resp.success:
+            print_error("Error: {}".format(resp.error_message))
+            return
+        print_success("Success! Message sent to {}".format(group))
+
+    def handle_stats(self):
+        """
+        Prints the server's metrics
+        NOTE: Expected to be run inside a safety_wrap
+        """
+        resp = self.stub.Stats(schema.BlankRequest())
+        if not resp.success:
+            print_error("Error: {}".format(resp.error_message))
+            return
+        print(resp.text)
     
     def safety_wrap(self, func):
         """
         Wraps a handler function in a try except block to handle
         errors and automatically deal with server health
-        NOTE: For simplicity, uses a simple list request with an empty
-        wildcard to check server health
+        NOTE: For simplicity, checks server health by asking for a single
+        page of one account
         """
         try:
             func()
@@ -232,13 +308,21 @@ class Client:
             return self.handle_list
         elif input_str == "send":
             return self.handle_send
+        elif input_str == "join":
+            return self.handle_join
+        elif input_str == "leave":
+            return self.handle_leave
+        elif input_str == "group":
+            return self.handle_send_group
+        elif input_str == "stats":
+            return self.handle_stats
         else:
             print_error("Error: Invalid command")
 
         return None
 
     def run(self):
-        with grpc.insecure_channel(input("Enter server ip address: ") + ':50051') as channel:
+        with grpc.insecure_channel(input("Enter server ip address: ") + ':50051', compression=COMPRESSION) as channel:
             self.stub = services.ChatHandlerStub(channel=channel)
             self.check_server_health()
             retry_multiplier = 1
@@ -13,7 +13,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0cschema.proto\x12\x04\x63hat\"\x1e\n\x0b\x43redentials\x12\x0f\n\x07user_id\x18\x01 \x01(\t\"0\n\x07\x41\x63\x63ount\x12\x0f\n\x07user_id\x18\x01 \x01(\t\x12\x14\n\x0cis_logged_in\x18\x02 \x01(\x08\"@\n\x07Message\x12\x11\n\tauthor_id\x18\x01 \x01(\t\x12\x14\n\x0crecipient_id\x18\x02 \x01(\t\x12\x0c\n\x04text\x18\x03 \x01(\t\"\x0e\n\x0c\x42lankRequest\"\x1f\n\x0bListRequest\x12\x10\n\x08wildcard\x18\x01 \x01(\t\"7\n\rBasicResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x15\n\rerror_message\x18\x02 \x01(\t\"W\n\x0cListResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x15\n\rerror_message\x18\x02 \x01(\t\x12\x1f\n\x08\x61\x63\x63ounts\x18\x03 \x03(\x0b\x32\r.chat.Account2\xae\x02\n\x0b\x43hatHandler\x12\x30\n\x06\x43reate\x12\x11.chat.Credentials\x1a\x13.chat.BasicResponse\x12/\n\x05Login\x12\x11.chat.Credentials\x1a\x13.chat.BasicResponse\x12\x30\n\x06\x44\x65lete\x12\x11.chat.Credentials\x1a\x13.chat.BasicResponse\x12/\n\tSubscribe\x12\x11.chat.Credentials\x1a\r.chat.Message0\x01\x12*\n\x04Send\x12\r.chat.Message\x1a\x13.chat.BasicResponse\x12-\n\x04List\x12\x11.chat.ListRequest\x1a\x12.chat.ListResponseb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0cschema.proto\x12\x04\x63hat\"\x1e\n\x0b\x43redentials\x12\x0f\n\x07user_id\x18\x01 \x01(\t\"0\n\x07\x41\x63\x63ount\x12\x0f\n\x07user_id\x18\x01 \x01(\t\x12\x14\n\x0cis_logged_in\x18\x02 \x01(\x08\"@\n\x07Message\x12\x11\n\tauthor_id\x18\x01 \x01(\t\x12\x14\n\x0crecipient_id\x18\x02 \x01(\t\x12\x0c\n\x04text\x18\x03 \x01(\t\"/\n\x0cMessageBatch\x12\x1f\n\x08messages\x18\x01 \x03(\x0b\x32\r.chat.Message\"\x0e\n\x0c\x42lankRequest\"1\n\x0cGroupRequest\x12\x0f\n\x07user_id\x18\x01 \x01(\t\x12\x10\n\x08group_id\x18\x02 \x01(\t\"\x1f\n\x0bListRequest\x12\x10\n\x08wildcard\x18\x01 \x01(\t\"H\n\x11ListStreamRequest\x12\x10\n\x08wildcard\x18\x01 \x01(\t\x12\x11\n\tpage_size\x18\x02 \x01(\r\x12\x0e\n\x06\x63ursor\x18\x03 \x01(\t\"7\n\rBasicResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x15\n\rerror_message\x18\x02 \x01(\t\"W\n\x0cListResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x15\n\rerror_message\x18\x02 \x01(\t\x12\x1f\n\x08\x61\x63\x63ounts\x18\x03 \x03(\x0b\x32\r.chat.Account\"c\n\x08ListPage\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x15\n\rerror_message\x18\x02 \x01(\t\x12\x1f\n\x08\x61\x63\x63ounts\x18\x03 \x03(\x0b\x32\r.chat.Account\x12\x0e\n\x06\x63ursor\x18\x04 \x01(\t\"I\n\rBatchResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x15\n\rerror_message\x18\x02 \x01(\t\x12\x10\n\x08statuses\x18\x03 \x03(\x08\"E\n\rStatsResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x15\n\rerror_message\x18\x02 \x01(\t\x12\x0c\n\x04text\x18\x03 \x01(\t2\xed\x04\n\x0b\x43hatHandler\x12\x30\n\x06\x43reate\x12\x11.chat.Credentials\x1a\x13.chat.BasicResponse\x12/\n\x05Login\x12\x11.chat.Credentials\x1a\x13.chat.BasicResponse\x12\x30\n\x06\x44\x65lete\x12\x11.chat.Credentials\x1a\x13.chat.BasicResponse\x12/\n\tSubscribe\x12\x11.chat.Credentials\x1a\r.chat.Message0\x01\x12*\n\x04Send\x12\r.chat.Message\x1a\x13.chat.BasicResponse\x12\x34\n\tSendBatch\x12\x12.chat.MessageBatch\x1a\x13.chat.BatchResponse\x12-\n\x04List\x12\x11.chat.ListRequest\x1a\x12.chat.ListResponse\x12\x37\n\nListStream\x12\x17.chat.ListStreamRequest\x1a\x0e.chat.ListPage0\x01\x12\x30\n\x05Stats\x12\x12.chat.BlankRequest\x1a\x13.chat.StatsResponse\x12\x34\n\tJoinGroup\x12\x12.chat.GroupRequest\x1a\x13.chat.BasicResponse\x12\x35\n\nLeaveGroup\x12\x12.chat.GroupRequest\x1a\x13.chat.BasicResponse\x12/\n\tSendGroup\x12\r.chat.Message\x1a\x13.chat.BasicResponseb\x06proto3')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'schema_pb2', globals())
@@ -26,14 +26,26 @@ if _descriptor._USE_C_DESCRIPTORS == False:
   _ACCOUNT._serialized_end=102
   _MESSAGE._serialized_start=104
   _MESSAGE._serialized_end=168
-  _BLANKREQUEST._serialized_start=170
-  _BLANKREQUEST._serialized_end=184
-  _LISTREQUEST._serialized_start=186
-  _LISTREQUEST._serialized_end=217
-  _BASICRESPONSE._serialized_start=219
-  _BASICRESPONSE._serialized_end=274
-  _LISTRESPONSE._serialized_start=276
-  _LISTRESPONSE._serialized_end=363
-  _CHATHANDLER._serialized_start=366
-  _CHATHANDLER._serialized_end=668
+  _MESSAGEBATCH._serialized_start=170
+  _MESSAGEBATCH._serialized_end=217
+  _BLANKREQUEST._serialized_start=219
+  _BLANKREQUEST._serialized_end=233
+  _GROUPREQUEST._serialized_start=235
+  _GROUPREQUEST._serialized_end=284
+  _LISTREQUEST._serialized_start=286
+  _LISTREQUEST._serialized_end=317
+  _LISTSTREAMREQUEST._serialized_start=319
+  _LISTSTREAMREQUEST._serialized_end=391
+  _BASICRESPONSE._serialized_start=393
+  _BASICRESPONSE._serialized_end=448
+  _LISTRESPONSE._serialized_start=450
+  _LISTRESPONSE._serialized_end=537
+  _LISTPAGE._serialized_start=539
+  _LISTPAGE._serialized_end=638
+  _BATCHRESPONSE._serialized_start=640
+  _BATCHRESPONSE._serialized_end=713
+  _STATSRESPONSE._serialized_start=715
+  _STATSRESPONSE._serialized_end=784
+  _CHATHANDLER._serialized_start=787
+  _CHATHANDLER._serialized_end=1408
 # @@protoc_insertion_point(module_scope)
@@ -21,6 +21,16 @@ class BasicResponse(_message.Message):
     success: bool
     def __init__(self, success: bool = ..., error_message: _Optional[str] = ...) -> None: ...
 
+class BatchResponse(_message.Message):
+    __slots__ = ["error_message", "statuses", "success"]
+    ERROR_MESSAGE_FIELD_NUMBER: _ClassVar[int]
+    STATUSES_FIELD_NUMBER: _ClassVar[int]
+    SUCCESS_FIELD_NUMBER: _ClassVar[int]
+    error_message: str
+    statuses: _containers.RepeatedScalarFieldContainer[bool]
+    success: bool
+    def __init__(self, success: bool = ..., error_message: _Optional[str] = ..., statuses: _Optional[_Iterable[bool]] = ...) -> None: ...
+
 class BlankRequest(_message.Message):
     __slots__ = []
     def __init__(self) -> None: ...
@@ -31,6 +41,26 @@ class Credentials(_message.Message):
     user_id: str
     def __init__(self, user_id: _Optional[str] = ...) -> None: ...
 
+class GroupRequest(_message.Message):
+    __slots__ = ["group_id", "user_id"]
+    GROUP_ID_FIELD_NUMBER: _ClassVar[int]
+    USER_ID_FIELD_NUMBER: _ClassVar[int]
+    group_id: str
+    user_id: str
+    def __init__(self, user_id: _Optional[str] = ..., group_id: _Optional[str] = ...) -> None: ...
+
+class ListPage(_message.Message):
+    __slots__ = ["accounts", "cursor", "error_message", "success"]
+    ACCOUNTS_FIELD_NUMBER: _ClassVar[int]
+    CURSOR_FIELD_NUMBER: _ClassVar[int]
+    ERROR_MESSAGE_FIELD_NUMBER: _ClassVar[int]
+    SUCCESS_FIELD_NUMBER: _ClassVar[int]
+    accounts: _containers.RepeatedCompositeFieldContainer[Account]
+    cursor: str
+    error_message: str
+    success: bool
+    def __init__(self, success: bool = ..., error_message: _Optional[str] = ..., accounts: _Optional[_Iterable[_Union[Account, _Mapping]]] = ..., cursor: _Optional[str] = ...) -> None: ...
+
 class ListRequest(_message.Message):
     __slots__ = ["wildcard"]
     WILDCARD_FIELD_NUMBER: _ClassVar[int]
@@ -47,6 +77,16 @@ class ListResponse(_message.Message):
     success: bool
     def __init__(self, success: bool = ..., error_message: _Optional[str] = ..., accounts: _Optional[_Iterable[_Union[Account, _Mapping]]] = ...) -> None: ...
 
+class ListStreamRequest(_message.Message):
+    __slots__ = ["cursor", "page_size", "wildcard"]
+    CURSOR_FIELD_NUMBER: _ClassVar[int]
+    PAGE_SIZE_FIELD_NUMBER: _ClassVar[int]
+    WILDCARD_FIELD_NUMBER: _ClassVar[int]
+    cursor: str
+    page_size: int
+    wildcard: str
+    def __init__(self, wildcard: _Optional[str] = ..., page_size: _Optional[int] = ..., cursor: _Optional[str] = ...) -> None: ...
+
 class Message(_message.Message):
     __slots__ = ["author_id", "recipient_id", "text"]
     AUTHOR_ID_FIELD_NUMBER: _ClassVar[int]
@@ -56,3 +96,19 @@ class Message(_message.Message):
     recipient_id: str
     text: str
     def __init__(self, author_id: _Optional[str] = ..., recipient_id: _Optional[str] = ..., text: _Optional[str] = ...) -> None: ...
+
+class MessageBatch(_message.Message):
+    __slots__ = ["messages"]
+    MESSAGES_FIELD_NUMBER: _ClassVar[int]
+    messages: _containers.RepeatedCompositeFieldContainer[Message]
+    def __init__(self, messages: _Optional[_Iterable[_Union[Message, _Mapping]]] = ...) -> None: ...
+
+class StatsResponse(_message.Message):
+    __slots__ = ["error_message", "success", "text"]
+    ERROR_MESSAGE_FIELD_NUMBER: _ClassVar[int]
+    SUCCESS_FIELD_NUMBER: _ClassVar[int]
+    TEXT_FIELD_NUMBER: _ClassVar[int]
+    error_message: str
+    success: bool
+    text: str
+    def __init__(self, success: bool = ..., error_message: _Optional[str] = ..., text: _Optional[str] = ...) -> None: ...
@@ -40,11 +40,41 @@ class ChatHandlerStub(object):
                 request_serializer=schema__pb2.Message.SerializeToString,
                 response_deserializer=schema__pb2.BasicResponse.FromString,
                 )
+        self.SendBatch = channel.unary_unary(
+                '/chat.ChatHandler/SendBatch',
+                request_serializer=schema__pb2.MessageBatch.SerializeToString,
+                response_deserializer=schema__pb2.BatchResponse.FromString,
+                )
         self.List = channel.unary_unary(
                 '/chat.ChatHandler/List',
                 request_serializer=schema__pb2.ListRequest.SerializeToString,
                 response_deserializer=schema__pb2.ListResponse.FromString,
                 )
+        self.ListStream = channel.unary_stream(
+                '/chat.ChatHandler/ListStream',
+                request_serializer=schema__pb2.ListStreamRequest.SerializeToString,
+                response_deserializer=schema__pb2.ListPage.FromString,
+                )
+        self.Stats = channel.unary_unary(
+                '/chat.ChatHandler/Stats',
+                request_serializer=schema__pb2.BlankRequest.SerializeToString,
+                response_deserializer=schema__pb2.StatsResponse.FromString,
+                )
+        self.JoinGroup = channel.unary_unary(
+                '/chat.ChatHandler/JoinGroup',
+                request_serializer=schema__pb2.GroupRequest.SerializeToString,
+                response_deserializer=schema__pb2.BasicResponse.FromString,
+                )
+        self.LeaveGroup = channel.unary_unary(
+                '/chat.ChatHandler/LeaveGroup',
+                request_serializer=schema__pb2.GroupRequest.SerializeToString,
+                response_deserializer=schema__pb2.BasicResponse.FromString,
+                )
+        self.SendGroup = channel.unary_unary(
+                '/chat.ChatHandler/SendGroup',
+                request_serializer=schema__pb2.Message.SerializeToString,
+                response_deserializer=schema__pb2.BasicResponse.FromString,
+                )
 
 
 class ChatHandlerServicer(object):
@@ -81,12 +111,49 @@ class ChatHandlerServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def SendBatch(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def List(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def ListStream(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Stats(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def JoinGroup(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def LeaveGroup(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def SendGroup(self, request, context):
+        """Sends to every member of the group named by recipient_id
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_ChatHandlerServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -115,11 +182,41 @@ def add_ChatHandlerServicer_to_server(servicer, server):
                     request_deserializer=schema__pb2.Message.FromString,
                     response_serializer=schema__pb2.BasicResponse.SerializeToString,
             ),
+            'SendBatch': grpc.unary_unary_rpc_method_handler(
+                    servicer.SendBatch,
+                    request_deserializer=schema__pb2.MessageBatch.FromString,
+                    response_serializer=schema__pb2.BatchResponse.SerializeToString,
+            ),
             'List': grpc.unary_unary_rpc_method_handler(
                     servicer.List,
                     request_deserializer=schema__pb2.ListRequest.FromString,
                     response_serializer=schema__pb2.ListResponse.SerializeToString,
             ),
+            'ListStream': grpc.unary_stream_rpc_method_handler(
+                    servicer.ListStream,
+                    request_deserializer=schema__pb2.ListStreamRequest.FromString,
+                    response_serializer=schema__pb2.ListPage.SerializeToString,
+            ),
+            'Stats': grpc.unary_unary_rpc_method_handler(
+                    servicer.Stats,
+                    request_deserializer=schema__pb2.BlankRequest.FromString,
+                    response_serializer=schema__pb2.StatsResponse.SerializeToString,
+            ),
+            'JoinGroup': grpc.unary_unary_rpc_method_handler(
+                    servicer.JoinGroup,
+                    request_deserializer=schema__pb2.GroupRequest.FromString,
+                    response_serializer=schema__pb2.BasicResponse.SerializeToString,
+            ),
+            'LeaveGroup': grpc.unary_unary_rpc_method_handler(
+                    servicer.LeaveGroup,
+                    request_deserializer=schema__pb2.GroupRequest.FromString,
+                    response_serializer=schema__pb2.BasicResponse.SerializeToString,
+            ),
+            'SendGroup': grpc.unary_unary_rpc_method_handler(
+                    servicer.SendGroup,
+                    request_deserializer=schema__pb2.Message.FromString,
+                    response_serializer=schema__pb2.BasicResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'chat.ChatHandler', rpc_method_handlers)
@@ -216,6 +313,23 @@ class ChatHandler(object):
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
+    @staticmethod
+    def SendBatch(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chat.ChatHandler/SendBatch',
+            schema__pb2.MessageBatch.SerializeToString,
+            schema__pb2.BatchResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
     @staticmethod
     def List(request,
             target,
@@ -232,3 +346,88 @@ class ChatHandler(object):
             schema__pb2.ListResponse.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def ListStream(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/chat.ChatHandler/ListStream',
+            schema__pb2.ListStreamRequest.SerializeToString,
+            schema__pb2.ListPage.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def Stats(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chat.ChatHandler/Stats',
+            schema__pb2.BlankRequest.SerializeToString,
+            schema__pb2.StatsResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def JoinGroup(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chat.ChatHandler/JoinGroup',
+            schema__pb2.GroupRequest.SerializeToString,
+            schema__pb2.BasicResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def LeaveGroup(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chat.ChatHandler/LeaveGroup',
+            schema__pb2.GroupRequest.SerializeToString,
+            schema__pb2.BasicResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def SendGroup(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chat.ChatHandler/SendGroup',
+            schema__pb2.Message.SerializeToString,
+            schema__pb2.BasicResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
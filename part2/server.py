@@ -1,6 +1,12 @@
 # echo-server.py
 
-from threading import Event, Lock
+import argparse
+import base64
+import binascii
+import functools
+import os
+import sys
+from threading import Event
 from concurrent import futures
 
 import grpc
@@ -9,22 +15,164 @@ import schema_pb2_grpc as services
 import time
 import pdb
 
+# The mailboxes are shared with the socket server in the parent folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import groups
+import mailboxes
+import message_log
+import metrics
+import user_registry
+
+PORT = 50051 # Port to listen on by default
+
+# The page size of ListStream when the client leaves it at 0, and the largest
+# a client may ask for
+DEFAULT_LIST_PAGE_SIZE = 100
+MAX_LIST_PAGE_SIZE = 1000
+
+def encode_cursor(user_id):
+    """
+    The cursor resuming a listing after the given user_id. Clients should
+    treat it as opaque.
+    """
+    return base64.urlsafe_b64encode(user_id.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    """
+    The user_id a cursor resumes after. Raises ValueError for a cursor this
+    server didn't make.
+    """
+    try:
+        user_id = base64.b64decode(cursor.encode("ascii"), altchars=b"-_", validate=True).decode("utf-8")
+    except (binascii.Error, UnicodeError) as e:
+        raise ValueError("Invalid cursor") from e
+    if not user_id:
+        raise ValueError("Invalid cursor")
+    return user_id
+
+def timed(rpc):
+    """
+    Records how long each call of a unary RPC takes, whether it succeeded and
+    the size of its request and response in the servicer's metrics
+    NOTE: Sizes are those of the protobuf messages, without gRPC's framing
+    """
+    @functools.wraps(rpc)
+    def wrapper(self, request, context):
+        start = time.perf_counter()
+        resp = rpc(self, request, context)
+        self.metrics.observe(rpc.__name__, time.perf_counter() - start, resp.success)
+        self.metrics.received(request.ByteSize())
+        self.metrics.sent(resp.ByteSize())
+        return resp
+    return wrapper
+
+class SerializedMessage:
+    """
+    A message kept in a mailbox already serialized, so that Subscribe hands
+    the same bytes to gRPC however many times (or to however many members of
+    a group) it is delivered. The fields are kept too, for the log and the
+    tests.
+    """
+    __slots__ = ("author_id", "recipient_id", "text", "wire")
+
+    def __init__(self, msg):
+        self.author_id = msg.author_id
+        self.recipient_id = msg.recipient_id
+        self.text = msg.text
+        self.wire = msg.SerializeToString()
+
+    def ByteSize(self):
+        return len(self.wire)
+
+def serialize_message(msg):
+    """
+    Serializes a message Subscribe yields, passing a SerializedMessage's
+    bytes through as they are
+    """
+    if isinstance(msg, SerializedMessage):
+        return msg.wire
+    return msg.SerializeToString()
+
+def subscribe_handler(servicer):
+    """
+    The servicer's Subscribe with serialize_message as its response
+    serializer. Added to the server before the generated handlers, it is the
+    one gRPC finds.
+    """
+    return grpc.method_handlers_generic_handler("chat.ChatHandler", {
+        "Subscribe": grpc.unary_stream_rpc_method_handler(
+            servicer.Subscribe,
+            request_deserializer=schema.Credentials.FromString,
+            response_serializer=serialize_message,
+        ),
+    })
+
+# The RPCs timed by @timed, plus Subscribe's deliveries
+TIMED_RPCS = ["Create", "Login", "Delete", "List", "Send", "SendBatch", "Stats", "JoinGroup", "LeaveGroup", "SendGroup", metrics.DELIVER]
+
 class ChatHandlerServicer(object):
     """
     The service handler for the chat server.
     """
 
-    def __init__(self, executor):
+    def __init__(self, executor, mailbox_capacity=None, overflow=mailboxes.REJECT, user_shards=user_registry.DEFAULT_SHARDS, log_path=None, fsync=message_log.ALWAYS, checkpoint_interval=mailboxes.DEFAULT_CHECKPOINT_INTERVAL, metrics_port=None, preencode=False):
         """
         Initialize the service handler.
+        NOTE: mailbox_capacity and overflow limit how many messages wait for
+        each user and what happens beyond that (see mailboxes.py).
+        user_shards is the number of independently locked shards of users.
+        With a log_path, accounts and messages are logged there (see
+        message_log.py) and recovered from it on startup, fsync is the log's
+        fsync policy and checkpoint_interval is how often (in seconds) the log
+        is replaced by a snapshot. With a metrics_port, the metrics are also
+        served over HTTP on localhost (see metrics.py). With preencode,
+        messages are serialized once when sent and kept that way in the
+        mailboxes (see SerializedMessage).
         """
         self.executor = executor
-        self.users = {}
-        self.user_lock = Lock()
-        self.msgs_cache = {}
-        self.msgs_lock = Lock()
-        self.user_events = {}
+        self.preencode = preencode
+        self.users = user_registry.UserRegistry(user_shards)
+        self.msgs_cache = mailboxes.Mailboxes(mailbox_capacity, overflow)
+        self.groups = groups.Groups(self.users)
+        self.user_events = {} # user_id -> Event of their open Subscribe, only while there is one
+        self.log = None
+        if log_path is not None:
+            self.log = message_log.MessageLog(log_path, fsync)
+            make_message = lambda author_id, recipient_id, text_bytes : self.stored(schema.Message(author_id=author_id, recipient_id=recipient_id, text=str(text_bytes, "utf-8")))
+            for user_id in self.msgs_cache.attach(self.log, make_message, checkpoint_interval):
+                # Everyone starts logged out after a restart
+                self.users.add(schema.Account(user_id=user_id, is_logged_in=False))
+        self.metrics = metrics.Metrics(TIMED_RPCS, self.msgs_cache)
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = metrics.serve_metrics(self.metrics, metrics_port)
+
+    def stored(self, msg):
+        """
+        The message as it is kept in a mailbox: serialized already with
+        preencode, as is otherwise
+        """
+        if self.preencode:
+            return SerializedMessage(msg)
+        return msg
+
+    def wake(self, user_id):
+        """
+        Sets the event of the user's open Subscribe, if there is one
+        """
+        event = self.user_events.get(user_id)
+        if event is not None:
+            event.set()
+
+    def commit_log(self):
+        """
+        Waits until every change logged so far is durable, so that a
+        response never promises more than a crash would leave behind
+        """
+        if self.log is not None:
+            self.log.commit()
 
+    @timed
     def Create(self, request, context):
         """
         Creates a new account. Fails if the user_id already exists.
@@ -32,22 +180,22 @@ class ChatHandlerServicer(object):
         Subscribe method, which sets up necessary precautions for
         sudden disconnects.
         """
-        with self.user_lock:
+        with self.users.lock(request.user_id):
             if request.user_id in self.users:
                 return  schema.BasicResponse(success=False, error_message="user_id already exists")
             new_account = schema.Account(user_id=request.user_id, is_logged_in=True)
-            self.users[new_account.user_id] = new_account
-            self.user_events[new_account.user_id] = Event()
-        with self.msgs_lock:
-            self.msgs_cache[new_account.user_id] = []
+            self.users.add(new_account)
+        self.msgs_cache.create(new_account.user_id)
+        self.commit_log()
         return schema.BasicResponse(success=True, error_message="")
     
+    @timed
     def Login(self, request, context):
         """
         Logs in an existing account. Fails if the user_id does not exist or
         if the user is already logged in.
         """
-        with self.user_lock:
+        with self.users.lock(request.user_id):
             if request.user_id in self.users:
                 if self.users[request.user_id].is_logged_in:
                     return schema.BasicResponse(success=False, error_message="user_id already logged in")
@@ -55,30 +203,54 @@ class ChatHandlerServicer(object):
                 return schema.BasicResponse(success=True, error_message="")
             return schema.BasicResponse(success=False, error_message="user_id does not exist. Try creating an account.")
     
+    @timed
     def List(self, request, context):
         """
         Lists all accounts that match the given wildcard.
         NOTE: "" will match all accounts. Other strings will simply use
         Python's built-in "in" operator.
+        NOTE: Accounts are listed in user_id order, and found through the
+        registry's substring index rather than by scanning every account
         """
-        with self.user_lock:
-            satisfying = filter(lambda user : request.wildcard in user.user_id, self.users.values())
-        return schema.ListResponse(success=True, accounts=satisfying)
+        return schema.ListResponse(success=True, accounts=self.users.find(request.wildcard))
 
+    def ListStream(self, request, context):
+        """
+        Streams the accounts that match the given wildcard a page at a time,
+        in user_id order. Each page carries a cursor that resumes the listing
+        after it (empty on the last page), so a client can stop and pick up
+        later, e.g. after a dropped connection.
+        NOTE: Pages are only looked up as the client reads them, so a huge
+        listing never holds more than one page in memory
+        """
+        page_size = min(request.page_size or DEFAULT_LIST_PAGE_SIZE, MAX_LIST_PAGE_SIZE)
+        after = None
+        if request.cursor:
+            try:
+                after = decode_cursor(request.cursor)
+            except ValueError as e:
+                yield schema.ListPage(success=False, error_message=str(e))
+                return
+        for accounts, resume_after in self.users.pages(request.wildcard, page_size, after):
+            cursor = "" if resume_after is None else encode_cursor(resume_after)
+            yield schema.ListPage(success=True, accounts=accounts, cursor=cursor)
+
+    @timed
     def Delete(self, request, context):
         """
         Deletes an existing account. Fails if the user_id does not exist.
         """
-        with self.user_lock:
+        with self.users.lock(request.user_id):
             if not request.user_id in self.users:
                 return schema.BasicResponse(success=False, error_message="user_id does not exist.")
             self.users[request.user_id].is_logged_in = False
-            self.user_events[request.user_id].set()
-            del self.users[request.user_id]
-            del self.user_events[request.user_id]
-        with self.msgs_lock:
-            del self.msgs_cache[request.user_id]
-        
+            event = self.user_events.pop(request.user_id, None)
+            if event is not None:
+                event.set()
+            self.users.remove(request.user_id)
+            self.groups.leave_all(request.user_id)
+        self.msgs_cache.delete(request.user_id)
+        self.commit_log()
         return schema.BasicResponse(success=True, error_message="")
     
     def Subscribe(self, request, context):
@@ -88,45 +260,58 @@ class ChatHandlerServicer(object):
         NOTE: While technically "log" in may succeed for multiple users,
         we enforce that only one subscribe thread can be active at a time
         for a given user.
+        NOTE: The user's event is only created here, so that users who aren't
+        subscribed don't hold one
         """
-        with self.user_lock:
+        event = Event()
+        event.set() # So that whatever is already waiting goes out first
+        with self.users.lock(request.user_id):
             if not request.user_id in self.users:
                 return schema.BasicResponse(success=False, error_message="user_id does not exist.")
             if not self.users[request.user_id].is_logged_in:
                 raise Exception("Must be logged in to subscribe")
+            self.user_events[request.user_id] = event
 
         # Helper function to clean up when a client disconnects
         def log_out():
-            with self.user_lock:
-                self.users[request.user_id].is_logged_in = False
-            self.user_events[request.user_id].set()
+            with self.users.lock(request.user_id):
+                account = self.users.get(request.user_id)
+                if account is not None: # Unless deleted since
+                    account.is_logged_in = False
+                if self.user_events.get(request.user_id) is event:
+                    del self.user_events[request.user_id]
+            event.set()
         context.add_callback(log_out)
 
         # Block until there is a message, then yield it to client and repeat
+        # NOTE: An open subscription counts as a session in the metrics
         is_logged_in = False
-        with self.user_lock:
+        with self.users.lock(request.user_id):
             is_logged_in = self.users[request.user_id].is_logged_in
+        self.metrics.session_started()
+        context.add_callback(self.metrics.session_ended)
         while is_logged_in:
             try:
-                self.user_events[request.user_id].wait()
-                self.user_events[request.user_id].clear()
-                sending = []
-                with self.msgs_lock:
-                    while len(self.msgs_cache[request.user_id]) > 0:
-                        sending.append(self.msgs_cache[request.user_id][0])
-                        self.msgs_cache[request.user_id] = self.msgs_cache[request.user_id][1:]
+                event.wait()
+                event.clear()
+                start = time.perf_counter()
+                sending = self.msgs_cache[request.user_id].take()
+                if sending:
+                    self.metrics.deliver(time.perf_counter() - start, len(sending))
                 for msg in sending:
+                    self.metrics.sent(msg.ByteSize())
                     yield msg
-                with self.user_lock:
+                with self.users.lock(request.user_id):
                     is_logged_in = self.users[request.user_id].is_logged_in
             except:
                 self.users[request.user_id].is_logged_in = False
-                self.user_events[request.user_id].clear()
+                event.clear()
                 break
 
         
         return schema.BasicResponse(success=False, error_message="subscription thread dying.")
 
+    @timed
     def Send(self, request, context):
         """
         Sends a message to a recipient. Fails if either the recipient or
@@ -135,24 +320,145 @@ class ChatHandlerServicer(object):
         the subscribe thread handles delivery immediately, or the next
         time the recipient logs in/subscribes, they will receive the message.
         """
-        with self.user_lock:
-            if not request.author_id in self.users:
-                return schema.BasicResponse(success=False, error_message="Author does not exist")
-        with self.msgs_lock:
-            if not request.recipient_id in self.msgs_cache:
-                return schema.BasicResponse(success=False, error_message="Recipient does not exist")
-            self.msgs_cache[request.recipient_id].append(request)
-            self.user_events[request.recipient_id].set()
-            return schema.BasicResponse(success=True, error_message="")
-
-def serve():
-    executor = futures.ThreadPoolExecutor()
-    server = grpc.server(executor)
-    services.add_ChatHandlerServicer_to_server(
-        ChatHandlerServicer(executor), server)
-    server.add_insecure_port('[::]:50051')
+        if not request.author_id in self.users:
+            return schema.BasicResponse(success=False, error_message="Author does not exist")
+        mailbox = self.msgs_cache.get(request.recipient_id)
+        if mailbox is None:
+            return schema.BasicResponse(success=False, error_message="Recipient does not exist")
+        if not mailbox.put(self.stored(request)):
+            return schema.BasicResponse(success=False, error_message="Mailbox is full")
+        self.commit_log()
+        self.wake(request.recipient_id)
+        return schema.BasicResponse(success=True, error_message="")
+
+    @timed
+    def SendBatch(self, request, context):
+        """
+        Sends many messages at once. Fails if the author does not exist.
+        Messages are grouped by recipient so that each mailbox is appended
+        to under a single lock acquisition, and the response carries one
+        status per message (False if its recipient does not exist or their
+        mailbox is full).
+        """
+        if not all(msg.author_id in self.users for msg in request.messages):
+            return schema.BatchResponse(success=False, error_message="Author does not exist", statuses=[False] * len(request.messages))
+        statuses = [False] * len(request.messages)
+        missing = False
+        by_recipient = {}
+        for i, msg in enumerate(request.messages):
+            by_recipient.setdefault(msg.recipient_id, []).append(i)
+        for recipient_id, indices in by_recipient.items():
+            mailbox = self.msgs_cache.get(recipient_id)
+            if mailbox is None:
+                missing = True
+                continue
+            # A full mailbox may only take the first few
+            accepted = mailbox.put_many([self.stored(request.messages[i]) for i in indices])
+            for i in indices[:accepted]:
+                statuses[i] = True
+            if accepted > 0:
+                self.wake(recipient_id)
+        self.commit_log()
+        if all(statuses):
+            return schema.BatchResponse(success=True, error_message="", statuses=statuses)
+        error_message = "Some recipients do not exist" if missing else "Some mailboxes are full"
+        return schema.BatchResponse(success=False, error_message=error_message, statuses=statuses)
+
+    @timed
+    def JoinGroup(self, request, context):
+        """
+        Adds the user to a group, creating the group if nobody is in it yet.
+        Fails if the user_id does not exist or is in the group already.
+        """
+        with self.users.lock(request.user_id):
+            if not request.user_id in self.users:
+                return schema.BasicResponse(success=False, error_message="user_id does not exist.")
+            if not self.groups.join(request.group_id, request.user_id):
+                return schema.BasicResponse(success=False, error_message="Already in group")
+        return schema.BasicResponse(success=True, error_message="")
+
+    @timed
+    def LeaveGroup(self, request, context):
+        """
+        Takes the user out of a group. Fails if they are not in it.
+        """
+        if not self.groups.leave(request.group_id, request.user_id):
+            return schema.BasicResponse(success=False, error_message="Not in group")
+        return schema.BasicResponse(success=True, error_message="")
+
+    @timed
+    def SendGroup(self, request, context):
+        """
+        Sends a message to every member of the group named by recipient_id,
+        except its author. Every member's mailbox gets this same Message (see
+        groups.py), so it is delivered with the group as its recipient.
+        Fails if the author or the group does not exist, or if some member's
+        mailbox is full (everyone else still gets the message).
+        """
+        if not request.author_id in self.users:
+            return schema.BasicResponse(success=False, error_message="Author does not exist")
+        result = self.groups.fan_out(request.recipient_id, self.stored(request), self.msgs_cache, skip=request.author_id)
+        if result is None:
+            return schema.BasicResponse(success=False, error_message="Group does not exist")
+        delivered, refused = result
+        self.commit_log()
+        for user_id in delivered:
+            self.wake(user_id)
+        if refused > 0:
+            return schema.BasicResponse(success=False, error_message="Some mailboxes are full")
+        return schema.BasicResponse(success=True, error_message="")
+
+    @timed
+    def Stats(self, request, context):
+        """
+        Reports the server's metrics, in the same text format as the metrics
+        port (see metrics.py)
+        """
+        return schema.StatsResponse(success=True, error_message="", text=self.metrics.render())
+
+# Compression applied to every response (clients pick their own for requests)
+COMPRESSIONS = {
+    "none": grpc.Compression.NoCompression,
+    "deflate": grpc.Compression.Deflate,
+    "gzip": grpc.Compression.Gzip,
+}
+
+# A dead client's Subscribe would otherwise stay open (and the user logged in)
+# for good, so the server pings any connection that has been quiet for a
+# while and drops it if the ping goes unanswered, which ends its calls. This
+# is the gRPC counterpart of the socket server's idle timeout (see idle.py).
+KEEPALIVE_OPTIONS = [
+    ("grpc.keepalive_time_ms", 20000), # Ping after this long without hearing from the client
+    ("grpc.keepalive_timeout_ms", 10000), # Drop the connection if the ping isn't answered by then
+    ("grpc.keepalive_permit_without_calls", 1),
+]
+
+def serve(compression="none", mailbox_capacity=None, overflow=mailboxes.REJECT, log_path=None, fsync=message_log.ALWAYS, checkpoint_interval=mailboxes.DEFAULT_CHECKPOINT_INTERVAL, metrics_port=None, port=PORT, workers=None, preencode=False):
+    """
+    Serves the chat service until terminated
+    NOTE: Every open Subscribe holds one of the worker threads, so workers
+    has to be larger than the number of users online at once
+    """
+    executor = futures.ThreadPoolExecutor(max_workers=workers)
+    server = grpc.server(executor, compression=COMPRESSIONS[compression], options=KEEPALIVE_OPTIONS)
+    servicer = ChatHandlerServicer(executor, mailbox_capacity=mailbox_capacity, overflow=overflow, log_path=log_path, fsync=fsync, checkpoint_interval=checkpoint_interval, metrics_port=metrics_port, preencode=preencode)
+    server.add_generic_rpc_handlers((subscribe_handler(servicer),))
+    services.add_ChatHandlerServicer_to_server(servicer, server)
+    server.add_insecure_port('[::]:{}'.format(port))
     server.start()
     server.wait_for_termination()
 
 if __name__ == '__main__':
-    serve()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--compression", choices=COMPRESSIONS.keys(), default="none", help="compression applied to responses")
+    parser.add_argument("--mailbox-capacity", type=int, default=None, help="most messages waiting for each user (default: unlimited)")
+    parser.add_argument("--overflow", choices=mailboxes.OVERFLOW_POLICIES, default=mailboxes.REJECT, help="what a full mailbox does with new messages")
+    parser.add_argument("--log", default=None, help="file to log accounts and messages to, and recover them from on startup (default: keep them in memory only)")
+    parser.add_argument("--fsync", choices=message_log.FSYNC_POLICIES, default=message_log.ALWAYS, help="when the log is flushed to disk")
+    parser.add_argument("--checkpoint-interval", type=float, default=mailboxes.DEFAULT_CHECKPOINT_INTERVAL, help="seconds between snapshots of the logged state")
+    parser.add_argument("--metrics-port", type=int, default=None, help="localhost port to serve Prometheus metrics on")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=None, help="most RPCs served at once, including open subscriptions")
+    parser.add_argument("--preencode", action="store_true", help="serialize each message once when it is sent, rather than on every delivery")
+    args = parser.parse_args()
+    serve(args.compression, args.mailbox_capacity, args.overflow, args.log, args.fsync, args.checkpoint_interval, args.metrics_port, args.port, args.workers, args.preencode)
\ No newline at end of file
@@ -1,26 +1,74 @@
+# Every class here declares __slots__, so that its instances carry their
+# fields and nothing else, rather than a __dict__ each. A server holding
+# millions of accounts and waiting messages spends most of its memory on
+# these objects (see benchmarks/memory_footprint.py). The type of a Message
+# or Response is a class attribute for the same reason.
+
+import sys
+
+def fields(obj):
+    """
+    Every field of a schema object (and its type) as a dict, which is what
+    vars() gave before the classes had __slots__. Handy for comparing them.
+    """
+    out = {"type": obj.type} if hasattr(obj, "type") else {}
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, "__slots__", ()):
+            out[name] = getattr(obj, name)
+    return out
 
 class Account:
     """
     A class for users
+    NOTE: The user_id is interned, so that the registry, the mailboxes and
+    every message to or from the user share one copy of it
     """
+    __slots__ = ("user_id", "is_logged_in")
+
     def __init__(self, user_id, is_logged_in):
-        self.user_id = user_id
+        self.user_id = sys.intern(user_id)
         self.is_logged_in = is_logged_in
 
 class Message:
     """
     A class for messages sent from server -> client
+    NOTE: A message forwarded straight from a send request can be created with
+    text=None and the UTF-8 encoded text in text_bytes instead, in which case
+    the text is only decoded if something actually reads it
+    NOTE: A server that pre-encodes messages stores their version 1 wire
+    encoding in wire when they are sent (see coding.preencode)
+    NOTE: The author_id and recipient_id are interned like Account.user_id,
+    so that waiting messages don't each hold copies of them
     """
-    def __init__(self, author_id, recipient_id, text, success):
-        self.author_id = author_id
-        self.recipient_id = recipient_id
-        self.text = text
+    __slots__ = ("author_id", "recipient_id", "_text", "text_bytes", "success", "wire")
+    type = "message"
+
+    def __init__(self, author_id, recipient_id, text, success, text_bytes=None):
+        self.author_id = sys.intern(author_id)
+        self.recipient_id = sys.intern(recipient_id)
+        self._text = text
+        self.text_bytes = text_bytes
         self.success = success
+        self.wire = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = str(self.text_bytes, "utf-8")
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        self._text = text
+        self.text_bytes = None
+        self.wire = None
 
 class Request:
     """
     A base class for all requests from client -> server
     """
+    __slots__ = ("user_id",)
+
     def __init__(self, user_id):
         self.user_id = user_id
 
@@ -28,7 +76,9 @@ class ListRequest(Request):
     """
     A request to list all messages that match a wildcard
     """
-    def __init__(self, user_id, wildcard, page):
+    __slots__ = ("wildcard", "page")
+
+    def __init__(self, user_id, wildcard, page=0):
         super().__init__(user_id)
         self.wildcard = wildcard
         self.page = page
@@ -37,26 +87,110 @@ class SendRequest(Request):
     """
     A request to send a message to a user
     """
+    __slots__ = ("recipient_id", "text")
+
     def __init__(self, user_id, recipient_id, text):
         super().__init__(user_id)
         self.recipient_id = recipient_id
         self.text = text
 
+class GetManyRequest(Request):
+    """
+    A request to drain up to max_count pending messages at once, stopping
+    early once max_bytes worth of messages have been taken
+    """
+    __slots__ = ("max_count", "max_bytes")
+
+    def __init__(self, user_id, max_count, max_bytes):
+        super().__init__(user_id)
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+
+class BatchSendRequest(Request):
+    """
+    A request to send many messages (to one or more users) at once
+    NOTE: Each entry is a SendRequest whose user_id is the batch's author
+    """
+    __slots__ = ("messages",)
+
+    def __init__(self, user_id, messages):
+        super().__init__(user_id)
+        self.messages = messages
+
+class GroupRequest(Request):
+    """
+    A request to join or leave a group
+    """
+    __slots__ = ("group_id",)
+
+    def __init__(self, user_id, group_id):
+        super().__init__(user_id)
+        self.group_id = group_id
+
+class GroupSendRequest(Request):
+    """
+    A request to send a message to every member of a group
+    """
+    __slots__ = ("group_id", "text")
+
+    def __init__(self, user_id, group_id, text):
+        super().__init__(user_id)
+        self.group_id = group_id
+        self.text = text
+
 class Response:
     """
     A base class for all responses from server -> client
     """
+    __slots__ = ("user_id", "success", "error_message")
+    type = "basic"
+
     def __init__(self, user_id, success, error_message):
         self.user_id = user_id
         self.success = success
         self.error_message = error_message
-        self.type = "basic"
 
 class ListResponse(Response):
     """
     A response to a ListRequest
     """
+    __slots__ = ("accounts",)
+    type = "list"
+
     def __init__(self, user_id, success, error_message, accounts):
         super().__init__(user_id, success, error_message)
         self.accounts = accounts
-        self.type = "list"
+
+class BatchResponse(Response):
+    """
+    A response to a BatchSendRequest, with one status per message
+    """
+    __slots__ = ("statuses",)
+    type = "batch"
+
+    def __init__(self, user_id, success, error_message, statuses):
+        super().__init__(user_id, success, error_message)
+        self.statuses = statuses
+
+class MessagesResponse(Response):
+    """
+    A response to a GetManyRequest carrying every message that was drained
+    """
+    __slots__ = ("messages",)
+    type = "messages"
+
+    def __init__(self, user_id, success, error_message, messages):
+        super().__init__(user_id, success, error_message)
+        self.messages = messages
+
+class StatsResponse(Response):
+    """
+    A response to a stats request, carrying the server's metrics in the
+    Prometheus text format (see metrics.py)
+    """
+    __slots__ = ("text",)
+    type = "stats"
+
+    def __init__(self, user_id, success, error_message, text):
+        super().__init__(user_id, success, error_message)
+        self.text = text
@@ -1,82 +1,140 @@
 # echo-server.py
 
+import argparse
+import select
 import socket
 from concurrent import futures
 
 import schema
 import coding
+import struct_coding
+import framing
+import groups
+import idle
+import mailboxes
+import message_log
+import metrics
+import user_registry
 import utils
 import time
 import pdb
-from threading import Lock, Event
+from threading import Event, Thread
 
 HOST = ""  # Standard loopback interface address (localhost)
 PORT = 65432  # Port to listen on (non-privileged ports are > 1023)
+WATCH_CHECK_SECONDS = 1 # How often an idle subscribed connection checks for heartbeats and that its client is still there
+
+class Session:
+    """
+    The state of one client connection
+    """
+    def __init__(self, trusted=False):
+        self.user_id = "" # Set once a create or login on this connection succeeds
+        self.compressed = False # Only once the client asked for it in a hello frame
+        self.trusted = trusted # Connections from other workers may use internal ops
+        self.subscription = None # (request, version) once a subscribe on this connection succeeds
+        self.last_active = None # When a frame last arrived, for finding idle connections
+        self.drop = None # Closes the connection, if the server drops it for being idle
 
 class Server:
     """
     A bare-bones server that listens for connections on a given host and port
     """
 
-    def __init__(self, host, port, executor):
+    def __init__(self, host, port, executor, codec=coding, compression=True, mailbox_capacity=None, overflow=mailboxes.REJECT, user_shards=user_registry.DEFAULT_SHARDS, log_path=None, fsync=message_log.ALWAYS, checkpoint_interval=mailboxes.DEFAULT_CHECKPOINT_INTERVAL, metrics_port=None, idle_timeout=None, preencode=False):
         """
         Initialize the server
+        NOTE: codec is the module used to (un)marshal messages. Anything
+        with the same functions as coding.py (e.g. struct_coding) works.
+        compression controls whether clients may negotiate compressed frames.
+        mailbox_capacity and overflow limit how many messages wait for each
+        user and what happens beyond that (see mailboxes.py). user_shards is
+        the number of independently locked shards of users. With a log_path,
+        accounts and messages are logged there (see message_log.py) and
+        recovered from it on startup, fsync is the log's fsync policy and
+        checkpoint_interval is how often (in seconds) the log is replaced by a
+        snapshot. With a metrics_port, the metrics are also served over HTTP
+        on localhost (see metrics.py). With an idle_timeout, connections that
+        send nothing (not even a heartbeat) for that many seconds are dropped
+        and their users logged out (see idle.py). With preencode, messages
+        are encoded for version 1 responses as they are sent, rather than
+        every time they are delivered (see coding.preencode).
         """
         self.host = host
         self.port = port
         self.executor = executor
-        self.users = {}
-        self.user_lock = Lock()
-        self.msgs_cache = {}
-        self.msgs_lock = Lock()
-        self.user_events = {}
+        self.codec = codec
+        self.compression = compression
+        self.preencode = preencode
+        # Both tables are built from the op registry in coding.py
+        self.handlers = {op.name: getattr(self, op.handler) for op in coding.OPS}
+        self.encoders = coding.response_encoders(codec)
+        self.users = user_registry.UserRegistry(user_shards)
+        self.msgs_cache = mailboxes.Mailboxes(mailbox_capacity, overflow)
+        self.groups = groups.Groups(self.users)
+        self.user_events = {} # user_id -> Event of the thread watching their messages, only while one is
+        self.watchers = {} # user_id -> callback of the async connection subscribed to their messages
         self.ACCOUNT_PAGE_SIZE = 4
         self.alive = True
+        self.log = None
+        if log_path is not None:
+            self.log = message_log.MessageLog(log_path, fsync)
+            make_message = lambda author_id, recipient_id, text_bytes : self.new_message(author_id, recipient_id, text_bytes=text_bytes)
+            for user_id in self.msgs_cache.attach(self.log, make_message, checkpoint_interval):
+                # Everyone starts logged out after a restart
+                self.users.add(schema.Account(user_id=user_id, is_logged_in=False))
+        self.metrics = metrics.Metrics([op.name for op in coding.OPS] + [metrics.DELIVER], self.msgs_cache)
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = metrics.serve_metrics(self.metrics, metrics_port)
+        self.idle = None if idle_timeout is None else idle.TimerWheel(idle_timeout)
 
     
     def handle_create(self, request):
         """
         Creates a new account. Fails if the user_id already exists.
-        NOTE: Requires the user_lock to be held
+        NOTE: Requires the lock of the user's shard to be held
         """
-        with self.user_lock:
+        with self.users.lock(request.user_id):
             if request.user_id in self.users:
                 return schema.Response(user_id=request.user_id, success=False, error_message="User already exists")
             new_account = schema.Account(user_id=request.user_id, is_logged_in=True)
-            self.users[new_account.user_id] = new_account
-            self.msgs_cache[new_account.user_id] = []
-            self.user_events[new_account.user_id] = Event()
+            self.users.add(new_account)
+            self.msgs_cache.create(new_account.user_id)
             return schema.Response(user_id=request.user_id, success=True, error_message="")
     
     def handle_login(self, request):
         """
         Logs in an existing account. Fails if the user_id does not exist or
         if the user is already logged in.
-        NOTE: Requires the user_lock to be held
+        NOTE: Requires the lock of the user's shard to be held
         """
-        with self.user_lock:
+        with self.users.lock(request.user_id):
             if not request.user_id in self.users:
                 return schema.Response(user_id=request.user_id, success=False, error_message="User does not exist")
             if self.users[request.user_id].is_logged_in:
                 return schema.Response(user_id=request.user_id, success=False, error_message="User already logged in")
             self.users[request.user_id].is_logged_in = True
-        with self.msgs_lock:
-            # On login make sure the event is set to true
-            if len(self.msgs_cache[request.user_id]) > 0:
-                self.user_events[request.user_id].set()
+        # On login make sure a watching thread drains what is waiting
+        if len(self.msgs_cache[request.user_id]) > 0:
+            self.wake(request.user_id)
         return schema.Response(user_id=request.user_id, success=True, error_message="")
     
     def handle_delete(self, request):
         """
         Deletes an existing account. Fails if the user_id does not exist.
-        NOTE: Requires the user_lock to be held
+        NOTE: Requires the lock of the user's shard to be held
         """
-        with self.user_lock:
+        with self.users.lock(request.user_id):
             if not request.user_id in self.users:
                 return schema.Response(user_id=request.user_id, success=False, error_message="User does not exist")
-            del self.users[request.user_id]
-            del self.msgs_cache[request.user_id]
-            del self.user_events[request.user_id]
+            self.users.remove(request.user_id)
+            self.msgs_cache.delete(request.user_id)
+            self.groups.leave_all(request.user_id)
+            event = self.user_events.pop(request.user_id, None)
+            if event is not None:
+                event.set() # So that the watching thread sees the user is gone
+            self.watchers.pop(request.user_id, None)
             return schema.Response(user_id=request.user_id, success=True, error_message="")
     
     def handle_list(self, request):
@@ -84,27 +142,36 @@ class Server:
         Lists all accounts that match the given wildcard.
         NOTE: "" will match all accounts. Other strings will simply use
         Python's built-in "in" operator.
-        NOTE: Requires the user_lock to be held
+        NOTE: Accounts are listed in user_id order, and found through the
+        registry's substring index rather than by scanning every account
         """
-        with self.user_lock:
-            satisfying = filter(lambda user : request.wildcard in user.user_id, self.users.values())
-            limited_to_page = list(satisfying)[request.page * self.ACCOUNT_PAGE_SIZE : (request.page + 1) * self.ACCOUNT_PAGE_SIZE]
-            return schema.ListResponse(user_id=request.user_id, success=True, error_message="", accounts=limited_to_page)
+        limited_to_page = self.users.find(request.wildcard, request.page * self.ACCOUNT_PAGE_SIZE, (request.page + 1) * self.ACCOUNT_PAGE_SIZE)
+        return schema.ListResponse(user_id=request.user_id, success=True, error_message="", accounts=limited_to_page)
     
     def handle_get_messages(self, request):
         """
         Gets the messages for a given user
         """
-        sending = None
-        with self.msgs_lock:
-            if len(self.msgs_cache[request.user_id]) > 0:
-                sending = self.msgs_cache[request.user_id][0]
-                self.msgs_cache[request.user_id] = self.msgs_cache[request.user_id][1:]
+        sending = self.msgs_cache[request.user_id].get()
         if sending:
             return sending
         else:
             return schema.Message(author_id=request.user_id, recipient_id=request.user_id, text="", success=False)
     
+    def handle_get_many(self, request):
+        """
+        Drains up to request.max_count pending messages for a given user in
+        one response, taking no more than request.max_bytes of them (but
+        always at least one, so a small budget can't starve the client)
+        """
+        mailbox = self.msgs_cache.get(request.user_id)
+        if mailbox is None:
+            return schema.MessagesResponse(user_id=request.user_id, success=False, error_message="User does not exist", messages=[])
+        max_bytes = min(request.max_bytes, framing.MAX_FRAME_LENGTH // 2)
+        limit = max(1, min(request.max_count, max_bytes // coding.MESSAGE_ENTRY_LENGTH))
+        sending = mailbox.take(limit)
+        return schema.MessagesResponse(user_id=request.user_id, success=len(sending) > 0, error_message="", messages=sending)
+    
     def handle_send(self, request):
         """
         Sends a message to the given user. If the user does not exist, return
@@ -112,75 +179,416 @@ class Server:
         """
         if not request.recipient_id in self.users:
             return schema.Response(user_id=request.user_id, success=False, error_message="User does not exist")
-        message = schema.Message(author_id=request.user_id, recipient_id=request.recipient_id, text=request.text, success=True)
-        with self.msgs_lock:
-            self.msgs_cache[request.recipient_id].append(message)
-        self.user_events[request.recipient_id].set()
+        if isinstance(request, coding.RequestView):
+            # Forward the encoded text as it arrived, without decoding it
+            message = self.new_message(request.user_id, request.recipient_id, text_bytes=request.text_bytes)
+        else:
+            message = self.new_message(request.user_id, request.recipient_id, text=request.text)
+        if not self.msgs_cache[request.recipient_id].put(message):
+            return schema.Response(user_id=request.user_id, success=False, error_message="Mailbox is full")
+        self.notify(request.recipient_id)
         return schema.Response(user_id=request.user_id, success=True, error_message="")
     
+    def handle_send_batch(self, request):
+        """
+        Sends many messages at once. Messages are grouped by recipient so that
+        each mailbox is appended to under a single lock acquisition, and the
+        response carries one status per message (False if its recipient
+        does not exist or their mailbox is full).
+        """
+        statuses = [False] * len(request.messages)
+        missing = False
+        by_recipient = {}
+        for i, entry in enumerate(request.messages):
+            by_recipient.setdefault(entry.recipient_id, []).append(i)
+        for recipient_id, indices in by_recipient.items():
+            mailbox = self.msgs_cache.get(recipient_id)
+            if mailbox is None:
+                missing = True
+                continue
+            messages = [self.new_message(request.user_id, recipient_id, text=request.messages[i].text) for i in indices]
+            # A full mailbox may only take the first few
+            accepted = mailbox.put_many(messages)
+            for i in indices[:accepted]:
+                statuses[i] = True
+            if accepted > 0:
+                self.notify(recipient_id)
+        if all(statuses):
+            return schema.BatchResponse(user_id=request.user_id, success=True, error_message="", statuses=statuses)
+        error_message = "Some recipients do not exist" if missing else "Some mailboxes are full"
+        return schema.BatchResponse(user_id=request.user_id, success=False, error_message=error_message, statuses=statuses)
+
+    def handle_join_group(self, request):
+        """
+        Adds the user to a group, creating the group if nobody is in it yet.
+        Fails if the user_id does not exist or is in the group already.
+        """
+        with self.users.lock(request.user_id):
+            if not request.user_id in self.users:
+                return schema.Response(user_id=request.user_id, success=False, error_message="User does not exist")
+            if not self.groups.join(request.group_id, request.user_id):
+                return schema.Response(user_id=request.user_id, success=False, error_message="Already in group")
+        return schema.Response(user_id=request.user_id, success=True, error_message="")
+
+    def handle_leave_group(self, request):
+        """
+        Takes the user out of a group. Fails if they are not in it.
+        """
+        if not self.groups.leave(request.group_id, request.user_id):
+            return schema.Response(user_id=request.user_id, success=False, error_message="Not in group")
+        return schema.Response(user_id=request.user_id, success=True, error_message="")
+
+    def handle_send_group(self, request):
+        """
+        Sends a message to every member of a group except its author. Every
+        member's mailbox gets the same Message, addressed to the group (see
+        groups.py). Fails if the group does not exist, or if some member's
+        mailbox is full (everyone else still gets the message).
+        """
+        if isinstance(request, coding.RequestView):
+            # Share the encoded text as it arrived, without decoding it
+            message = self.new_message(request.user_id, request.group_id, text_bytes=request.text_bytes)
+        else:
+            message = self.new_message(request.user_id, request.group_id, text=request.text)
+        result = self.groups.fan_out(request.group_id, message, self.msgs_cache, skip=request.user_id)
+        if result is None:
+            return schema.Response(user_id=request.user_id, success=False, error_message="Group does not exist")
+        delivered, refused = result
+        for user_id in delivered:
+            self.notify(user_id)
+        if refused > 0:
+            return schema.Response(user_id=request.user_id, success=False, error_message="Some mailboxes are full")
+        return schema.Response(user_id=request.user_id, success=True, error_message="")
+
+    def new_message(self, author_id, recipient_id, text=None, text_bytes=None):
+        """
+        A message being sent (or recovered from the log), already encoded if
+        the server pre-encodes messages. Give either its text or its UTF-8
+        encoded text_bytes.
+        """
+        message = schema.Message(author_id=author_id, recipient_id=recipient_id, text=text, success=True, text_bytes=text_bytes)
+        if self.preencode:
+            coding.preencode(message)
+        return message
+
+    def notify(self, user_id):
+        """
+        Wakes up whatever is waiting on new messages for a user
+        """
+        self.wake(user_id)
+        watcher = self.watchers.get(user_id)
+        if watcher is not None:
+            watcher()
+
+    def wake(self, user_id):
+        """
+        Sets the event of the thread watching a user's messages, if there is one
+        """
+        event = self.user_events.get(user_id)
+        if event is not None:
+            event.set()
+
+    def handle_subscribe(self, request):
+        """
+        Subscribes a connection to a user's messages. Like get_many, the
+        response drains the messages already waiting, but from then on the
+        server pushes every new message to the connection as it arrives.
+        NOTE: Succeeds even if no messages are waiting. Fails if the user_id
+        does not exist.
+        """
+        if not request.user_id in self.users:
+            return schema.MessagesResponse(user_id=request.user_id, success=False, error_message="User does not exist", messages=[])
+        resp = self.handle_get_many(request)
+        resp.success = True
+        return resp
+
+    def pending_push(self, session):
+        """
+        Drains the messages waiting for a subscribed connection. Returns the
+        marshaled response to push, or None if there was nothing to send.
+        """
+        request, version = session.subscription
+        if not request.user_id in self.msgs_cache:
+            return None # Deleted
+        start = time.perf_counter()
+        resp = self.handle_get_many(request)
+        if not resp.messages:
+            return None
+        out = self.marshal_response(resp, "subscribe", version)
+        self.metrics.deliver(time.perf_counter() - start, len(resp.messages))
+        return out
+
+    def handle_logout(self, request):
+        """
+        Logs out an account, so that it can log in again (e.g. from another
+        connection). Fails if the user_id does not exist.
+        """
+        with self.users.lock(request.user_id):
+            account = self.users.get(request.user_id)
+            if account is None:
+                return schema.Response(user_id=request.user_id, success=False, error_message="User does not exist")
+            account.is_logged_in = False
+            self.wake(request.user_id)
+        return schema.Response(user_id=request.user_id, success=True, error_message="")
+
+    def handle_list_all(self, request):
+        """
+        Lists every account matching the wildcard up to the end of the given
+        page, in user_id order. Cluster workers use this to gather a page from
+        every partition, since any of those accounts may be on the page.
+        """
+        accounts = self.users.find(request.wildcard, 0, (request.page + 1) * self.ACCOUNT_PAGE_SIZE)
+        return schema.ListResponse(user_id=request.user_id, success=True, error_message="", accounts=accounts)
+
+    def handle_health(self, request):
+        """
+        Lets a client check that the server is up
+        """
+        return schema.Response(user_id=request.user_id, success=True, error_message="")
+
+    def handle_stats(self, request):
+        """
+        Reports the server's metrics, in the same text format as the metrics
+        port (see metrics.py)
+        """
+        return schema.StatsResponse(user_id=request.user_id, success=True, error_message="", text=self.metrics.render())
+
+    def commit_log(self):
+        """
+        Waits until every change logged so far is durable, so that a reply
+        never promises more than a crash would leave behind
+        """
+        if self.log is not None:
+            self.log.commit()
+
     def handle_request_with_op(self, request, op):
         """
-        Just does the dirty work of matching the code to the handler func
-        """
-        if op == "create":
-            return self.handle_create(request)
-        if op == "login":
-            return self.handle_login(request)
-        if op == "delete":
-            return self.handle_delete(request)
-        if op == "get":
-            return self.handle_get_messages(request)
-        if op == "list":
-            return self.handle_list(request)
-        if op == "send":
-            return self.handle_send(request)
-        if op == "health":
-            return schema.Response(user_id=request.user_id, success=True, error_message="")
-        return None
+        Just does the dirty work of matching the op to its handler func
+        """
+        handler = self.handlers.get(op)
+        if handler is None:
+            return None
+        return handler(request)
     
+    def marshal_response(self, resp, op, version):
+        """
+        Marshals a handler's response with the right encoding, in the
+        protocol version the request arrived in
+        """
+        if version == coding.VERSION_1:
+            return coding.marshal_response_v1(resp)
+        return self.encoders[op](resp)
+
+    def handle_hello(self, data, session):
+        """
+        Negotiates compression for a connection. Returns the hello reply.
+        """
+        compression = framing.negotiate(framing.parse_hello(data)) if self.compression else None
+        session.compressed = compression is not None
+        return framing.hello([compression] if session.compressed else [])
+
+    def respond(self, request, op, version, session):
+        """
+        Runs the handler for a decoded request and marshals its response
+        NOTE: Both are timed for the op's latency histogram
+        """
+        start = time.perf_counter()
+        resp = self.handle_request_with_op(request, op)
+        if (op == "create" or op == "login") and resp.success:
+            session.user_id = request.user_id
+        elif op == "subscribe" and resp.success:
+            session.subscription = (request, version)
+        out = self.marshal_response(resp, op, version)
+        self.metrics.observe(op, time.perf_counter() - start, resp.success)
+        return out
+
+    def handle_frame(self, data, session):
+        """
+        Handles one frame. Returns the marshaled reply, or None if the
+        frame was not a valid request or needs no reply.
+        NOTE: A tagged request is always answered, with its request_id (see
+        framing.py), so that a client waiting on it isn't left hanging. A
+        tagged frame too short to hold a request_id can't be answered, so it
+        is dropped like any other invalid frame.
+        """
+        if framing.is_tagged(data):
+            try:
+                request_id, data = framing.untag(data)
+            except:
+                utils.print_error("Error: Invalid request")
+                return None
+            return framing.tag(request_id, self.handle_frame(data, session) or self.invalid_reply())
+        if framing.is_hello(data):
+            return self.handle_hello(data, session)
+        if framing.is_heartbeat(data):
+            return None # Arriving was all it had to do
+        try:
+            version = chr(data[0])
+            request, op = self.codec.view_request(data)
+            if coding.OPS_BY_NAME[op].internal and not session.trusted:
+                raise Exception("Internal op")
+        except:
+            utils.print_error("Error: Invalid request")
+            return None
+        return self.respond(request, op, version, session)
+
+    def invalid_reply(self):
+        """
+        The reply to a tagged frame that held no valid request. Its op (and
+        so the type of response it expects) is unknown, so this is a basic
+        failed response, in version 1.
+        """
+        return coding.marshal_response_v1(schema.Response(user_id="", success=False, error_message="Invalid request"))
+
+    def handle_frames(self, decoder, session):
+        """
+        Handles every complete frame in the decoder. A single recv may hold
+        several pipelined requests (or only part of one), so the replies are
+        returned framed together, ready for one write (or None if there are none)
+        """
+        replies = []
+        for data in decoder.frames():
+            reply = self.handle_frame(data, session)
+            if reply is not None:
+                replies.append(reply)
+        if not replies:
+            return None
+        return framing.frame_all(replies, session.compressed)
+
+    def end_session(self, session):
+        """
+        Logs out the user whose connection closed, if one logged in on it
+        """
+        if len(session.user_id) > 0:
+            self.handle_logout(schema.Request(session.user_id))
+
+    def track(self, session, drop):
+        """
+        Starts watching a client connection for going idle. drop closes it.
+        """
+        session.drop = drop
+        if self.idle is not None:
+            self.idle.add(session)
+
+    def untrack(self, session):
+        if self.idle is not None:
+            self.idle.remove(session)
+
+    def touch(self, session):
+        """
+        Records that a frame (or part of one) arrived on a connection
+        """
+        if self.idle is not None:
+            self.idle.touch(session)
+
+    def reap_idle(self):
+        """
+        Drops every connection that has been idle for too long. Closing it
+        ends its session as usual, which logs its user out.
+        """
+        for session in self.idle.expire():
+            print("Error: Dropping idle connection", session.user_id)
+            session.drop()
+
+    def reap_loop(self):
+        """
+        Reaps idle connections every tick of the timer wheel, for the
+        threaded server
+        """
+        while self.alive:
+            time.sleep(self.idle.resolution)
+            try:
+                self.reap_idle()
+            except Exception as e:
+                print("Error:", e)
+
     def handle_connection(self, conn, addr):
         print("New connection")
-        user_id = ""
+        session = Session()
+        decoder = framing.FrameDecoder()
+        self.metrics.session_started()
+        self.track(session, lambda : shutdown(conn))
         while True:
             if not self.alive:
                 break
             # Continue to receive data until the connection is closed
             try:
-                data = conn.recv(1024)
+                received = decoder.recv_from(conn)
+                if received == 0:
+                    raise Exception("Client closed connection")
+                self.metrics.received(received)
+                self.touch(session)
                 if not self.alive:
                     break
-                if not data:
-                    raise Exception("Client closed connection")
-                try:
-                    request, op = coding.unmarshal_request(data)
-                except:
-                    utils.print_error("Error: Invalid request")
+                out = self.handle_frames(decoder, session)
+                if out is None:
                     continue
-                resp = self.handle_request_with_op(request, op)
-                if (op == "create" or op == "login") and resp.success:
-                    user_id = request.user_id
-                # Send back using the right encoding
-                if op == "list":
-                    data = coding.marshal_list_response(resp)
-                elif op == "get":
-                    data = coding.marshal_message_response(resp)
-                else:
-                    data = coding.marshal_response(resp)
+                self.commit_log()
                 try:
-                    conn.sendall(data)
+                    conn.sendall(out)
                 except:
                     raise Exception("Client closed connection")
+                self.metrics.sent(len(out))
+                if session.subscription is not None:
+                    self.watch(conn, session, decoder)
+                    break
             except Exception as e:
                 print("Error:", e.args[0])
-                resp = schema.Response(user_id=user_id, success=False, error_message=str(e.args[0]))
-                data = coding.marshal_response(resp)
-                if len(user_id) > 0:
-                    self.users[user_id].is_logged_in = False
-                    self.user_events[user_id].set()
+                self.end_session(session)
                 break
+        self.untrack(session)
+        self.metrics.session_ended()
         conn.close()
 
+    def watch(self, conn, session, decoder):
+        """
+        Pushes a subscribed user's messages down the connection as soon as they
+        arrive, until the client goes away or the user is deleted
+        NOTE: Frames that arrive on a subscribed connection (usually just
+        heartbeats) are only checked for in between pushes
+        NOTE: The event is only created here, so that users without a watching
+        thread don't hold one, and a newer subscription for the same user
+        takes over from this one
+        """
+        request, version = session.subscription
+        event = Event()
+        with self.users.lock(request.user_id):
+            if not request.user_id in self.users:
+                return
+            previous = self.user_events.get(request.user_id)
+            self.user_events[request.user_id] = event
+        if previous is not None:
+            previous.set() # So that it sees it was taken over
+        try:
+            while self.alive and self.user_events.get(request.user_id) is event:
+                out = self.pending_push(session)
+                if out is not None:
+                    out = framing.frame(out, session.compressed)
+                    conn.sendall(out)
+                    self.metrics.sent(len(out))
+                    continue # A full response may have left more behind
+                if readable(conn):
+                    received = decoder.recv_from(conn)
+                    if received == 0:
+                        break # Closed by the client, or dropped for being idle
+                    self.metrics.received(received)
+                    self.touch(session)
+                    out = self.handle_frames(decoder, session)
+                    if out is not None:
+                        self.commit_log()
+                        conn.sendall(out)
+                        self.metrics.sent(len(out))
+                    continue
+                if event.wait(WATCH_CHECK_SECONDS):
+                    event.clear()
+        finally:
+            with self.users.lock(request.user_id):
+                if self.user_events.get(request.user_id) is event:
+                    del self.user_events[request.user_id]
+
     def start(self):
+        if self.idle is not None:
+            Thread(target=self.reap_loop, daemon=True).start()
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.bind((self.host, self.port))
             s.listen()
@@ -196,10 +604,56 @@ class Server:
                 except:
                     pass
 
+def readable(conn):
+    """
+    Checks, without blocking, whether a connection has something to read
+    (which includes the other end having closed it)
+    """
+    ready, _, _ = select.select([conn], [], [], 0)
+    return len(ready) > 0
+
+def shutdown(conn):
+    """
+    Shuts a connection down from another thread, which wakes up a recv
+    blocked on it (it returns 0, as if the client had closed it)
+    """
+    try:
+        conn.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass # Already closed
+
+CODECS = {
+    "string": coding,
+    "struct": struct_coding,
+}
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--codec", choices=CODECS.keys(), default="string", help="implementation used to (un)marshal messages")
+    parser.add_argument("--no-compression", action="store_true", help="never compress frames, even if a client asks")
+    parser.add_argument("--mode", choices=["async", "threaded", "cluster"], default="async", help="serve every connection from one asyncio event loop, with a thread per connection, or from several event loop processes")
+    parser.add_argument("--workers", type=int, default=None, help="most connections served at once in threaded mode")
+    parser.add_argument("--mailbox-capacity", type=int, default=None, help="most messages waiting for each user (default: unlimited)")
+    parser.add_argument("--overflow", choices=mailboxes.OVERFLOW_POLICIES, default=mailboxes.REJECT, help="what a full mailbox does with new messages")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes in cluster mode (default: one per CPU)")
+    parser.add_argument("--log", default=None, help="file to log accounts and messages to, and recover them from on startup (default: keep them in memory only)")
+    parser.add_argument("--fsync", choices=message_log.FSYNC_POLICIES, default=message_log.ALWAYS, help="when the log is flushed to disk")
+    parser.add_argument("--checkpoint-interval", type=float, default=mailboxes.DEFAULT_CHECKPOINT_INTERVAL, help="seconds between snapshots of the logged state")
+    parser.add_argument("--metrics-port", type=int, default=None, help="localhost port to serve Prometheus metrics on (in cluster mode, each worker uses the next port after the previous one's)")
+    parser.add_argument("--preencode", action="store_true", help="encode each message for version 1 responses once, when it is sent, instead of on every delivery")
+    parser.add_argument("--idle-timeout", type=float, default=idle.DEFAULT_IDLE_TIMEOUT, help="seconds without a frame or heartbeat after which a connection is dropped and its user logged out (0 to never drop them)")
+    args = parser.parse_args()
+    idle_timeout = args.idle_timeout or None
     try:
-        executor = futures.ThreadPoolExecutor()
-        server = Server(host=HOST, port=PORT, executor=executor)
+        if args.mode == "async":
+            from async_server import AsyncServer
+            server = AsyncServer(host=HOST, port=PORT, codec=CODECS[args.codec], compression=not args.no_compression, mailbox_capacity=args.mailbox_capacity, overflow=args.overflow, log_path=args.log, fsync=args.fsync, checkpoint_interval=args.checkpoint_interval, metrics_port=args.metrics_port, idle_timeout=idle_timeout, preencode=args.preencode)
+        elif args.mode == "cluster":
+            from cluster import Cluster
+            server = Cluster(host=HOST, port=PORT, workers=args.processes, codec=args.codec, compression=not args.no_compression, mailbox_capacity=args.mailbox_capacity, overflow=args.overflow, log_path=args.log, fsync=args.fsync, checkpoint_interval=args.checkpoint_interval, metrics_port=args.metrics_port, idle_timeout=idle_timeout, preencode=args.preencode)
+        else:
+            executor = futures.ThreadPoolExecutor(max_workers=args.workers)
+            server = Server(host=HOST, port=PORT, executor=executor, codec=CODECS[args.codec], compression=not args.no_compression, mailbox_capacity=args.mailbox_capacity, overflow=args.overflow, log_path=args.log, fsync=args.fsync, checkpoint_interval=args.checkpoint_interval, metrics_port=args.metrics_port, idle_timeout=idle_timeout, preencode=args.preencode)
         server.start()
     except KeyboardInterrupt:
         server.alive = False
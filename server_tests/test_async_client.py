@@ -0,0 +1,125 @@
+import unittest
+import sys
+import asyncio
+import tempfile
+
+sys.path.insert(0, "..")
+import async_client
+import async_server
+import cluster
+import framing
+import idle
+import schema
+
+class Test_async_client(unittest.TestCase):
+    """Test class for the pipelined client in async_client.py"""
+
+    def test_pipelining(self):
+
+        async def scenario():
+            # Start an async server and connect to it
+            s = async_server.AsyncServer(host="127.0.0.1", port=0)
+            task = asyncio.create_task(s.serve())
+            await asyncio.sleep(0.1)
+            client = await async_client.AsyncClient("127.0.0.1", s.port, compression=True).connect()
+            assert client.compressed
+
+            # Ensure hundreds of requests in flight at once each get their own response
+            names = ["user{}".format(i) for i in range(200)]
+            futures = [client.submit(schema.Request(user_id=name), "create") for name in names]
+            futures.append(client.submit(schema.Request(user_id=names[0]), "create"))
+            responses = await asyncio.gather(*futures)
+            assert [resp.success for resp in responses] == [True] * 200 + [False]
+            assert [resp.user_id for resp in responses] == names + [names[0]]
+            assert client.pending == {}
+
+            # Ensure messages pushed after a subscribe go to the pushes queue
+            resp = await client.call(schema.GetManyRequest(user_id=names[1], max_count=8, max_bytes=4096), "subscribe")
+            assert resp.success and resp.messages == []
+            resp = await client.call(schema.SendRequest(user_id=names[0], recipient_id=names[1], text="pushed"), "send")
+            assert resp.success
+            pushed = await asyncio.wait_for(client.pushes.get(), 5)
+            assert [msg.text for msg in pushed.messages] == ["pushed"]
+
+            # Ensure requests fail once the client is closed
+            await client.close()
+            with self.assertRaises(Exception):
+                await client.call(schema.Request(user_id=names[0]), "health")
+            task.cancel()
+
+        asyncio.run(scenario())
+
+    def test_connection(self):
+
+        async def scenario():
+            # Ensure requests need a connection
+            client = async_client.AsyncClient("127.0.0.1", 0)
+            with self.assertRaises(Exception) as raised:
+                client.submit(schema.Request(user_id="ream"), "health")
+            assert raised.exception.args[0] == "Not connected"
+
+            # Connect with frequent heartbeats
+            s = async_server.AsyncServer(host="127.0.0.1", port=0)
+            task = asyncio.create_task(s.serve())
+            await asyncio.sleep(0.1)
+            client = await async_client.AsyncClient("127.0.0.1", s.port).connect()
+            heartbeats = client.tasks[-1]
+            await asyncio.sleep(0.05)
+            assert not heartbeats.done()
+
+            # Ensure heartbeats stop once the connection is closing
+            client.writer.close()
+            await asyncio.sleep(0.05)
+            assert heartbeats.done()
+            await client.close()
+            task.cancel()
+
+        seconds = idle.HEARTBEAT_SECONDS
+        idle.HEARTBEAT_SECONDS = 0.01
+        try:
+            asyncio.run(scenario())
+        finally:
+            idle.HEARTBEAT_SECONDS = seconds
+
+    def test_out_of_order(self):
+
+        async def scenario():
+            # Start a two worker cluster in this process and connect to worker 0 only
+            socket_dir = tempfile.mkdtemp()
+            workers = [cluster.WorkerServer("127.0.0.1", 0, index, 2, socket_dir) for index in range(2)]
+            tasks = [asyncio.create_task(w.serve()) for w in workers]
+            await asyncio.sleep(0.2)
+            client = await async_client.AsyncClient("127.0.0.1", workers[0].port).connect()
+            names = ["user{}".format(i) for i in range(20)]
+            local = [name for name in names if cluster.owner_of(name, 2) == 0][0]
+            remote = [name for name in names if cluster.owner_of(name, 2) == 1][0]
+            await client.call(schema.Request(user_id=local), "create")
+
+            # Hold back every reply from worker 1 for a while
+            peer = workers[0].peers[1]
+            request = peer.request
+            def slow_request(data):
+                delayed = asyncio.get_running_loop().create_future()
+                request(data).add_done_callback(lambda future : asyncio.get_running_loop().call_later(0.2, delayed.set_result, future.result()))
+                return delayed
+            peer.request = slow_request
+
+            # Ensure a local request sent after a forwarded one is answered first
+            answered = []
+            forwarded = client.submit(schema.Request(user_id=remote), "create")
+            forwarded.add_done_callback(lambda _ : answered.append("forwarded"))
+            handled = client.submit(schema.Request(user_id=local), "health")
+            handled.add_done_callback(lambda _ : answered.append("local"))
+            assert (await forwarded).success and (await handled).success
+            assert answered == ["local", "forwarded"]
+            assert remote in workers[1].users
+
+            # Ensure a tagged frame too short for its request_id only drops that frame
+            client.writer.write(framing.frame(framing.TAGGED + b"\0"))
+            assert (await client.call(schema.Request(user_id=local), "health")).success
+
+            await client.close()
+            for task in tasks:
+                task.cancel()
+
+        asyncio.run(scenario())
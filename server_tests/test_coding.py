@@ -0,0 +1,158 @@
+import unittest
+import sys
+
+sys.path.insert(0, "..")
+import coding
+import struct_coding
+import schema
+import server
+
+class Test_coding(unittest.TestCase):
+    """Test class for the lazy request views in coding.py"""
+
+    def test_view_decodes_lazily(self):
+
+        # Wrap a send request without decoding anything but user_id/op
+        data = coding.marshal_send_request(schema.SendRequest(user_id="ream", recipient_id="mark", text="hello"))
+        view, op = coding.view_request(memoryview(data))
+        assert op == "send"
+        assert view.user_id == "ream"
+        assert "text" not in vars(view)
+
+        # Ensure the fields decode on first access and are then cached
+        assert view.recipient_id == "mark"
+        assert view.text_bytes == b"hello"
+        assert "text" not in vars(view)
+        assert view.text == "hello"
+        assert "text" in vars(view)
+
+    def test_view_matches_unmarshal(self):
+
+        # Ensure views agree with the eager decoder, including non-ASCII fields
+        for user_id in ["ream", "zoë"]:
+            for recipient_id in ["mark", "chloé"]:
+                for text in ["", "hi", "héllo", "z" * 300]:
+                    data = coding.marshal_send_request(schema.SendRequest(user_id=user_id, recipient_id=recipient_id, text=text))
+                    view, _ = coding.view_request(memoryview(data))
+                    eager, _ = coding.unmarshal_request(data)
+                    assert (view.user_id, view.recipient_id, view.text) == (eager.user_id, eager.recipient_id, eager.text)
+
+    def test_forwarded_message(self):
+
+        # Ensure a message built from the raw text field marshals like a decoded one
+        for text in ["hi", "héllo"]:
+            data = coding.marshal_send_request(schema.SendRequest(user_id="ream", recipient_id="mark", text=text))
+            view, _ = coding.view_request(memoryview(data))
+            forwarded = schema.Message(author_id="ream", recipient_id="mark", text=None, success=True, text_bytes=view.text_bytes)
+            decoded = schema.Message(author_id="ream", recipient_id="mark", text=text, success=True)
+            for codec in [coding, struct_coding]:
+                assert codec.marshal_message_response(forwarded) == coding.marshal_message_response(decoded)
+            assert forwarded.text == text
+
+    def test_v1_round_trip(self):
+
+        # Ensure every request comes back out of the version 1 format unchanged
+        reqs = [
+            (schema.Request(user_id="zoë"), "login"),
+            (schema.ListRequest(user_id="ream", wildcard="ma", page=300), "list"),
+            (schema.GetManyRequest(user_id="ream", max_count=64, max_bytes=65536), "get_many"),
+            (schema.SendRequest(user_id="ream", recipient_id="chloé", text="héllo"), "send"),
+            (schema.BatchSendRequest(user_id="ream", messages=[schema.SendRequest(user_id="ream", recipient_id="mark", text=text) for text in ["", "hi"]]), "send_batch"),
+        ]
+        for req, op in reqs:
+            data = coding.marshal_request(req, op, coding.VERSION_1)
+            out, out_op = coding.unmarshal_request(data)
+            assert out_op == op
+            if op == "send_batch":
+                assert [schema.fields(msg) for msg in out.messages] == [schema.fields(msg) for msg in req.messages]
+            else:
+                assert schema.fields(out) == schema.fields(req)
+
+        # Ensure long text is truncated like version 0 and views agree with the eager decoder
+        data = coding.marshal_request(schema.SendRequest(user_id="ream", recipient_id="mark", text="é" * 300), "send", coding.VERSION_1)
+        view, _ = coding.view_request(memoryview(data))
+        assert view.text == coding.unmarshal_request(data)[0].text == "é" * 280
+
+        # Ensure responses come back out, and that an empty poll is far smaller than version 0
+        empty = schema.Message(author_id="ream", recipient_id="ream", text="", success=False)
+        assert len(coding.marshal_response_v1(empty)) < len(coding.marshal_message_response(empty)) // 10
+        statuses = [i % 3 == 0 for i in range(11)]
+        resp = coding.unmarshal_response(coding.marshal_response_v1(schema.BatchResponse(user_id="ream", success=False, error_message="Some recipients do not exist", statuses=statuses)))
+        assert (resp.statuses, resp.error_message) == (statuses, "Some recipients do not exist")
+
+    def test_mixed_versions(self):
+
+        # Ensure messages sent in one version are delivered in the other
+        s = server.Server(host="127.0.0.1", port="50051", executor=None)
+        s.handle_create(schema.Request(user_id="ream"))
+        s.handle_create(schema.Request(user_id="mark"))
+        for send_version, get_version in [(coding.VERSION, coding.VERSION_1), (coding.VERSION_1, coding.VERSION)]:
+            data = coding.marshal_request(schema.SendRequest(user_id="ream", recipient_id="mark", text="héllo"), "send", send_version)
+            req, op = coding.view_request(memoryview(data))
+            assert s.handle_request_with_op(req, op).success
+            data = coding.marshal_request(schema.Request(user_id="mark"), "get", get_version)
+            req, op = coding.view_request(memoryview(data))
+            resp = coding.unmarshal_response(s.marshal_response(s.handle_request_with_op(req, op), op, get_version))
+            assert (resp.author_id, resp.text) == ("ream", "héllo")
+
+    def test_op_registry(self):
+
+        # Ensure every registered op round trips through every codec and version
+        requests = {
+            "send": schema.SendRequest(user_id="ream", recipient_id="mark", text="hi"),
+            "list": schema.ListRequest(user_id="ream", wildcard="ma", page=2),
+            "list_all": schema.ListRequest(user_id="ream", wildcard="ma", page=2),
+            "get_many": schema.GetManyRequest(user_id="ream", max_count=4, max_bytes=4096),
+            "subscribe": schema.GetManyRequest(user_id="ream", max_count=16, max_bytes=8192),
+            "send_batch": schema.BatchSendRequest(user_id="ream", messages=[schema.SendRequest(user_id="ream", recipient_id="mark", text="hi")]),
+            "join_group": schema.GroupRequest(user_id="ream", group_id="team"),
+            "leave_group": schema.GroupRequest(user_id="ream", group_id="team"),
+            "send_group": schema.GroupSendRequest(user_id="ream", group_id="team", text="hi all"),
+        }
+        for op in coding.OPS:
+            req = requests.get(op.name, schema.Request(user_id="ream"))
+            data = coding.marshal_request(req, op.name)
+            assert struct_coding.marshal_op_request(req, op) == data
+            for out, out_op in [coding.unmarshal_request(data), struct_coding.unmarshal_request(data), coding.unmarshal_request(coding.marshal_request(req, op.name, coding.VERSION_1))]:
+                assert out_op == op.name
+                assert type(out) == op.request_class
+                for field in op.fields:
+                    if field.kind != coding.ENTRIES:
+                        assert getattr(out, field.name) == getattr(req, field.name)
+
+        # Ensure the server has a handler and response encoder for every op
+        s = server.Server(host="127.0.0.1", port="50051", executor=None)
+        for op in coding.OPS:
+            assert op.name in s.handlers and op.name in s.encoders
+        resp = s.handle_request_with_op(schema.Request(user_id="ream"), "health")
+        assert resp.success
+
+        # Ensure the stats response carries the metrics through every codec and version
+        stats = s.handle_request_with_op(schema.Request(user_id="ream"), "stats")
+        assert "chat_request_seconds" in stats.text
+        for data in [coding.marshal_stats_response(stats), struct_coding.marshal_stats_response(stats), coding.marshal_response_v1(stats)]:
+            assert coding.unmarshal_response(data).text == stats.text
+        assert struct_coding.unmarshal_response(coding.marshal_stats_response(stats)).text == stats.text
+
+        # Ensure unknown op codes are rejected
+        with self.assertRaises(Exception):
+            coding.unmarshal_request(b"0ream\0\0\0\0z")
+
+    def test_batch_count(self):
+
+        # Build a send_batch frame that claims far more entries than it holds
+        messages = [schema.SendRequest(user_id="ream", recipient_id="mark", text="hi")]
+        data = coding.marshal_batch_send_request(schema.BatchSendRequest(user_id="ream", messages=messages))
+        count = coding.OPS_BY_NAME["send_batch"].fields[0]
+        header = 10 + count.length
+        forged = data[:10] + coding.pad_to_length("1000000", count.length).encode() + data[header:]
+
+        # Ensure both codecs reject it rather than decode a million entries
+        assert len(coding.unmarshal_request(data)[0].messages) == 1
+        for codec in [coding, struct_coding]:
+            with self.assertRaises(Exception):
+                codec.unmarshal_request(forged)
+
+        # Ensure the server drops only that frame
+        s = server.Server(host="127.0.0.1", port="50051", executor=None)
+        assert s.handle_frame(memoryview(forged), server.Session()) is None
@@ -0,0 +1,108 @@
+import unittest
+import sys
+
+sys.path.insert(0, "..")
+import framing
+import coding
+import schema
+
+class Test_framing(unittest.TestCase):
+    """Test class for the length-prefixed frame decoder"""
+
+    def test_many_frames_in_one_chunk(self):
+
+        # Pipeline three requests into a single chunk of bytes
+        reqs = [schema.Request(user_id=name) for name in ["ream", "mark", "joe"]]
+        chunk = framing.frame_all([coding.marshal_login_request(req) for req in reqs])
+        decoder = framing.FrameDecoder()
+        decoder.feed(chunk)
+
+        # Ensure every request comes back out, in order
+        decoded = [coding.unmarshal_request(data) for data in decoder.frames()]
+        assert [req.user_id for req, _ in decoded] == ["ream", "mark", "joe"]
+        assert all(op == "login" for _, op in decoded)
+        assert decoder.pending() == 0
+
+    def test_partial_frames(self):
+
+        # Split a send request at every possible position
+        req = schema.SendRequest(user_id="ream", recipient_id="mark", text="hello there")
+        chunk = framing.frame(coding.marshal_send_request(req))
+        for split in range(1, len(chunk)):
+            decoder = framing.FrameDecoder()
+
+            # Ensure nothing is handed out until the whole frame arrived
+            decoder.feed(chunk[:split])
+            assert decoder.next_frame() is None
+            decoder.feed(chunk[split:])
+            out, op = coding.unmarshal_request(decoder.next_frame())
+            assert op == "send"
+            assert out.text == "hello there"
+
+    def test_buffer_growth(self):
+
+        # Ensure frames larger than the initial buffer are reassembled
+        decoder = framing.FrameDecoder(capacity=16)
+        payload = b"x" * 5000
+        decoder.feed(framing.frame(payload) + framing.frame(b"y"))
+        assert bytes(decoder.next_frame()) == payload
+        assert bytes(decoder.next_frame()) == b"y"
+        assert decoder.next_frame() is None
+
+    def test_oversized_frame(self):
+
+        # Ensure a bogus length header is rejected instead of buffered
+        decoder = framing.FrameDecoder()
+        decoder.feed(framing.FRAME_HEADER.pack(framing.MAX_FRAME_LENGTH + 1))
+        with self.assertRaises(Exception):
+            decoder.next_frame()
+
+    def test_compressed_frames(self):
+
+        # Ensure large compressible frames shrink while small ones are sent raw
+        accounts = [schema.Account(user_id="user{}".format(i), is_logged_in=False) for i in range(200)]
+        large = coding.marshal_list_response(schema.ListResponse(user_id="ream", success=True, error_message="", accounts=accounts))
+        small = coding.marshal_login_request(schema.Request(user_id="ream"))
+        chunk = framing.frame_all([large, small], compressed=True)
+        assert len(chunk) < len(large)
+        assert framing.frame(small, compressed=True) == framing.frame(small)
+
+        # Ensure both come back out unchanged, even when split up
+        decoder = framing.FrameDecoder(capacity=16)
+        for i in range(0, len(chunk), 100):
+            decoder.feed(chunk[i:i + 100])
+        assert [bytes(data) for data in decoder.frames()] == [large, small]
+
+    def test_compression_bomb(self):
+
+        # Ensure a small frame that inflates past the limit is rejected
+        bomb = framing.zlib.compress(b"\0" * (framing.MAX_FRAME_LENGTH + 1))
+        decoder = framing.FrameDecoder()
+        decoder.feed(framing.FRAME_HEADER.pack(len(bomb) | framing.COMPRESSED_FLAG) + bomb)
+        with self.assertRaises(Exception):
+            decoder.next_frame()
+
+    def test_hello(self):
+
+        # Ensure hello frames are told apart from requests and negotiate zlib
+        offer = framing.hello()
+        assert framing.is_hello(offer)
+        assert not framing.is_hello(coding.marshal_login_request(schema.Request(user_id="ream")))
+        assert not framing.is_hello(coding.marshal_request(schema.Request(user_id="ream"), "login", coding.VERSION_1))
+        assert framing.negotiate(framing.parse_hello(offer)) == "zlib"
+        assert framing.negotiate(framing.parse_hello(framing.hello(["lz4"]))) is None
+        assert framing.parse_hello(framing.hello([])) == []
+
+    def test_tags(self):
+
+        # Ensure a tagged request is told apart from everything else and comes back out with its id
+        data = coding.marshal_request(schema.Request(user_id="ream"), "login", coding.VERSION_1)
+        tagged = framing.tag(framing.MAX_REQUEST_ID, data)
+        assert framing.is_tagged(tagged)
+        assert not any(framing.is_tagged(other) for other in [data, coding.marshal_login_request(schema.Request(user_id="ream")), framing.hello(), framing.HEARTBEAT])
+        request_id, payload = framing.untag(memoryview(tagged))
+        assert request_id == framing.MAX_REQUEST_ID and bytes(payload) == data
+
+        # Ensure a tag too short to hold an id is refused
+        with self.assertRaises(Exception):
+            framing.untag(framing.TAGGED + b"\0")
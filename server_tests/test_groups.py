@@ -0,0 +1,95 @@
+import unittest
+import sys
+import threading
+
+sys.path.insert(0, "..")
+import groups
+import mailboxes
+import schema
+import user_registry
+
+class CountingLock:
+    """A lock that counts how often it was taken"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.taken = 0
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.taken += 1
+
+    def __exit__(self, *args):
+        self.lock.release()
+
+class Test_groups(unittest.TestCase):
+    """Test class for the group memberships in groups.py"""
+
+    def setUp(self):
+        self.users = user_registry.UserRegistry(shards=4)
+        self.mailboxes = mailboxes.Mailboxes()
+        for i in range(40):
+            user_id = "user{}".format(i)
+            with self.users.lock(user_id):
+                self.users.add(schema.Account(user_id=user_id, is_logged_in=False))
+            self.mailboxes.create(user_id)
+
+    def test_membership(self):
+
+        # Ensure the first member creates a group and joining twice fails
+        g = groups.Groups(self.users)
+        assert "team" not in g
+        assert g.join("team", "user1")
+        assert not g.join("team", "user1")
+        assert g.join("team", "user2") and g.join("other", "user1")
+        assert "team" in g and len(g) == 2
+        assert sorted(user_id for _, user_ids in g.members("team") for user_id in user_ids) == ["user1", "user2"]
+
+        # Ensure only members can leave, and the last one out removes the group
+        assert not g.leave("team", "user3")
+        assert g.leave("team", "user2")
+        assert g.leave("team", "user1")
+        assert "team" not in g and g.members("team") == []
+
+        # Ensure a deleted user leaves every group they were in
+        g.join("team", "user1")
+        g.join("team", "user2")
+        g.leave_all("user1")
+        assert "other" not in g
+        assert [user_ids for _, user_ids in g.members("team")] == [["user2"]]
+        assert "user1" not in g.joined
+
+    def test_fan_out(self):
+
+        # Put every user in a group and count the shard locks taken by a send
+        g = groups.Groups(self.users)
+        for i in range(40):
+            g.join("team", "user{}".format(i))
+        for shard in self.users.shards:
+            shard.lock = CountingLock()
+        message = schema.Message(author_id="user0", recipient_id="team", text="hi", success=True)
+        delivered, refused = g.fan_out("team", message, self.mailboxes, skip="user0")
+
+        # Ensure everyone but the author got the very same message, taking each shard's lock once
+        assert sorted(delivered) == sorted("user{}".format(i) for i in range(1, 40))
+        assert refused == 0
+        assert len(self.mailboxes["user0"]) == 0
+        assert all(self.mailboxes["user{}".format(i)].get() is message for i in range(1, 40))
+        assert all(shard.lock.taken == (1 if shard.accounts else 0) for shard in self.users.shards)
+
+        # Ensure a group nobody is in can't be sent to
+        assert g.fan_out("nobody", message, self.mailboxes) is None
+
+    def test_full_mailboxes(self):
+
+        # Ensure full mailboxes are counted without stopping delivery to the others
+        full = mailboxes.Mailboxes(capacity=1)
+        for user_id in ["user1", "user2", "user3"]:
+            full.create(user_id)
+        full["user2"].put(schema.Message(author_id="user1", recipient_id="user2", text="first", success=True))
+        g = groups.Groups(self.users)
+        for user_id in ["user1", "user2", "user3"]:
+            g.join("team", user_id)
+        message = schema.Message(author_id="user1", recipient_id="team", text="hi", success=True)
+        delivered, refused = g.fan_out("team", message, full, skip="user1")
+        assert delivered == ["user3"] and refused == 1
@@ -1,7 +1,11 @@
 import pytest
 import unittest
 from google.protobuf import message as _message
+import os
 import sys
+import tempfile
+import contextlib
+import io
 
 try:
     del sys.modules["server"]
@@ -11,6 +15,7 @@ except:
 sys.path.insert(0, "../part2")
 import client
 import server
+import metrics
 import threading
 import grpc
 import schema_pb2 as schema
@@ -18,6 +23,15 @@ import schema_pb2_grpc as services
 import ctypes
 from concurrent import futures
 
+class Context:
+    """Stands in for a gRPC call's context, keeping its callbacks"""
+
+    def __init__(self):
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
 class Test_GRPC_Server(unittest.TestCase):
     """Test class for our part 2 server code"""
 
@@ -95,6 +109,65 @@ class Test_GRPC_Server(unittest.TestCase):
         ret = s.List(z_lst_req, None)
         assert len(ret.accounts) == 0
 
+    def test_ListStream(self):
+
+        # Create test server
+        executor = futures.ThreadPoolExecutor()
+        s = server.ChatHandlerServicer(executor)
+
+        # Create test users
+        names = ["ream", "mark", "achele", "joe", "bob"]
+        for name in names:
+            req = schema.Credentials(user_id=name)
+            s.Create(req, None)
+
+        # Ensure every match is streamed in pages, in user_id order, with only the last page lacking a cursor
+        pages = list(s.ListStream(schema.ListStreamRequest(wildcard="", page_size=2), None))
+        assert [[a.user_id for a in page.accounts] for page in pages] == [["achele", "bob"], ["joe", "mark"], ["ream"]]
+        assert all(page.success for page in pages)
+        assert all(page.cursor for page in pages[:-1]) and pages[-1].cursor == ""
+
+        # Ensure a cursor resumes right after its page, even once accounts are created and deleted
+        s.Delete(schema.Credentials(user_id="joe"), None)
+        s.Create(schema.Credentials(user_id="amy"), None)
+        resumed = s.ListStream(schema.ListStreamRequest(wildcard="", page_size=2, cursor=pages[0].cursor), None)
+        assert [a.user_id for page in resumed for a in page.accounts] == ["mark", "ream"]
+
+        # Ensure filtering works, and a page size of 0 uses the default
+        pages = list(s.ListStream(schema.ListStreamRequest(wildcard="e"), None))
+        assert len(pages) == 1 and [a.user_id for a in pages[0].accounts] == ["achele", "ream"]
+
+        # Ensure a bad cursor fails
+        pages = list(s.ListStream(schema.ListStreamRequest(wildcard="", cursor="!!"), None))
+        assert len(pages) == 1 and not pages[0].success
+
+    def test_ClientList(self):
+
+        # Create test server and users, and a client whose stub calls it directly, two accounts a page
+        executor = futures.ThreadPoolExecutor()
+        s = server.ChatHandlerServicer(executor)
+        for name in ["ream", "mark", "achele", "joe", "bob"]:
+            s.Create(schema.Credentials(user_id=name), None)
+
+        class Stub:
+            def ListStream(self, request, timeout=None):
+                return s.ListStream(schema.ListStreamRequest(wildcard=request.wildcard, page_size=2), None)
+
+        c = client.Client()
+        c.stub = Stub()
+
+        # Ensure the count comes before the matching accounts, as the client tests expect
+        out = io.StringIO()
+        client.input = lambda prompt : "e"
+        try:
+            with contextlib.redirect_stdout(out):
+                c.handle_list()
+        finally:
+            del client.input
+        lines = out.getvalue().splitlines()
+        assert "3 users matching 'e'" in lines[0]
+        assert lines[1:] == ["achele", "joe", "ream"]
+
     def test_Delete(self):
         # Create test server
         executor = futures.ThreadPoolExecutor()
@@ -116,3 +189,150 @@ class Test_GRPC_Server(unittest.TestCase):
         ret = s.Delete(req, None)
         assert ret.success
         assert len(s.users) == 4
+
+    def test_SendBatch(self):
+        # Create test server
+        executor = futures.ThreadPoolExecutor()
+        s = server.ChatHandlerServicer(executor)
+
+        # Create test users
+        names = ["ream", "mark", "achele"]
+        for name in names:
+            req = schema.Credentials(user_id=name)
+            s.Create(req, None)
+
+        # Send a batch with two recipients and one non-existent user
+        batch = schema.MessageBatch(messages=[
+            schema.Message(author_id="ream", recipient_id="mark", text="one"),
+            schema.Message(author_id="ream", recipient_id="achele", text="two"),
+            schema.Message(author_id="ream", recipient_id="jimmy", text="three"),
+            schema.Message(author_id="ream", recipient_id="mark", text="four"),
+        ])
+        ret = s.SendBatch(batch, None)
+
+        # Ensure there is one status per message, in order
+        assert not ret.success
+        assert list(ret.statuses) == [True, True, False, True]
+
+        # Ensure messages landed in the right mailboxes, in order
+        assert [msg.text for msg in s.msgs_cache["mark"]] == ["one", "four"]
+        assert [msg.text for msg in s.msgs_cache["achele"]] == ["two"]
+
+        # Ensure a batch from a non-existent author is rejected
+        ret = s.SendBatch(schema.MessageBatch(messages=[schema.Message(author_id="jimmy", recipient_id="mark", text="hi")]), None)
+        assert not ret.success
+        assert len(s.msgs_cache["mark"]) == 2
+
+    def test_Groups(self):
+        # Create test server
+        executor = futures.ThreadPoolExecutor()
+        s = server.ChatHandlerServicer(executor)
+
+        # Create test users and put them in a group
+        names = ["ream", "mark", "achele"]
+        for name in names:
+            s.Create(schema.Credentials(user_id=name), None)
+            assert s.JoinGroup(schema.GroupRequest(user_id=name, group_id="team"), None).success
+        assert not s.JoinGroup(schema.GroupRequest(user_id="jimmy", group_id="team"), None).success
+
+        # Ensure every other member's mailbox gets the very same message
+        req = schema.Message(author_id="ream", recipient_id="team", text="hello")
+        assert s.SendGroup(req, None).success
+        assert len(s.msgs_cache["ream"]) == 0
+        assert s.msgs_cache["mark"].get() is s.msgs_cache["achele"].get()
+
+        # Ensure members that left or were deleted get nothing, and an empty group is gone
+        assert s.LeaveGroup(schema.GroupRequest(user_id="mark", group_id="team"), None).success
+        s.Delete(schema.Credentials(user_id="achele"), None)
+        assert s.SendGroup(schema.Message(author_id="ream", recipient_id="team", text="again"), None).success
+        assert len(s.msgs_cache["mark"]) == 0
+        s.LeaveGroup(schema.GroupRequest(user_id="ream", group_id="team"), None)
+        ret = s.SendGroup(schema.Message(author_id="mark", recipient_id="team", text="gone"), None)
+        assert not ret.success and ret.error_message == "Group does not exist"
+
+    def test_Preencode(self):
+        # Create test server that keeps messages serialized
+        executor = futures.ThreadPoolExecutor()
+        s = server.ChatHandlerServicer(executor, preencode=True)
+        for name in ["ream", "mark"]:
+            s.Create(schema.Credentials(user_id=name), None)
+            s.JoinGroup(schema.GroupRequest(user_id=name, group_id="team"), None)
+
+        # Ensure each kind of send stores the serialized message
+        s.Send(schema.Message(author_id="ream", recipient_id="mark", text="hi é"), None)
+        s.SendBatch(schema.MessageBatch(messages=[schema.Message(author_id="ream", recipient_id="mark", text="two")]), None)
+        s.SendGroup(schema.Message(author_id="ream", recipient_id="team", text="all"), None)
+        stored = list(s.msgs_cache["mark"])
+        assert all(isinstance(msg, server.SerializedMessage) for msg in stored)
+        assert [msg.text for msg in stored] == ["hi é", "two", "all"]
+
+        # Ensure Subscribe's serializer passes those bytes through, and they parse back
+        received = [schema.Message.FromString(server.serialize_message(msg)) for msg in stored]
+        assert received == [
+            schema.Message(author_id="ream", recipient_id="mark", text="hi é"),
+            schema.Message(author_id="ream", recipient_id="mark", text="two"),
+            schema.Message(author_id="ream", recipient_id="team", text="all"),
+        ]
+        assert server.serialize_message(received[0]) == stored[0].wire
+
+    def test_SubscribeEvents(self):
+        # Create test server and users, with a message waiting
+        executor = futures.ThreadPoolExecutor()
+        s = server.ChatHandlerServicer(executor)
+        for name in ["ream", "mark"]:
+            s.Create(schema.Credentials(user_id=name), None)
+        s.Send(schema.Message(author_id="mark", recipient_id="ream", text="early"), None)
+        assert s.user_events == {}
+
+        # Ensure a subscription gets an event, and what was waiting first
+        context = Context()
+        stream = s.Subscribe(schema.Credentials(user_id="ream"), context)
+        assert next(stream).text == "early"
+        assert list(s.user_events) == ["ream"]
+
+        # Ensure its event goes away with the client
+        for callback in context.callbacks:
+            callback()
+        assert s.user_events == {}
+        assert not s.users["ream"].is_logged_in
+
+    def test_Stats(self):
+        # Create test server
+        executor = futures.ThreadPoolExecutor()
+        s = server.ChatHandlerServicer(executor)
+
+        # Make some calls, one of which fails
+        for name in ["ream", "mark", "ream"]:
+            s.Create(schema.Credentials(user_id=name), None)
+        s.Send(schema.Message(author_id="ream", recipient_id="mark", text="hi"), None)
+
+        # Ensure the Stats RPC reports them, along with the waiting message
+        ret = s.Stats(schema.BlankRequest(), None)
+        assert ret.success
+        samples = metrics.parse(ret.text)
+        assert samples['chat_request_seconds_count{op="Create"}'] == 3
+        assert samples['chat_request_failures_total{op="Create"}'] == 1
+        assert samples['chat_request_seconds_count{op="Send"}'] == 1
+        assert samples["chat_received_bytes_total"] > 0
+        assert samples["chat_mailbox_depth_sum"] == 1
+
+    def test_Recover(self):
+        log_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(log_dir.name, "chat.log")
+
+        # Create test users and send messages with a log
+        executor = futures.ThreadPoolExecutor()
+        s = server.ChatHandlerServicer(executor, log_path=path)
+        for name in ["ream", "mark"]:
+            s.Create(schema.Credentials(user_id=name), None)
+        s.Send(schema.Message(author_id="ream", recipient_id="mark", text="hi é"), None)
+        s.SendBatch(schema.MessageBatch(messages=[schema.Message(author_id="mark", recipient_id="ream", text="yo")]), None)
+        s.log.close()
+
+        # Ensure a restarted server gets back the accounts and the waiting messages
+        s = server.ChatHandlerServicer(executor, log_path=path)
+        assert sorted(account.user_id for account in s.users.values()) == ["mark", "ream"]
+        assert [(msg.author_id, msg.text) for msg in s.msgs_cache["mark"]] == [("ream", "hi é")]
+        assert [msg.text for msg in s.msgs_cache["ream"]] == ["yo"]
+        s.log.close()
+        log_dir.cleanup()
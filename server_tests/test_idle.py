@@ -0,0 +1,74 @@
+import unittest
+import sys
+
+sys.path.insert(0, "..")
+import idle
+
+class Connection:
+    """Anything with a last_active attribute can be tracked"""
+
+    last_active = None
+
+class Clock:
+    """A clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class Test_idle(unittest.TestCase):
+    """Test class for the timer wheel in idle.py"""
+
+    def test_expire(self):
+
+        # Track three connections in a wheel with a 10 second timeout
+        clock = Clock()
+        wheel = idle.TimerWheel(10, resolution=1, clock=clock)
+        quiet, chatty, gone = Connection(), Connection(), Connection()
+        for connection in [quiet, chatty, gone]:
+            wheel.add(connection)
+        wheel.remove(gone)
+        assert len(wheel) == 2
+
+        # Ensure nothing expires before the timeout, however often it is checked
+        for _ in range(9):
+            clock.now += 1
+            wheel.touch(chatty)
+            assert wheel.expire() == []
+
+        # Ensure only the connection that went quiet expires, within a tick of its deadline
+        clock.now += 2
+        assert wheel.expire() == [quiet]
+        assert len(wheel) == 1
+
+        # Ensure the touched connection expires once it goes quiet too, even if nothing checks for a while
+        clock.now += 100
+        assert wheel.expire() == [chatty]
+        assert len(wheel) == 0
+        assert wheel.expire() == []
+
+    def test_many(self):
+
+        # Track a connection added every tenth of a second, touching every other one
+        clock = Clock()
+        wheel = idle.TimerWheel(5, resolution=0.5, clock=clock)
+        connections = []
+        expired = []
+        for i in range(200):
+            connection = Connection()
+            wheel.add(connection)
+            connections.append(connection)
+            for other in connections[::2]:
+                wheel.touch(other)
+            clock.now += 0.1
+            expired.extend(wheel.expire())
+
+        # Ensure only untouched connections idle for over 5 seconds expired, each once and no more than a tick late
+        untouched = set(map(id, connections[1::2]))
+        assert len(set(map(id, expired))) == len(expired)
+        assert all(id(connection) in untouched and clock.now - connection.last_active > 5 for connection in expired)
+        late = [connection for connection in connections[1::2] if clock.now - connection.last_active > 6]
+        assert len(late) > 0 and all(connection in expired for connection in late)
+        assert len(wheel) == len(connections) - len(expired)
@@ -0,0 +1,90 @@
+import unittest
+import sys
+
+sys.path.insert(0, "..")
+import mailboxes
+
+class Test_mailboxes(unittest.TestCase):
+    """Test class for the per-user message queues"""
+
+    def test_order(self):
+
+        # Queue messages one at a time and in a batch
+        mailbox = mailboxes.Mailbox()
+        assert mailbox.put("a")
+        assert mailbox.put_many(["b", "c", "d"]) == 3
+        assert list(mailbox) == ["a", "b", "c", "d"]
+
+        # Ensure they come back out oldest first
+        assert mailbox.get() == "a"
+        assert mailbox.take(2) == ["b", "c"]
+        assert mailbox.take() == ["d"]
+        assert mailbox.get() is None
+        assert len(mailbox) == 0
+
+    def test_empty(self):
+
+        # Ensure an empty mailbox holds no deque, before and after it had messages
+        mailbox = mailboxes.Mailbox(capacity=2, overflow=mailboxes.DROP_OLDEST)
+        assert mailbox.messages is mailboxes.EMPTY
+        assert mailbox.take() == [] and mailbox.put_many([]) == 0
+        assert mailbox.messages is mailboxes.EMPTY
+        mailbox.put_many(["a", "b", "c"])
+        assert list(mailbox) == ["b", "c"]
+        assert mailbox.get() == "b" and mailbox.get() == "c"
+        assert mailbox.messages is mailboxes.EMPTY
+
+        # Ensure a new deque is still bounded
+        mailbox.put_many(["d", "e", "f"])
+        assert mailbox.take() == ["e", "f"]
+        assert mailbox.messages is mailboxes.EMPTY
+
+    def test_reject(self):
+
+        # Fill a mailbox that refuses new messages
+        mailbox = mailboxes.Mailbox(capacity=3, overflow=mailboxes.REJECT)
+        assert mailbox.put_many(["a", "b"]) == 2
+
+        # Ensure a batch only gets in as far as there is room, and the rest is refused
+        assert mailbox.put_many(["c", "d", "e"]) == 1
+        assert not mailbox.put("f")
+        assert list(mailbox) == ["a", "b", "c"]
+        assert mailbox.dropped == 3
+
+        # Ensure taking a message makes room again
+        mailbox.get()
+        assert mailbox.put("g")
+        assert list(mailbox) == ["b", "c", "g"]
+
+    def test_drop_oldest(self):
+
+        # Overfill a mailbox that discards its oldest messages
+        mailbox = mailboxes.Mailbox(capacity=3, overflow=mailboxes.DROP_OLDEST)
+        assert mailbox.put_many(["a", "b"]) == 2
+        assert mailbox.put_many(["c", "d", "e"]) == 3
+        assert mailbox.put("f")
+
+        # Ensure only the newest messages are kept
+        assert list(mailbox) == ["d", "e", "f"]
+        assert mailbox.dropped == 3
+
+    def test_mailboxes(self):
+
+        # Ensure every mailbox gets the same settings
+        boxes = mailboxes.Mailboxes(capacity=2, overflow=mailboxes.DROP_OLDEST)
+        boxes.create("ream")
+        assert "ream" in boxes and boxes["ream"].capacity == 2
+        assert boxes.get("mark") is None
+
+        # Ensure deleting a mailbox discards its messages
+        boxes["ream"].put("hi")
+        boxes.delete("ream")
+        assert "ream" not in boxes
+        boxes.create("ream")
+        assert len(boxes["ream"]) == 0
+
+        # Ensure bad settings are caught up front
+        with self.assertRaises(Exception):
+            mailboxes.Mailboxes(overflow="explode")
+        with self.assertRaises(Exception):
+            mailboxes.Mailboxes(capacity=0)
@@ -0,0 +1,74 @@
+import unittest
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, "..")
+import message_log
+
+class Test_message_log(unittest.TestCase):
+    """Test class for the durable message log"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "chat.log")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_records(self):
+
+        # Log a few records and ensure they are read back
+        log = message_log.MessageLog(self.path)
+        log.append(message_log.CREATE, b"ream")
+        log.append(message_log.SEND, b"ream", b"mark", "hi é".encode("utf-8"), b"joe", b"")
+        log.commit()
+        log.close()
+        records, length = message_log.read_records(self.path)
+        assert records == [(message_log.CREATE, [b"ream"]), (message_log.SEND, [b"ream", b"mark", "hi é".encode("utf-8"), b"joe", b""])]
+        assert length == os.path.getsize(self.path)
+
+        # Ensure a torn record at the end is dropped, and cut off before appending more
+        with open(self.path, "ab") as f:
+            f.write(message_log.encode_record(message_log.DELETE, b"ream")[:-2])
+        log = message_log.MessageLog(self.path, message_log.NEVER)
+        assert len(log.recovered) == 2
+        assert os.path.getsize(self.path) == length
+        log.append(message_log.DELETE, b"ream")
+        log.close()
+        assert [kind for kind, _ in message_log.read_records(self.path)[0]] == [message_log.CREATE, message_log.SEND, message_log.DELETE]
+
+        # Ensure bad settings are caught up front
+        with self.assertRaises(Exception):
+            message_log.MessageLog(self.path, "sometimes")
+
+    def test_group_commit(self):
+
+        # Commit from many threads at once
+        log = message_log.MessageLog(self.path)
+        def send(i):
+            for j in range(50):
+                log.commit(log.append(message_log.SEND, b"ream", str(i).encode(), str(j).encode()))
+        threads = [threading.Thread(target=send, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Ensure every record is durable
+        assert log.durable == log.appended == 400
+        assert len(message_log.read_records(self.path)[0]) == 400
+
+        # Ensure one commit writes everything appended before it at once
+        syncs = log.syncs
+        seqs = [log.append(message_log.DELIVER, b"ream", b"1") for _ in range(10)]
+        log.commit(seqs[0])
+        assert log.syncs == syncs + 1 and log.durable == seqs[-1]
+        log.close()
+
+        # Ensure the interval policy doesn't wait but still gets there
+        log = message_log.MessageLog(self.path, message_log.INTERVAL, interval=0.001)
+        log.commit(log.append(message_log.CREATE, b"mark"))
+        log.close()
+        assert len(message_log.read_records(self.path)[0]) == 411
@@ -0,0 +1,70 @@
+import unittest
+import sys
+import urllib.request
+
+sys.path.insert(0, "..")
+import mailboxes
+import metrics
+import schema
+
+class Test_metrics(unittest.TestCase):
+    """Test class for the counters and histograms in metrics.py"""
+
+    def test_Histogram(self):
+
+        # Ensure observations land in the first bucket whose bound they don't exceed
+        histogram = metrics.Histogram([1, 10, 100])
+        for value in [0, 1, 2, 10, 50, 1000]:
+            histogram.observe(value, success=value != 50)
+        counts, total, failures = histogram.read()
+        assert counts == [2, 2, 1, 1]
+        assert total == 1063
+        assert failures == 1
+
+    def test_render(self):
+
+        # Record a few requests, bytes and a session against some mailboxes
+        boxes = mailboxes.Mailboxes()
+        for user_id in ["ream", "mark"]:
+            boxes.create(user_id)
+        for i in range(12):
+            boxes["ream"].put(schema.Message(author_id="mark", recipient_id="ream", text=str(i), success=True))
+        m = metrics.Metrics(["send", "list", metrics.DELIVER], boxes)
+        m.observe("send", 0.00002)
+        m.observe("send", 0.003, success=False)
+        m.deliver(0.0001, 5)
+        m.received(100)
+        m.sent(40)
+        m.session_started()
+
+        # Ensure every sample reads back, with cumulative buckets
+        samples = metrics.parse(m.render())
+        assert samples['chat_request_seconds_bucket{op="send",le="2.5e-05"}'] == 1
+        assert samples['chat_request_seconds_bucket{op="send",le="+Inf"}'] == 2
+        assert samples['chat_request_seconds_count{op="send"}'] == 2
+        assert samples['chat_request_seconds_count{op="list"}'] == 0
+        assert samples['chat_request_failures_total{op="send"}'] == 1
+        assert samples['chat_request_seconds_count{op="deliver"}'] == 1
+        assert samples["chat_delivered_messages_total"] == 5
+        assert samples["chat_received_bytes_total"] == 100
+        assert samples["chat_sent_bytes_total"] == 40
+        assert samples["chat_sessions"] == 1
+
+        # Ensure the mailbox depths are bucketed when rendered
+        assert samples['chat_mailbox_depth_bucket{le="0"}'] == 1
+        assert samples['chat_mailbox_depth_bucket{le="10"}'] == 1
+        assert samples['chat_mailbox_depth_bucket{le="100"}'] == 2
+        assert samples["chat_mailbox_depth_sum"] == 12
+
+    def test_serve_metrics(self):
+
+        # Ensure the metrics port serves the same dump
+        m = metrics.Metrics(["send"])
+        m.observe("send", 0.001)
+        httpd = metrics.serve_metrics(m, 0)
+        with urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(httpd.server_address[1]), timeout=5) as resp:
+            assert resp.headers["Content-Type"].startswith("text/plain")
+            samples = metrics.parse(resp.read().decode())
+        assert samples['chat_request_seconds_count{op="send"}'] == 1
+        httpd.shutdown()
+        httpd.server_close()
@@ -8,11 +8,28 @@ except:
     pass
 sys.path.insert(0, "..")
 import server
+import async_server
+import cluster
 import schema
+import snapshot
+import coding
+import framing
+import asyncio
 import client
 import threading
 import grpc
 import ctypes
+import contextlib
+import io
+import idle
+import mailboxes
+import message_log
+import multiprocessing
+import metrics
+import os
+import socket
+import tempfile
+import time
 from concurrent import futures
 
 class Test_server(unittest.TestCase):
@@ -82,6 +99,7 @@ class Test_server(unittest.TestCase):
         empty_lst_req = schema.ListRequest(user_id='ream',wildcard="", page=0)
         ret = s.handle_list(empty_lst_req)
         assert len(ret.accounts) == 4
+        assert [account.user_id for account in ret.accounts] == ["achele", "bob", "joe", "mark"]
 
         # Ensure pagination works
         empty_lst_req = schema.ListRequest(user_id='ream',wildcard="", page=1)
@@ -120,3 +138,647 @@ class Test_server(unittest.TestCase):
         ret = s.handle_delete(req)
         assert ret.success
         assert len(s.users) == 4
+
+    def test_SendBatch(self):
+        # Create test server
+        executor = futures.ThreadPoolExecutor()
+        s = server.Server(host='127.0.0.1', port='50051', executor=executor)
+
+        # Create test users
+        names = ["ream", "mark", "achele"]
+        for name in names:
+            req = schema.Request(user_id=name)
+            s.handle_create(req)
+
+        # Send a batch with two recipients and one non-existent user
+        messages = [
+            schema.SendRequest(user_id="ream", recipient_id="mark", text="one"),
+            schema.SendRequest(user_id="ream", recipient_id="achele", text="two"),
+            schema.SendRequest(user_id="ream", recipient_id="jimmy", text="three"),
+            schema.SendRequest(user_id="ream", recipient_id="mark", text="four"),
+        ]
+        s.user_events["mark"] = threading.Event() # As if a thread were watching mark's messages
+        ret = s.handle_send_batch(schema.BatchSendRequest(user_id="ream", messages=messages))
+
+        # Ensure there is one status per message, in order
+        assert not ret.success
+        assert ret.statuses == [True, True, False, True]
+
+        # Ensure messages landed in the right mailboxes, in order
+        assert [msg.text for msg in s.msgs_cache["mark"]] == ["one", "four"]
+        assert [msg.text for msg in s.msgs_cache["achele"]] == ["two"]
+        assert s.user_events["mark"].is_set()
+
+    def test_Groups(self):
+        # Create test server
+        executor = futures.ThreadPoolExecutor()
+        s = server.Server(host='127.0.0.1', port='50051', executor=executor)
+
+        # Create test users and put all but one in a group
+        names = ["ream", "mark", "achele", "joe"]
+        for name in names:
+            s.handle_create(schema.Request(user_id=name))
+        for name in names[:3]:
+            assert s.handle_join_group(schema.GroupRequest(user_id=name, group_id="team")).success
+        assert not s.handle_join_group(schema.GroupRequest(user_id="ream", group_id="team")).success
+        assert not s.handle_join_group(schema.GroupRequest(user_id="jimmy", group_id="team")).success
+
+        # Ensure a group send reaches every other member, as one shared message addressed to the group
+        s.user_events["mark"] = threading.Event() # As if a thread were watching mark's messages
+        frame = coding.marshal_send_group_request(schema.GroupSendRequest(user_id="ream", group_id="team", text="hello"))
+        ret = s.handle_frame(frame, server.Session())
+        assert coding.unmarshal_response(ret).success
+        assert len(s.msgs_cache["ream"]) == 0 and len(s.msgs_cache["joe"]) == 0
+        shared = s.msgs_cache["mark"].get()
+        assert shared is s.msgs_cache["achele"].get()
+        assert shared.recipient_id == "team" and shared.text == "hello"
+        assert s.user_events["mark"].is_set()
+
+        # Ensure members get their copy through get_many like any other message
+        s.handle_send_group(schema.GroupSendRequest(user_id="mark", group_id="team", text="again"))
+        resp = s.handle_get_many(schema.GetManyRequest(user_id="achele", max_count=10, max_bytes=4096))
+        assert [(msg.author_id, msg.text) for msg in resp.messages] == [("mark", "again")]
+
+        # Ensure leaving and deleting accounts take users out of the group, and an empty group is gone
+        assert s.handle_leave_group(schema.GroupRequest(user_id="mark", group_id="team")).success
+        assert not s.handle_leave_group(schema.GroupRequest(user_id="mark", group_id="team")).success
+        s.handle_delete(schema.Request(user_id="achele"))
+        s.handle_send_group(schema.GroupSendRequest(user_id="joe", group_id="team", text="left"))
+        assert len(s.msgs_cache["mark"]) == 0
+        assert [msg.text for msg in s.msgs_cache["ream"]] == ["again", "left"]
+        s.handle_leave_group(schema.GroupRequest(user_id="ream", group_id="team"))
+        ret = s.handle_send_group(schema.GroupSendRequest(user_id="joe", group_id="team", text="gone"))
+        assert not ret.success and ret.error_message == "Group does not exist"
+
+    def test_GetMany(self):
+        # Create test server
+        executor = futures.ThreadPoolExecutor()
+        s = server.Server(host='127.0.0.1', port='50051', executor=executor)
+        s.handle_create(schema.Request(user_id="ream"))
+        s.handle_create(schema.Request(user_id="mark"))
+
+        # Ensure an empty mailbox reports failure
+        ret = s.handle_get_many(schema.GetManyRequest(user_id="mark", max_count=10, max_bytes=10000))
+        assert not ret.success
+        assert len(ret.messages) == 0
+
+        # Queue up some messages
+        for i in range(5):
+            s.handle_send(schema.SendRequest(user_id="ream", recipient_id="mark", text=str(i)))
+
+        # Ensure the count limit is respected and messages come out in order
+        ret = s.handle_get_many(schema.GetManyRequest(user_id="mark", max_count=3, max_bytes=10000))
+        assert ret.success
+        assert [msg.text for msg in ret.messages] == ["0", "1", "2"]
+
+        # Ensure the byte budget is respected, but at least one message is returned
+        ret = s.handle_get_many(schema.GetManyRequest(user_id="mark", max_count=10, max_bytes=1))
+        assert [msg.text for msg in ret.messages] == ["3"]
+        ret = s.handle_get_many(schema.GetManyRequest(user_id="mark", max_count=10, max_bytes=10000))
+        assert [msg.text for msg in ret.messages] == ["4"]
+        assert len(s.msgs_cache["mark"]) == 0
+
+        # Ensure an unknown user fails, and the requests pipelined behind it are still answered
+        ret = s.handle_get_many(schema.GetManyRequest(user_id="jimmy", max_count=10, max_bytes=10000))
+        assert not ret.success and ret.error_message == "User does not exist"
+        decoder = framing.FrameDecoder()
+        decoder.feed(framing.frame_all([
+            coding.marshal_get_many_request(schema.GetManyRequest(user_id="jimmy", max_count=10, max_bytes=10000)),
+            coding.marshal_health_request(schema.Request(user_id="mark")),
+        ]))
+        replies = framing.FrameDecoder()
+        replies.feed(s.handle_frames(decoder, server.Session()))
+        assert coding.unmarshal_response(replies.next_frame()).error_message == "User does not exist"
+        assert coding.unmarshal_response(replies.next_frame()).success
+
+    def test_Preencode(self):
+        # Create a test server that pre-encodes messages, and one that doesn't
+        servers = [server.Server(host="127.0.0.1", port=0, executor=None, preencode=preencode) for preencode in [True, False]]
+        for s in servers:
+            for name in ["ream", "mark", "achele"]:
+                s.handle_create(schema.Request(user_id=name))
+                s.handle_join_group(schema.GroupRequest(user_id=name, group_id="team"))
+            s.handle_send(schema.SendRequest(user_id="ream", recipient_id="mark", text="hi é"))
+            s.handle_send_batch(schema.BatchSendRequest(user_id="ream", messages=[schema.SendRequest(user_id="ream", recipient_id="mark", text="two")]))
+            s.handle_send_group(schema.GroupSendRequest(user_id="ream", group_id="team", text="all"))
+
+        # Ensure every stored message carries its encoding, and only with preencode
+        assert all(msg.wire == coding.encode_message_v1(msg) for msg in servers[0].msgs_cache["mark"])
+        assert all(msg.wire is None for msg in servers[1].msgs_cache["mark"])
+
+        # Ensure both deliver the very same bytes
+        responses = []
+        for s in servers:
+            message = coding.marshal_response_v1(s.handle_get_messages(schema.Request(user_id="mark")))
+            messages = coding.marshal_response_v1(s.handle_get_many(schema.GetManyRequest(user_id="mark", max_count=10, max_bytes=10000)))
+            responses.append((message, messages))
+        assert responses[0] == responses[1]
+        assert [msg.text for msg in coding.unmarshal_response_v1(responses[0][1]).messages] == ["two", "all"]
+
+    def test_MailboxCapacity(self):
+        # Create test server whose mailboxes hold two messages
+        executor = futures.ThreadPoolExecutor()
+        s = server.Server(host='127.0.0.1', port='50051', executor=executor, mailbox_capacity=2)
+        s.handle_create(schema.Request(user_id="ream"))
+        s.handle_create(schema.Request(user_id="mark"))
+
+        # Ensure sends to a full mailbox fail
+        assert s.handle_send(schema.SendRequest(user_id="ream", recipient_id="mark", text="one")).success
+        assert s.handle_send(schema.SendRequest(user_id="ream", recipient_id="mark", text="two")).success
+        ret = s.handle_send(schema.SendRequest(user_id="ream", recipient_id="mark", text="three"))
+        assert not ret.success
+        assert ret.error_message == "Mailbox is full"
+
+        # Ensure a batch reports which messages did not fit
+        s.handle_get_messages(schema.Request(user_id="mark"))
+        req = schema.BatchSendRequest(user_id="ream", messages=[
+            schema.SendRequest(user_id="ream", recipient_id="mark", text="four"),
+            schema.SendRequest(user_id="ream", recipient_id="ream", text="five"),
+            schema.SendRequest(user_id="ream", recipient_id="mark", text="six"),
+        ])
+        ret = s.handle_send_batch(req)
+        assert ret.statuses == [True, True, False]
+        assert ret.error_message == "Some mailboxes are full"
+        assert [msg.text for msg in s.msgs_cache["mark"]] == ["two", "four"]
+
+    def test_Recover(self):
+        log_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(log_dir.name, "chat.log")
+
+        # Create users, send them messages, deliver some and delete one
+        s = server.Server(host="127.0.0.1", port=0, executor=None, mailbox_capacity=2, overflow=mailboxes.DROP_OLDEST, log_path=path)
+        for name in ["ream", "mark", "joe"]:
+            s.handle_create(schema.Request(user_id=name))
+        for text in ["a", "b", "c", "é"]:
+            s.handle_send(schema.SendRequest(user_id="mark", recipient_id="ream", text=text))
+        s.handle_send_batch(schema.BatchSendRequest(user_id="ream", messages=[
+            schema.SendRequest(user_id="ream", recipient_id="mark", text="x"),
+            schema.SendRequest(user_id="ream", recipient_id="joe", text="y"),
+        ]))
+        assert s.handle_get_messages(schema.Request(user_id="ream")).text == "c"
+        s.handle_delete(schema.Request(user_id="joe"))
+        s.commit_log()
+        s.log.close()
+
+        # Ensure a restarted server gets back the accounts (logged out) and the waiting messages
+        s = server.Server(host="127.0.0.1", port=0, executor=None, mailbox_capacity=2, overflow=mailboxes.DROP_OLDEST, log_path=path)
+        assert sorted(account.user_id for account in s.users.values()) == ["mark", "ream"]
+        assert not s.users["ream"].is_logged_in
+        assert s.handle_login(schema.Request(user_id="ream")).success
+        assert [msg.text for msg in s.msgs_cache["ream"]] == ["é"]
+        assert [(msg.author_id, msg.text) for msg in s.msgs_cache["mark"]] == [("ream", "x")]
+        assert s.handle_list(schema.ListRequest(user_id="ream", wildcard="", page=0)).accounts[0].user_id == "mark"
+
+        # Ensure that state was checkpointed into a snapshot, and the log starts over
+        assert message_log.read_records(path)[0] == []
+        assert [user_id for user_id, _ in snapshot.load(path + ".snapshot").users] == ["ream", "mark"]
+        s.handle_send(schema.SendRequest(user_id="mark", recipient_id="ream", text="z"))
+        s.log.close()
+        s = server.Server(host="127.0.0.1", port=0, executor=None, log_path=path)
+        assert [msg.text for msg in s.msgs_cache["ream"]] == ["é", "z"]
+        s.log.close()
+        log_dir.cleanup()
+
+    def test_Subscribe(self):
+
+        # Create test server and users
+        executor = futures.ThreadPoolExecutor()
+        s = server.Server(host='127.0.0.1', port='50051', executor=executor)
+        s.handle_create(schema.Request(user_id="ream"))
+        s.handle_create(schema.Request(user_id="mark"))
+        s.handle_send(schema.SendRequest(user_id="mark", recipient_id="ream", text="early"))
+
+        # Ensure subscribing to a missing user fails
+        assert not s.handle_subscribe(schema.GetManyRequest(user_id="nobody", max_count=8, max_bytes=4096)).success
+
+        # Serve a watch connection on its own thread
+        client_sock, server_sock = socket.socketpair()
+        client_sock.settimeout(5)
+        thread = threading.Thread(target=s.handle_connection, args=(server_sock, None), daemon=True)
+        thread.start()
+        decoder = framing.FrameDecoder()
+
+        # Ensure the subscribe response drains what was already waiting
+        client_sock.sendall(framing.frame(coding.marshal_subscribe_request(schema.GetManyRequest(user_id="ream", max_count=8, max_bytes=4096))))
+        resp = coding.unmarshal_response(framing.recv_frame(client_sock, decoder))
+        assert resp.success
+        assert [msg.text for msg in resp.messages] == ["early"]
+
+        # Ensure new messages are pushed without being asked for
+        s.handle_send(schema.SendRequest(user_id="mark", recipient_id="ream", text="pushed"))
+        resp = coding.unmarshal_response(framing.recv_frame(client_sock, decoder))
+        assert [msg.text for msg in resp.messages] == ["pushed"]
+        assert len(s.msgs_cache["ream"]) == 0
+
+        # Ensure only the watched user has a wake-up event
+        assert "ream" in s.user_events and "mark" not in s.user_events
+
+        # Ensure deleting the user ends the watch, and drops its event
+        s.handle_delete(schema.Request(user_id="ream"))
+        thread.join(5)
+        assert not thread.is_alive()
+        assert "ream" not in s.user_events
+        client_sock.close()
+
+    def test_SubscribedCommits(self):
+        log_dir = tempfile.TemporaryDirectory()
+
+        # Create test server with a log, and subscribe on a watch connection
+        s = server.Server(host="127.0.0.1", port=0, executor=None, log_path=os.path.join(log_dir.name, "chat.log"))
+        for name in ["ream", "mark"]:
+            s.handle_create(schema.Request(user_id=name))
+        s.commit_log()
+        client_sock, server_sock = socket.socketpair()
+        client_sock.settimeout(5)
+        thread = threading.Thread(target=s.handle_connection, args=(server_sock, None), daemon=True)
+        thread.start()
+        decoder = framing.FrameDecoder()
+        client_sock.sendall(framing.frame(coding.marshal_subscribe_request(schema.GetManyRequest(user_id="ream", max_count=8, max_bytes=4096))))
+        assert coding.unmarshal_response(framing.recv_frame(client_sock, decoder)).success
+
+        # Ensure a send on the subscribed connection is durable before it is acknowledged
+        client_sock.sendall(framing.frame(coding.marshal_send_request(schema.SendRequest(user_id="ream", recipient_id="mark", text="hi"))))
+        assert coding.unmarshal_response(framing.recv_frame(client_sock, decoder)).success
+        assert s.log.durable == s.log.appended
+
+        s.handle_delete(schema.Request(user_id="ream"))
+        thread.join(5)
+        client_sock.close()
+        s.log.close()
+        log_dir.cleanup()
+
+    def test_TaggedFrames(self):
+
+        # Create test server
+        s = server.Server(host="127.0.0.1", port=0, executor=None)
+        session = server.Session()
+
+        # Ensure a tagged request gets its reply in a tagged frame with the same id
+        data = coding.marshal_request(schema.Request(user_id="ream"), "create", coding.VERSION_1)
+        reply = s.handle_frame(memoryview(framing.tag(7, data)), session)
+        request_id, payload = framing.untag(reply)
+        assert request_id == 7 and coding.unmarshal_response(payload).success
+        assert session.user_id == "ream"
+
+        # Ensure untagged requests still get untagged replies
+        assert not framing.is_tagged(s.handle_frame(memoryview(data), session))
+
+        # Ensure a tagged frame holding no valid request still gets a (failed) reply
+        request_id, payload = framing.untag(s.handle_frame(memoryview(framing.tag(8, b"?")), session))
+        resp = coding.unmarshal_response(payload)
+        assert request_id == 8 and not resp.success and resp.error_message == "Invalid request"
+
+        # Ensure a tagged frame too short for its request_id is dropped, and the frames after it are still answered
+        decoder = framing.FrameDecoder()
+        decoder.feed(framing.frame_all([framing.TAGGED + b"\0\0", framing.tag(9, data)]))
+        replies = framing.FrameDecoder()
+        replies.feed(s.handle_frames(decoder, session))
+        request_id, _ = framing.untag(replies.next_frame())
+        assert request_id == 9 and replies.next_frame() is None
+
+    def test_CompactModel(self):
+
+        # Create test server and queue up a message
+        s = server.Server(host="127.0.0.1", port=0, executor=None)
+        for name in ["ream", "mark"]:
+            s.handle_create(schema.Request(user_id=name))
+        s.handle_frame(coding.marshal_send_request(schema.SendRequest(user_id="ream", recipient_id="mark", text="hi")), server.Session())
+
+        # Ensure accounts and messages carry no __dict__
+        message = s.msgs_cache["mark"].get()
+        for obj in [s.users["ream"], message, schema.Response(user_id="ream", success=True, error_message="")]:
+            assert not hasattr(obj, "__dict__")
+        assert message.type == "message" and schema.fields(message)["text_bytes"] == b"hi"
+
+        # Ensure the message shares its user_ids with the accounts rather than copying them
+        assert message.author_id is s.users["ream"].user_id
+        assert message.recipient_id is s.users["mark"].user_id
+
+        # Ensure nobody has a wake-up event until a thread watches their messages
+        assert s.user_events == {}
+
+    def test_Stats(self):
+
+        # Serve a connection on its own thread
+        executor = futures.ThreadPoolExecutor()
+        s = server.Server(host='127.0.0.1', port='50051', executor=executor)
+        client_sock, server_sock = socket.socketpair()
+        client_sock.settimeout(5)
+        thread = threading.Thread(target=s.handle_connection, args=(server_sock, None), daemon=True)
+        thread.start()
+        decoder = framing.FrameDecoder()
+
+        def request(data):
+            client_sock.sendall(framing.frame(data))
+            return coding.unmarshal_response(framing.recv_frame(client_sock, decoder))
+
+        # Make some requests, one of which fails
+        request(coding.marshal_create_request(schema.Request(user_id="ream")))
+        request(coding.marshal_create_request(schema.Request(user_id="ream")))
+        request(coding.marshal_request(schema.SendRequest(user_id="ream", recipient_id="ream", text="hi"), "send", coding.VERSION_1))
+
+        # Ensure the stats op reports them, along with the connection and the waiting message
+        resp = request(coding.marshal_request(schema.Request(user_id="ream"), "stats", coding.VERSION_1))
+        assert resp.success
+        samples = metrics.parse(resp.text)
+        assert samples['chat_request_seconds_count{op="create"}'] == 2
+        assert samples['chat_request_failures_total{op="create"}'] == 1
+        assert samples['chat_request_seconds_count{op="send"}'] == 1
+        assert samples["chat_sessions"] == 1
+        assert samples["chat_received_bytes_total"] > 0 and samples["chat_sent_bytes_total"] > 0
+        assert samples['chat_mailbox_depth_bucket{le="0"}'] == 0
+        assert samples["chat_mailbox_depth_sum"] == 1
+
+        # Ensure closing the connection ends the session
+        client_sock.close()
+        thread.join(5)
+        assert metrics.parse(s.metrics.render())["chat_sessions"] == 0
+
+    def test_IdleConnections(self):
+
+        # Serve a logged in connection and a subscribed one, with a clock that only moves when told to
+        executor = futures.ThreadPoolExecutor()
+        s = server.Server(host='127.0.0.1', port='50051', executor=executor, idle_timeout=10)
+        now = [1000.0]
+        s.idle = idle.TimerWheel(10, resolution=1, clock=lambda : now[0])
+        s.handle_create(schema.Request(user_id="mark"))
+        connections = []
+        for _ in range(2):
+            client_sock, server_sock = socket.socketpair()
+            client_sock.settimeout(5)
+            thread = threading.Thread(target=s.handle_connection, args=(server_sock, None), daemon=True)
+            thread.start()
+            connections.append((client_sock, thread, framing.FrameDecoder()))
+        (chat_sock, chat_thread, chat_decoder), (watch_sock, watch_thread, watch_decoder) = connections
+        chat_sock.sendall(framing.frame(coding.marshal_create_request(schema.Request(user_id="ream"))))
+        assert coding.unmarshal_response(framing.recv_frame(chat_sock, chat_decoder)).success
+        watch_sock.sendall(framing.frame(coding.marshal_subscribe_request(schema.GetManyRequest(user_id="mark", max_count=8, max_bytes=4096))))
+        assert coding.unmarshal_response(framing.recv_frame(watch_sock, watch_decoder)).success
+
+        # Ensure a heartbeat is read off the subscribed connection, without an answer
+        now[0] += 5
+        watch_sock.sendall(framing.frame(framing.HEARTBEAT))
+        deadline = time.time() + 5
+        while not any(session.last_active == now[0] for session in list(s.idle.slot_of)) and time.time() < deadline:
+            time.sleep(0.05)
+        assert len(s.idle) == 2
+
+        # Ensure the quiet connection is dropped once it times out, which logs its user out
+        now[0] += 7
+        s.reap_idle()
+        chat_thread.join(5)
+        assert not chat_thread.is_alive()
+        assert framing.recv_frame(chat_sock, chat_decoder) is None
+        assert not s.users["ream"].is_logged_in
+        assert watch_thread.is_alive()
+
+        # Ensure the subscribed connection is dropped once its heartbeats stop too
+        now[0] += 10
+        s.reap_idle()
+        watch_thread.join(5)
+        assert not watch_thread.is_alive()
+        assert len(s.idle) == 0
+        assert metrics.parse(s.metrics.render())["chat_sessions"] == 0
+        chat_sock.close()
+        watch_sock.close()
+
+    def test_AsyncIdleConnections(self):
+
+        async def scenario():
+            # Start an async server that drops connections after a third of a second of quiet
+            s = async_server.AsyncServer(host="127.0.0.1", port=0, idle_timeout=0.3)
+            s.idle = idle.TimerWheel(0.3, resolution=0.1)
+            task = asyncio.create_task(s.serve())
+            await asyncio.sleep(0.1)
+            quiet_reader, quiet_writer = await asyncio.open_connection("127.0.0.1", s.port)
+            quiet_writer.write(framing.frame(coding.marshal_create_request(schema.Request(user_id="ream"))))
+            (length,) = framing.FRAME_HEADER.unpack(await quiet_reader.readexactly(framing.FRAME_HEADER_LENGTH))
+            assert coding.unmarshal_response(await quiet_reader.readexactly(length)).success
+            beating_reader, beating_writer = await asyncio.open_connection("127.0.0.1", s.port)
+
+            # Ensure only the connection that sent no heartbeats is dropped, logging its user out
+            for _ in range(10):
+                beating_writer.write(framing.frame(framing.HEARTBEAT))
+                await asyncio.sleep(0.1)
+            assert not s.users["ream"].is_logged_in
+            assert await asyncio.wait_for(quiet_reader.read(), 1) == b""
+            assert len(s.idle) == 1
+            beating_writer.write(framing.frame(coding.marshal_health_request(schema.Request(user_id="mark"))))
+            header = await asyncio.wait_for(beating_reader.readexactly(framing.FRAME_HEADER_LENGTH), 1)
+            (length,) = framing.FRAME_HEADER.unpack(header)
+            assert coding.unmarshal_response(await beating_reader.readexactly(length)).success
+            beating_writer.close()
+            task.cancel()
+
+        asyncio.run(scenario())
+
+    def test_AsyncSubscribe(self):
+
+        async def scenario():
+            s = async_server.AsyncServer(host="127.0.0.1", port=0)
+            task = asyncio.create_task(s.serve())
+            await asyncio.sleep(0.1)
+            s.handle_create(schema.Request(user_id="ream"))
+            reader, writer = await asyncio.open_connection("127.0.0.1", s.port)
+
+            async def read_response():
+                header = await reader.readexactly(framing.FRAME_HEADER_LENGTH)
+                (length,) = framing.FRAME_HEADER.unpack(header)
+                return coding.unmarshal_response(await reader.readexactly(length))
+
+            # Ensure a subscribe with nothing waiting succeeds with no messages
+            writer.write(framing.frame(coding.marshal_request(schema.GetManyRequest(user_id="ream", max_count=2, max_bytes=4096), "subscribe", coding.VERSION_1)))
+            resp = await read_response()
+            assert resp.success and len(resp.messages) == 0
+            assert "ream" in s.watchers
+
+            # Ensure a burst of sends is pushed, max_count messages at a time
+            for i in range(3):
+                s.handle_send(schema.SendRequest(user_id="ream", recipient_id="ream", text=str(i)))
+            first, second = await read_response(), await read_response()
+            assert [msg.text for msg in first.messages + second.messages] == ["0", "1", "2"]
+
+            # Ensure closing the connection stops the pushing
+            writer.close()
+            await asyncio.sleep(0.1)
+            assert "ream" not in s.watchers
+            task.cancel()
+
+        asyncio.run(scenario())
+
+    def test_AsyncServer(self):
+
+        async def scenario():
+            # Start an async server and connect to it
+            s = async_server.AsyncServer(host="127.0.0.1", port=0)
+            task = asyncio.create_task(s.serve())
+            await asyncio.sleep(0.1)
+            reader, writer = await asyncio.open_connection("127.0.0.1", s.port)
+
+            # Pipeline requests in one write and ensure each gets its reply, in order
+            writer.write(framing.frame_all([
+                coding.marshal_create_request(schema.Request(user_id="ream")),
+                coding.marshal_create_request(schema.Request(user_id="ream")),
+                coding.marshal_request(schema.SendRequest(user_id="ream", recipient_id="ream", text="hi"), "send", coding.VERSION_1),
+                coding.marshal_get_request(schema.Request(user_id="ream")),
+            ]))
+            replies = []
+            for _ in range(4):
+                header = await reader.readexactly(framing.FRAME_HEADER_LENGTH)
+                (length,) = framing.FRAME_HEADER.unpack(header)
+                replies.append(coding.unmarshal_response(await reader.readexactly(length)))
+            assert [resp.success for resp in replies] == [True, False, True, True]
+            assert replies[3].text == "hi"
+            assert s.users["ream"].is_logged_in
+
+            # Ensure closing the connection logs the user out
+            writer.close()
+            await asyncio.sleep(0.1)
+            assert not s.users["ream"].is_logged_in
+            task.cancel()
+
+        asyncio.run(scenario())
+
+    def test_WorkerLogout(self):
+
+        async def scenario():
+            # Create a worker whose only peer can't be reached
+            s = cluster.WorkerServer("127.0.0.1", 0, 0, 2, tempfile.mkdtemp())
+            s.peers[1] = cluster.Peer(s.socket_path(1))
+            session = server.Session()
+            session.user_id = [name for name in ["user{}".format(i) for i in range(20)] if cluster.owner_of(name, 2) == 1][0]
+
+            # Ensure a logout that can't be forwarded is reported
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                s.end_session(session)
+                await asyncio.sleep(0)
+            assert out.getvalue() == "Error: Worker unavailable\n"
+
+        asyncio.run(scenario())
+
+    def test_ClusterSpawn(self):
+
+        # Pick a free port, and start workers the way macOS does by default
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        c = cluster.Cluster("127.0.0.1", port, workers=2, codec="struct")
+        fork = cluster.multiprocessing
+        cluster.multiprocessing = multiprocessing.get_context("spawn")
+        try:
+            c.launch()
+
+            # Ensure the workers come up and answer requests
+            deadline = time.time() + 20
+            while True:
+                try:
+                    conn = socket.create_connection(("127.0.0.1", port))
+                    break
+                except OSError:
+                    assert time.time() < deadline and all(process.is_alive() for process in c.processes)
+                    time.sleep(0.1)
+            conn.settimeout(10)
+            conn.sendall(framing.frame(coding.marshal_health_request(schema.Request(user_id="ream"))))
+            assert coding.unmarshal_response(framing.recv_frame(conn, framing.FrameDecoder())).success
+            conn.close()
+        finally:
+            cluster.multiprocessing = fork
+            c.stop()
+
+    def test_WorkerServer(self):
+
+        async def scenario():
+            # Start a two worker cluster in this process and connect to worker 0 only
+            socket_dir = tempfile.mkdtemp()
+            workers = [cluster.WorkerServer("127.0.0.1", 0, index, 2, socket_dir) for index in range(2)]
+            tasks = [asyncio.create_task(w.serve()) for w in workers]
+            await asyncio.sleep(0.2)
+            reader, writer = await asyncio.open_connection("127.0.0.1", workers[0].port)
+
+            async def round_trip(requests):
+                writer.write(framing.frame_all(requests))
+                replies = []
+                for _ in requests:
+                    header = await reader.readexactly(framing.FRAME_HEADER_LENGTH)
+                    (length,) = framing.FRAME_HEADER.unpack(header)
+                    replies.append(coding.unmarshal_response(await reader.readexactly(length)))
+                return replies
+
+            # Find a user owned by each worker
+            names = ["user{}".format(i) for i in range(20)]
+            local = [name for name in names if cluster.owner_of(name, 2) == 0][0]
+            remote = [name for name in names if cluster.owner_of(name, 2) == 1][0]
+
+            # Ensure requests are handled by the owner, with replies kept in order
+            replies = await round_trip([
+                coding.marshal_create_request(schema.Request(user_id=local)),
+                coding.marshal_create_request(schema.Request(user_id=remote)),
+                coding.marshal_create_request(schema.Request(user_id=remote)),
+                coding.marshal_send_request(schema.SendRequest(user_id=local, recipient_id=remote, text="hi")),
+                coding.marshal_get_request(schema.Request(user_id=remote)),
+            ])
+            assert [resp.success for resp in replies] == [True, True, False, True, True]
+            assert replies[4].text == "hi"
+            assert remote in workers[1].users and remote not in workers[0].users
+            assert local in workers[0].users and local not in workers[1].users
+
+            # Ensure list is gathered from every worker and batches are split between them
+            replies = await round_trip([
+                coding.marshal_list_request(schema.ListRequest(user_id=local, wildcard="user")),
+                coding.marshal_batch_send_request(schema.BatchSendRequest(user_id=local, messages=[
+                    schema.SendRequest(user_id=local, recipient_id=remote, text="a"),
+                    schema.SendRequest(user_id=local, recipient_id="nobody", text="b"),
+                    schema.SendRequest(user_id=local, recipient_id=local, text="c"),
+                ])),
+            ])
+            assert sorted(replies[0].accounts) == sorted([local, remote])
+            assert replies[1].statuses == [True, False, True]
+
+            # Ensure a group send reaches members on every worker, whichever worker owns the sender
+            replies = await round_trip([
+                coding.marshal_join_group_request(schema.GroupRequest(user_id=local, group_id="team")),
+                coding.marshal_join_group_request(schema.GroupRequest(user_id=remote, group_id="team")),
+                coding.marshal_send_group_request(schema.GroupSendRequest(user_id=remote, group_id="team", text="group")),
+                coding.marshal_send_group_request(schema.GroupSendRequest(user_id=local, group_id="nobody", text="group")),
+            ])
+            assert [resp.success for resp in replies] == [True, True, True, False]
+            assert replies[3].error_message == "Group does not exist"
+            assert [msg.text for msg in workers[0].msgs_cache[local]] == ["c", "group"]
+            assert workers[0].msgs_cache[local].take()[-1].recipient_id == "team"
+            assert "team" in workers[0].groups and "team" in workers[1].groups
+
+            # Ensure clients can't use internal ops
+            writer.write(framing.frame_all([
+                coding.marshal_request(schema.ListRequest(user_id=local, wildcard=""), "list_all", coding.VERSION_1),
+                coding.marshal_health_request(schema.Request(user_id=local)),
+            ]))
+            header = await reader.readexactly(framing.FRAME_HEADER_LENGTH)
+            (length,) = framing.FRAME_HEADER.unpack(header)
+            assert coding.unmarshal_response(await reader.readexactly(length)).success
+
+            # Ensure a subscription to a remote user is relayed from its owner
+            watch_reader, watch_writer = await asyncio.open_connection("127.0.0.1", workers[0].port)
+
+            async def read_pushed():
+                header = await watch_reader.readexactly(framing.FRAME_HEADER_LENGTH)
+                (length,) = framing.FRAME_HEADER.unpack(header)
+                return coding.unmarshal_response(await watch_reader.readexactly(length))
+
+            watch_writer.write(framing.frame(coding.marshal_subscribe_request(schema.GetManyRequest(user_id=remote, max_count=8, max_bytes=4096))))
+            assert [msg.text for msg in (await read_pushed()).messages] == ["a"]
+            await round_trip([coding.marshal_send_request(schema.SendRequest(user_id=local, recipient_id=remote, text="pushed"))])
+            assert [msg.text for msg in (await read_pushed()).messages] == ["pushed"]
+            watch_writer.close()
+            await asyncio.sleep(0.1)
+            assert remote not in workers[1].watchers
+
+            # Ensure closing the connection logs out the remote user on its owner
+            assert workers[1].users[remote].is_logged_in
+            writer.close()
+            await asyncio.sleep(0.1)
+            assert not workers[1].users[remote].is_logged_in
+            for task in tasks:
+                task.cancel()
+
+        asyncio.run(scenario())
@@ -0,0 +1,98 @@
+import unittest
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, "..")
+import mailboxes
+import message_log
+import snapshot
+
+def make_message(author_id, recipient_id, text_bytes):
+    return mailboxes.StoredMessage(author_id, recipient_id, text_bytes)
+
+def texts(boxes, user_id):
+    return [msg.text_bytes for msg in boxes[user_id]]
+
+class Test_snapshot(unittest.TestCase):
+    """Test class for snapshots of the mailboxes and checkpointing the log"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "chat.log")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def attach(self):
+        boxes = mailboxes.Mailboxes()
+        log = message_log.MessageLog(self.path)
+        boxes.attach(log, make_message)
+        return boxes, log
+
+    def test_write_load(self):
+
+        # Write a snapshot with an empty mailbox and non-ASCII text, and ensure it loads back
+        contents = [("ream", [(b"mark", "hi é".encode("utf-8")), (b"mark", b"")]), ("mark", []), ("joe", [(b"ream", b"yo")])]
+        path = self.path + ".snapshot"
+        snapshot.write(path, 7, contents)
+        saved = snapshot.load(path)
+        assert saved.generation == 7
+        assert saved.users == [("ream", [("mark", "hi é".encode("utf-8")), ("mark", b"")]), ("mark", []), ("joe", [("ream", b"yo")])]
+
+        # Ensure a missing snapshot is None, and a damaged one is caught
+        assert snapshot.load(path + ".missing") is None
+        with open(path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"!")
+        with self.assertRaises(Exception):
+            snapshot.load(path)
+
+    def test_checkpoint(self):
+
+        # Log some messages and checkpoint them
+        boxes, log = self.attach()
+        for user_id in ["ream", "mark"]:
+            boxes.create(user_id)
+        boxes["ream"].put_many([make_message("mark", "ream", text) for text in [b"a", b"b", b"c"]])
+        boxes["ream"].take(1)
+        assert boxes.checkpoint()
+        assert not os.path.exists(log.old_path)
+        assert message_log.read_records(self.path)[0] == []
+        assert not boxes.checkpoint() # Nothing new
+
+        # Ensure changes after the checkpoint are logged on top of it
+        boxes["mark"].put(make_message("ream", "mark", b"d"))
+        boxes.delete("ream")
+        log.close()
+        boxes, log = self.attach()
+        assert list(boxes.mailboxes) == ["mark"] and texts(boxes, "mark") == [b"d"]
+        log.close()
+
+    def test_interrupted_checkpoint(self):
+
+        # Rotate the log without writing the snapshot, as if the server crashed
+        boxes, log = self.attach()
+        boxes.create("ream")
+        boxes["ream"].put(make_message("mark", "ream", b"a"))
+        generation = log.rotate()
+        boxes["ream"].put(make_message("mark", "ream", b"b"))
+        log.close()
+
+        # Ensure nothing is lost, in either log file
+        boxes, log = self.attach()
+        assert texts(boxes, "ream") == [b"a", b"b"]
+        assert not os.path.exists(log.old_path)
+        boxes["ream"].put(make_message("mark", "ream", b"c"))
+        generation = log.rotate()
+
+        # Write the snapshot but keep the old log file, as if the server crashed right after
+        shadow = mailboxes.Mailboxes()
+        shadow.restore(snapshot.load(log.snapshot_path), message_log.read_records(log.old_path)[0], make_message)
+        snapshot.write(log.snapshot_path, generation, shadow.contents())
+        log.close()
+
+        # Ensure the old log file isn't replayed on top of the snapshot that has it
+        boxes, log = self.attach()
+        assert texts(boxes, "ream") == [b"a", b"b", b"c"]
+        log.close()
@@ -0,0 +1,130 @@
+import unittest
+import sys
+
+sys.path.insert(0, "..")
+import coding
+import struct_coding
+import schema
+import server
+
+USER_IDS = ["ream", "", "achele12", "toolongname", "zoë"]
+TEXTS = ["", "hi", "x" * 280, "y" * 300, "héllo wörld"]
+
+class Test_struct_coding(unittest.TestCase):
+    """Test class for the struct based codec"""
+
+    def test_requests_match_string_codec(self):
+
+        # Ensure every request marshals to exactly the same bytes
+        for user_id in USER_IDS:
+            req = schema.Request(user_id=user_id)
+            assert struct_coding.marshal_create_request(req) == coding.marshal_create_request(req)
+            assert struct_coding.marshal_login_request(req) == coding.marshal_login_request(req)
+            assert struct_coding.marshal_delete_request(req) == coding.marshal_delete_request(req)
+            assert struct_coding.marshal_get_request(req) == coding.marshal_get_request(req)
+            lst = schema.ListRequest(user_id=user_id, wildcard=user_id[:3], page=12)
+            assert struct_coding.marshal_list_request(lst) == coding.marshal_list_request(lst)
+            for text in TEXTS:
+                send = schema.SendRequest(user_id=user_id, recipient_id="mark", text=text)
+                assert struct_coding.marshal_send_request(send) == coding.marshal_send_request(send)
+
+    def test_responses_match_string_codec(self):
+
+        # Ensure every response marshals to exactly the same bytes
+        for user_id in USER_IDS:
+            for error_message in ["", "User does not exist", "ümlaut"]:
+                resp = schema.Response(user_id=user_id, success=not error_message, error_message=error_message)
+                assert struct_coding.marshal_response(resp) == coding.marshal_response(resp)
+            accounts = [schema.Account(user_id=name, is_logged_in=False) for name in USER_IDS]
+            lst = schema.ListResponse(user_id=user_id, success=True, error_message="", accounts=accounts)
+            assert struct_coding.marshal_list_response(lst) == coding.marshal_list_response(lst)
+            for text in TEXTS:
+                msg = schema.Message(author_id="mark", recipient_id=user_id, text=text, success=True)
+                assert struct_coding.marshal_message_response(msg) == coding.marshal_message_response(msg)
+
+    def test_unmarshal_matches_string_codec(self):
+
+        # Ensure both codecs read back the same fields
+        for user_id in USER_IDS:
+            for text in TEXTS:
+                data = coding.marshal_send_request(schema.SendRequest(user_id=user_id, recipient_id="mark", text=text))
+                fast, fast_op = struct_coding.unmarshal_request(memoryview(data))
+                slow, slow_op = coding.unmarshal_request(data)
+                assert fast_op == slow_op == "send"
+                assert schema.fields(fast) == schema.fields(slow)
+                data = coding.marshal_message_response(schema.Message(author_id=user_id, recipient_id="mark", text=text, success=True))
+                assert schema.fields(struct_coding.unmarshal_response(data)) == schema.fields(coding.unmarshal_response(data))
+            data = coding.marshal_list_request(schema.ListRequest(user_id=user_id, wildcard="e", page=3))
+            fast, _ = struct_coding.unmarshal_request(data)
+            assert (fast.user_id, fast.wildcard, fast.page) == (coding.unpad(user_id[:8]), "e", 3)
+
+    def test_pack_into(self):
+
+        # Ensure packing into a shared buffer produces the same bytes back to back
+        msgs = [schema.Message(author_id="mark", recipient_id="ream", text=text, success=True) for text in ["a", "b"]]
+        buffer = bytearray(2 * struct_coding.MESSAGE_RESPONSE.size)
+        offset = 0
+        for msg in msgs:
+            offset = struct_coding.pack_message_response_into(buffer, offset, msg)
+        assert offset == len(buffer)
+        assert bytes(buffer) == b"".join(coding.marshal_message_response(msg) for msg in msgs)
+
+    def test_batches_match_string_codec(self):
+
+        # Ensure batch requests and responses marshal to the same bytes and back
+        for user_id in USER_IDS:
+            messages = [schema.SendRequest(user_id=user_id, recipient_id=recipient_id, text=text) for recipient_id in ["mark", "chloé"] for text in TEXTS]
+            for batch in [messages[:len(TEXTS) - 1], messages, []]:
+                req = schema.BatchSendRequest(user_id=user_id, messages=batch)
+                data = coding.marshal_batch_send_request(req)
+                assert struct_coding.marshal_batch_send_request(req) == data
+                fast, fast_op = struct_coding.unmarshal_request(memoryview(data))
+                slow, slow_op = coding.unmarshal_request(data)
+                assert fast_op == slow_op == "send_batch"
+                assert [schema.fields(msg) for msg in fast.messages] == [schema.fields(msg) for msg in slow.messages]
+            resp = schema.BatchResponse(user_id=user_id, success=False, error_message="Some recipients do not exist", statuses=[True, False, True])
+            data = coding.marshal_batch_response(resp)
+            assert struct_coding.marshal_batch_response(resp) == data
+            assert struct_coding.unmarshal_response(data).statuses == coding.unmarshal_response(data).statuses == [True, False, True]
+
+    def test_messages_match_string_codec(self):
+
+        # Ensure multi-message responses marshal to the same bytes and back
+        for user_id in USER_IDS:
+            req = schema.GetManyRequest(user_id=user_id, max_count=64, max_bytes=65536)
+            assert struct_coding.marshal_get_many_request(req) == coding.marshal_get_many_request(req)
+            fast, _ = struct_coding.unmarshal_request(coding.marshal_get_many_request(req))
+            assert (fast.max_count, fast.max_bytes) == (64, 65536)
+            for texts in [[], TEXTS[:3], TEXTS]:
+                msgs = [schema.Message(author_id="mark", recipient_id=user_id, text=text, success=True) for text in texts]
+                resp = schema.MessagesResponse(user_id=user_id, success=len(msgs) > 0, error_message="", messages=msgs)
+                data = coding.marshal_messages_response(resp)
+                assert struct_coding.marshal_messages_response(resp) == data
+                out = [msg.text for msg in struct_coding.unmarshal_response(data).messages]
+                assert out == [msg.text for msg in coding.unmarshal_response(data).messages] == [text[:280] for text in texts]
+
+    def test_server_view_request(self):
+
+        # Create test server with the struct codec, counting its unmarshals
+        s = server.Server(host="127.0.0.1", port=0, executor=None, codec=struct_coding)
+        session = server.Session()
+        unmarshaled = []
+        unmarshal_request = struct_coding.unmarshal_request
+        struct_coding.unmarshal_request = lambda data : unmarshaled.append(data) or unmarshal_request(data)
+        try:
+            # Ensure requests that don't get a view are unmarshaled by the struct codec
+            for name in ["ream", "mark"]:
+                s.handle_frame(memoryview(struct_coding.marshal_create_request(schema.Request(user_id=name))), session)
+            batch = schema.BatchSendRequest(user_id="ream", messages=[schema.SendRequest(user_id="ream", recipient_id="mark", text="one")])
+            reply = s.handle_frame(memoryview(struct_coding.marshal_batch_send_request(batch)), session)
+            assert len(unmarshaled) == 3
+            assert struct_coding.unmarshal_response(reply).statuses == [True]
+
+            # Ensure lazy ops still get a view
+            send = schema.SendRequest(user_id="ream", recipient_id="mark", text="two")
+            assert isinstance(struct_coding.view_request(memoryview(struct_coding.marshal_send_request(send)))[0], coding.RequestView)
+            s.handle_frame(memoryview(struct_coding.marshal_send_request(send)), session)
+            assert len(unmarshaled) == 3
+        finally:
+            struct_coding.unmarshal_request = unmarshal_request
+        assert [msg.text for msg in s.msgs_cache["mark"]] == ["one", "two"]
@@ -0,0 +1,118 @@
+import unittest
+import sys
+import random
+import string
+import threading
+
+sys.path.insert(0, "..")
+import schema
+import user_index
+import user_registry
+
+class Test_user_index(unittest.TestCase):
+    """Test class for the substring index of user_ids"""
+
+    def test_search(self):
+
+        # Index a few user_ids
+        index = user_index.SubstringIndex()
+        for name in ["ream", "mark", "achele", "joe", "bob"]:
+            index.add(name)
+        assert len(index) == 5
+
+        # Ensure short and long wildcards find matches in sorted order
+        assert index.search("") == ["achele", "bob", "joe", "mark", "ream"]
+        assert index.search("e") == ["achele", "joe", "ream"]
+        assert index.search("ar") == ["mark"]
+        assert index.search("chel") == ["achele"]
+        assert index.search("chex") == []
+        assert index.search("z") == []
+
+        # Ensure pages can be cut out of the matches
+        assert index.search("", 1, 3) == ["bob", "joe"]
+        assert index.search("e", 2) == ["ream"]
+
+        # Ensure adding twice is harmless and removing drops every posting
+        index.add("bob")
+        assert index.search("b") == ["bob"]
+        index.remove("bob")
+        index.remove("nobody")
+        assert index.search("b") == []
+        assert "bo" not in index.postings
+        assert len(index) == 4
+
+    def test_matches_scan(self):
+
+        # Churn random accounts, checking the index against a full scan as we go
+        rng = random.Random(262)
+        registry = user_registry.UserRegistry(shards=4)
+        wildcards = ["", "a", "b", "ab", "ba", "abc", "aab", "abab", "bcab", "aaaaa"]
+        for _ in range(2000):
+            user_id = "".join(rng.choice("abc") for _ in range(rng.randint(1, 8)))
+            with registry.lock(user_id):
+                if user_id in registry and rng.random() < 0.5:
+                    registry.remove(user_id)
+                else:
+                    registry.add(schema.Account(user_id=user_id, is_logged_in=False))
+            wildcard = rng.choice(wildcards)
+            start = rng.randint(0, 20)
+            stop = start + rng.randint(0, 8)
+            assert registry.find(wildcard, start, stop) == registry.scan(wildcard)[start:stop]
+
+        # Ensure every match is found once the churn is over
+        for wildcard in wildcards + list(string.ascii_lowercase[:4]):
+            assert [a.user_id for a in registry.find(wildcard)] == [a.user_id for a in registry.scan(wildcard)]
+
+    def test_chunks(self):
+
+        # Use tiny chunks, so that posting lists get split and emptied often
+        chunk_size = user_index.CHUNK_SIZE
+        user_index.CHUNK_SIZE = 4
+        try:
+            rng = random.Random(262)
+            index = user_index.SubstringIndex()
+            names = set()
+            for _ in range(3000):
+                user_id = "".join(rng.choice("abc") for _ in range(rng.randint(1, 6)))
+                if user_id in names and rng.random() < 0.5:
+                    index.remove(user_id)
+                    names.remove(user_id)
+                else:
+                    index.add(user_id)
+                    names.add(user_id)
+
+            # Ensure searches, pages and resumed listings match a sorted scan
+            for wildcard in ["", "a", "ab", "abc", "abca", "cccc"]:
+                expected = sorted(name for name in names if wildcard in name)
+                assert index.search(wildcard) == expected
+                assert index.search(wildcard, 5, 23) == expected[5:23]
+                if expected:
+                    after = expected[len(expected) // 2]
+                    assert index.search(wildcard, 1, 9, after) == [name for name in expected if name > after][1:9]
+            assert len(index) == len(names)
+            assert all(len(chunk) <= 4 for posting in index.postings.values() for chunk in posting.chunks)
+        finally:
+            user_index.CHUNK_SIZE = chunk_size
+
+    def test_concurrent_updates(self):
+
+        # Add and remove user_ids from several threads at once, sharing every short gram
+        index = user_index.SubstringIndex()
+
+        def churn(prefix):
+            for i in range(300):
+                index.add("{}{}".format(prefix, i))
+            for i in range(0, 300, 2):
+                index.remove("{}{}".format(prefix, i))
+
+        threads = [threading.Thread(target=churn, args=(prefix,)) for prefix in "abcd"]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Ensure every thread's changes made it in
+        expected = sorted("{}{}".format(prefix, i) for prefix in "abcd" for i in range(1, 300, 2))
+        assert index.search("") == expected
+        assert index.search("1") == [name for name in expected if "1" in name]
+        assert len(index) == len(expected)
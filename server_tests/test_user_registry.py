@@ -0,0 +1,83 @@
+import unittest
+import sys
+import threading
+
+sys.path.insert(0, "..")
+import schema
+import user_registry
+
+class Test_user_registry(unittest.TestCase):
+    """Test class for the sharded account registry"""
+
+    def add(self, registry, user_id):
+        with registry.lock(user_id):
+            registry.add(schema.Account(user_id=user_id, is_logged_in=False))
+
+    def test_dict_like(self):
+
+        # Add accounts and ensure they can be found
+        registry = user_registry.UserRegistry(shards=4)
+        for name in ["ream", "mark", "achele"]:
+            self.add(registry, name)
+        assert len(registry) == 3
+        assert "mark" in registry and registry["mark"].user_id == "mark"
+        assert registry.get("joe") is None
+
+        # Ensure removing an account only removes that one
+        with registry.lock("mark"):
+            registry.remove("mark")
+        assert "mark" not in registry
+        assert len(registry) == 2
+
+        # Ensure bad settings are caught up front
+        with self.assertRaises(Exception):
+            user_registry.UserRegistry(shards=0)
+
+    def test_values(self):
+
+        # Spread many accounts over the shards
+        registry = user_registry.UserRegistry(shards=8)
+        names = ["user{}".format(i) for i in range(100)]
+        for name in names:
+            self.add(registry, name)
+        assert len(set(id(registry.shard(name)) for name in names)) > 1
+
+        # Ensure a snapshot has every account once, oldest first within each shard
+        snapshot = [account.user_id for account in registry.values()]
+        assert sorted(snapshot) == sorted(names)
+        for shard in registry.shards:
+            in_shard = [name for name in snapshot if registry.shard(name) is shard]
+            assert in_shard == [name for name in names if registry.shard(name) is shard]
+
+        # Ensure a single shard keeps creation order, and an account added again counts as the newest
+        registry = user_registry.UserRegistry(shards=1)
+        for name in names:
+            self.add(registry, name)
+        with registry.lock("user0"):
+            registry.remove("user0")
+        self.add(registry, "user0")
+        assert [account.user_id for account in registry.values()] == names[1:] + ["user0"]
+
+    def test_concurrent_writers(self):
+
+        # Create and delete accounts on many threads while taking snapshots
+        registry = user_registry.UserRegistry(shards=4)
+        def churn(prefix):
+            for i in range(200):
+                name = "{}{}".format(prefix, i)
+                self.add(registry, name)
+                if i % 2 == 0:
+                    with registry.lock(name):
+                        registry.remove(name)
+        threads = [threading.Thread(target=churn, args=(prefix,)) for prefix in "abcd"]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            snapshot = registry.values()
+            assert len(snapshot) == len(set(account.user_id for account in snapshot))
+        for thread in threads:
+            thread.join()
+
+        # Ensure exactly the accounts that were kept are left
+        assert len(registry) == 4 * 100
+        assert all("{}{}".format(prefix, i) in registry for prefix in "abcd" for i in range(1, 200, 2))
@@ -0,0 +1,151 @@
+# Binary snapshots of every mailbox, so that a restarting server doesn't have
+# to replay its whole message log (see message_log.py).
+#
+# A snapshot is laid out in columns rather than record by record, so that it
+# can be read back in bulk instead of one field at a time:
+#
+# [ header, user_id lengths, message counts, author lengths, text lengths,
+#   user_ids, authors, texts ]
+#
+# The header holds a magic string, the generation of the log that carries on
+# from the snapshot, the number of users and messages, and a crc32 of
+# everything after it. The length and count columns are arrays of
+# little-endian integers (2 bytes for ids, 4 for counts and texts), and the
+# last three columns are every user_id, author_id and text concatenated, in
+# mailbox order. Loading maps the file into memory, reads each column with a
+# single copy, and then only slices them.
+
+import array
+import itertools
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+MAGIC = b"CHATSNP1"
+HEADER = struct.Struct("<8sQQQI") # magic, generation, users, messages, crc32 of the body
+
+class Snapshot:
+    """
+    The mailboxes at some point, and the generation of the log that carries
+    on from there
+    NOTE: users is a list of (user_id, messages), where messages is a list of
+    (author_id, text_bytes) pairs, oldest first
+    """
+    def __init__(self, generation, users):
+        self.generation = generation
+        self.users = users
+
+def column(typecode, values):
+    """
+    The bytes of a column of little-endian integers
+    """
+    values = array.array(typecode, values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tobytes()
+
+def read_column(typecode, data):
+    values = array.array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+def write(path, generation, contents):
+    """
+    Writes a snapshot of contents, an iterable of (user_id, messages) where
+    messages are (author_id, text) byte string pairs, to path
+    NOTE: The snapshot replaces path atomically, so a crash leaves either the
+    old snapshot or the new one
+    """
+    user_ids = []
+    counts = []
+    authors = []
+    texts = []
+    for user_id, messages in contents:
+        user_ids.append(user_id.encode("utf-8"))
+        counts.append(len(messages))
+        for author_id, text in messages:
+            authors.append(author_id)
+            texts.append(text)
+    body = b"".join([
+        column("H", map(len, user_ids)),
+        column("I", counts),
+        column("H", map(len, authors)),
+        column("I", map(len, texts)),
+        b"".join(user_ids),
+        b"".join(authors),
+        b"".join(texts),
+    ])
+    header = HEADER.pack(MAGIC, generation, len(user_ids), len(texts), zlib.crc32(body))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    sync_directory(path)
+
+def load(path):
+    """
+    Reads the snapshot at path, or returns None if there isn't one. Raises if
+    it is damaged.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, generation, user_count, message_count, checksum = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise Exception("Not a snapshot: {}".format(path))
+        with memoryview(data) as view:
+            valid = zlib.crc32(view[HEADER.size:]) == checksum
+        if not valid:
+            raise Exception("Damaged snapshot: {}".format(path))
+
+        offset = HEADER.size
+        columns = []
+        for typecode, count in [("H", user_count), ("I", user_count), ("H", message_count), ("I", message_count)]:
+            size = array.array(typecode).itemsize * count
+            columns.append(read_column(typecode, data[offset:offset + size]))
+            offset += size
+        id_lengths, counts, author_lengths, text_lengths = columns
+        blobs = []
+        for lengths in [id_lengths, author_lengths, text_lengths]:
+            size = sum(lengths)
+            blobs.append(data[offset:offset + size])
+            offset += size
+        id_blob, author_blob, text_blob = blobs
+
+    user_ids = slices(id_blob, id_lengths)
+    names = {} # Each author's id is only decoded once
+    authors = [names.get(author) or names.setdefault(author, str(author, "utf-8")) for author in slices(author_blob, author_lengths)]
+    messages = list(zip(authors, slices(text_blob, text_lengths)))
+    users = []
+    start = 0
+    for user_id, count in zip(user_ids, counts):
+        users.append((str(user_id, "utf-8"), messages[start:start + count]))
+        start += count
+    return Snapshot(generation, users)
+
+def slices(blob, lengths):
+    """
+    Cuts a concatenation back into its pieces, given their lengths
+    """
+    ends = list(itertools.accumulate(lengths))
+    return [blob[end - length:end] for end, length in zip(ends, lengths)]
+
+def sync_directory(path):
+    """
+    Makes a rename in the directory holding path survive a crash
+    """
+    try:
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return # e.g. Windows, where directories can't be opened
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
@@ -0,0 +1,460 @@
+import struct
+from functools import lru_cache
+
+import coding
+from coding import VERSION, ERROR_MESSAGE_LENGTH, MAX_MESSAGE_LENGTH, OP_TO_CODE_MAP, CODE_TO_OP_MAP, RESP_TO_CODE_MAP, CODE_TO_RESP_MAP
+from coding import OPS, OPS_BY_NAME, STRING, NUMBER, ENTRIES, find_op
+from coding import RequestView
+from schema import Message, Request, ListRequest, SendRequest, GetManyRequest, BatchSendRequest, GroupRequest, GroupSendRequest, Response, ListResponse, BatchResponse, MessagesResponse, StatsResponse
+
+# A drop-in replacement for the marshaling functions in coding.py built on
+# precompiled struct layouts. The output is byte-identical to the version "0"
+# format: struct's "Ns" fields pad with NUL bytes and truncate exactly like
+# pad_to_length, as long as every character is a single byte. Strings that are
+# not ASCII are handed to coding.py, which pads by characters instead of bytes.
+# Version 1 messages are handed to coding.py as well.
+
+def request_layout(op):
+    """
+    The layout of an op's request: version, user_id, op_code and then one
+    field per entry in the op registry (for entries, just their count)
+    """
+    return struct.Struct("1s8s1s" + "".join("{}s".format(field.length) for field in op.fields))
+
+REQUEST_LAYOUTS = {op.name: request_layout(op) for op in OPS}
+BASIC_REQUEST = REQUEST_LAYOUTS["create"] # version, user_id, op_code
+LIST_REQUEST = REQUEST_LAYOUTS["list"] # ..., wildcard, page
+SEND_REQUEST = REQUEST_LAYOUTS["send"] # ..., recipient_id, text
+BATCH_REQUEST_HEADER = REQUEST_LAYOUTS["send_batch"] # version, user_id, op_code, count
+ENTRY = struct.Struct("8s{}s".format(MAX_MESSAGE_LENGTH)) # user_id, text (repeated count times)
+GET_MANY_REQUEST = REQUEST_LAYOUTS["get_many"] # version, user_id, op_code, max_count, max_bytes
+RESPONSE_SUFFIX = struct.Struct("1s1s{}s".format(ERROR_MESSAGE_LENGTH)) # resp_code, success, error_message
+RESPONSE = struct.Struct("1s8s{}s".format(RESPONSE_SUFFIX.size)) # prefix + cached suffix
+MESSAGE_RESPONSE = struct.Struct("1s8s{}s8s{}s".format(RESPONSE_SUFFIX.size, MAX_MESSAGE_LENGTH)) # ..., author_id, text
+MESSAGE_RESPONSE_HEADER = struct.Struct("1s8s{}s8s".format(RESPONSE_SUFFIX.size)) # everything before the text
+MESSAGES_RESPONSE_HEADER = struct.Struct("1s8s{}s8s".format(RESPONSE_SUFFIX.size)) # version, user_id, suffix, count
+
+VERSION_BYTE = VERSION.encode()
+OP_CODE_BYTES = {op: code.encode() for op, code in OP_TO_CODE_MAP.items()}
+RESP_CODE_BYTES = {resp: code.encode() for resp, code in RESP_TO_CODE_MAP.items()}
+RESP_FROM_BYTE = {ord(code): resp for code, resp in CODE_TO_RESP_MAP.items()}
+
+def unpad(b):
+    """
+    Removes padding from a fixed-width ASCII field
+    """
+    return b.strip(b"\0").decode("ascii")
+
+@lru_cache(maxsize=1024)
+def response_suffix(resp_type, success, error_message):
+    """
+    Marshals the resp_code, success and error_message fields of a response.
+    These rarely change between responses ("User does not exist", "", ...)
+    so the packed bytes are cached. Returns None if error_message is not ASCII.
+    """
+    if not error_message.isascii():
+        return None
+    return RESPONSE_SUFFIX.pack(
+        RESP_CODE_BYTES[resp_type],
+        b"1" if success else b"0",
+        error_message.encode(),
+    )
+
+def generate(name, lines, namespace):
+    """
+    Compiles the source of a generated function and returns it
+    """
+    exec("\n".join(lines), namespace)
+    return namespace[name]
+
+def request_marshaler(op):
+    """
+    Generates a function that marshals Requests for an op, written out for
+    its fields in the op registry (like namedtuple does) so marshaling a
+    request is as cheap as a hand-written pack. Anything that is not ASCII
+    is handed to coding.py.
+    """
+    namespace = {
+        "layout": REQUEST_LAYOUTS[op.name],
+        "code": OP_CODE_BYTES[op.name],
+        "op": op,
+        "VERSION_BYTE": VERSION_BYTE,
+        "ENTRY": ENTRY,
+        "fallback": coding.marshal_op_request,
+    }
+    strings = ["user_id"] + [field.name for field in op.fields if field.kind == STRING]
+    packed = ["user_id.encode()", "code"]
+    lines = ["def marshal(req):"]
+    lines += ["    {0} = req.{0}".format(name) for name in strings]
+    entries = None
+    for field in op.fields:
+        if field.kind == STRING:
+            packed.append("{}.encode()".format(field.name))
+        elif field.kind == NUMBER:
+            packed.append("str(req.{}).encode()".format(field.name))
+        else:
+            entries = field.name
+            packed.append("str(len(req.{})).encode()".format(field.name))
+    ascii = " and ".join("{}.isascii()".format(name) for name in strings)
+    if entries is not None:
+        ascii += " and all(msg.recipient_id.isascii() and msg.text.isascii() for msg in req.{})".format(entries)
+    lines += [
+        "    if not ({}):".format(ascii),
+        "        return fallback(req, op)",
+    ]
+    if entries is None:
+        lines.append("    return layout.pack(VERSION_BYTE, {})".format(", ".join(packed)))
+        return generate("marshal", lines, namespace)
+    # Entries are packed straight into one preallocated buffer after the header
+    lines += [
+        "    buffer = bytearray(layout.size + len(req.{}) * ENTRY.size)".format(entries),
+        "    layout.pack_into(buffer, 0, VERSION_BYTE, {})".format(", ".join(packed)),
+        "    offset = layout.size",
+        "    for msg in req.{}:".format(entries),
+        "        ENTRY.pack_into(buffer, offset, msg.recipient_id.encode(), msg.text.encode())",
+        "        offset += ENTRY.size",
+        "    return bytes(buffer)",
+    ]
+    return generate("marshal", lines, namespace)
+
+def request_unmarshaler(op):
+    """
+    Generates a function that builds an op's Request from its data and
+    already decoded user_id. A text field is last, so it is decoded through
+    to the end of the data (which also handles non-ASCII text).
+    """
+    namespace = {
+        "layout": REQUEST_LAYOUTS[op.name],
+        "request_class": op.request_class,
+        "unpad": unpad,
+        "ENTRY": ENTRY,
+        "SendRequest": SendRequest,
+    }
+    lines = ["def unmarshal(data, user_id):"]
+    if not op.fields:
+        lines.append("    return request_class(user_id)")
+        return generate("unmarshal", lines, namespace)
+    lines.append("    _, _, _, {} = layout.unpack_from(data)".format(", ".join(field.name for field in op.fields)))
+    args = ["user_id"]
+    for field in op.fields:
+        if field.name == "text":
+            value = "bytes(data[{}:]).strip(b'\\0').decode()".format(op.offsets["text"][0])
+        elif field.kind == STRING:
+            value = "unpad({})".format(field.name)
+        elif field.kind == NUMBER:
+            value = "int(unpad({}))".format(field.name)
+        else:
+            lines += [
+                "    end = layout.size + int(unpad({})) * ENTRY.size".format(field.name),
+                "    if end > len(data):",
+                "        raise Exception('Truncated batch')",
+                "    {} = [SendRequest(user_id, recipient_id=unpad(recipient_id), text=unpad(text)) for recipient_id, text in ENTRY.iter_unpack(data[layout.size:end])]".format(field.name),
+            ]
+            value = field.name
+        args.append("{}={}".format(field.name, value))
+    lines.append("    return request_class({})".format(", ".join(args)))
+    return generate("unmarshal", lines, namespace)
+
+REQUEST_MARSHALERS = {op.name: request_marshaler(op) for op in OPS}
+REQUEST_UNMARSHALERS = [None] * 256
+for op in OPS:
+    REQUEST_UNMARSHALERS[ord(op.code)] = request_unmarshaler(op)
+
+def marshal_op_request(req: Request, op):
+    """
+    Marshals a Request for any op into a byte string
+    """
+    return REQUEST_MARSHALERS[op.name](req)
+
+def marshal_create_request(req: Request):
+    """
+    Marshals a create Request into a byte string
+    """
+    return REQUEST_MARSHALERS["create"](req)
+
+def marshal_login_request(req: Request):
+    """
+    Marshals a login Request into a byte string
+    """
+    return REQUEST_MARSHALERS["login"](req)
+
+def marshal_delete_request(req: Request):
+    """
+    Marshals a delete Request into a byte string
+    """
+    return REQUEST_MARSHALERS["delete"](req)
+
+def marshal_get_request(req: Request):
+    """
+    Marshals a get Request into a byte string
+    """
+    return REQUEST_MARSHALERS["get"](req)
+
+def marshal_get_many_request(req: GetManyRequest):
+    """
+    Marshals a get_many Request into a byte string
+    """
+    return REQUEST_MARSHALERS["get_many"](req)
+
+def marshal_list_request(req: ListRequest):
+    """
+    Marshals a list Request into a byte string
+    """
+    return REQUEST_MARSHALERS["list"](req)
+
+def marshal_send_request(req: SendRequest):
+    """
+    Marshals a send Request into a byte string
+    """
+    return REQUEST_MARSHALERS["send"](req)
+
+def marshal_batch_send_request(req: BatchSendRequest):
+    """
+    Marshals a batch of send Requests into a byte string
+    """
+    return REQUEST_MARSHALERS["send_batch"](req)
+
+def marshal_health_request(req: Request):
+    """
+    Marshals a health Request into a byte string
+    """
+    return REQUEST_MARSHALERS["health"](req)
+
+def marshal_logout_request(req: Request):
+    """
+    Marshals a logout Request into a byte string
+    """
+    return REQUEST_MARSHALERS["logout"](req)
+
+def marshal_subscribe_request(req: GetManyRequest):
+    """
+    Marshals a subscribe GetManyRequest into a byte string
+    """
+    return REQUEST_MARSHALERS["subscribe"](req)
+
+def marshal_stats_request(req: Request):
+    """
+    Marshals a stats Request into a byte string
+    """
+    return REQUEST_MARSHALERS["stats"](req)
+
+def marshal_join_group_request(req: GroupRequest):
+    """
+    Marshals a join_group GroupRequest into a byte string
+    """
+    return REQUEST_MARSHALERS["join_group"](req)
+
+def marshal_leave_group_request(req: GroupRequest):
+    """
+    Marshals a leave_group GroupRequest into a byte string
+    """
+    return REQUEST_MARSHALERS["leave_group"](req)
+
+def marshal_send_group_request(req: GroupSendRequest):
+    """
+    Marshals a send_group GroupSendRequest into a byte string
+    """
+    return REQUEST_MARSHALERS["send_group"](req)
+
+def pack_send_request_into(buffer, offset, req: SendRequest):
+    """
+    Packs a send Request directly into a writable buffer (e.g. a reusable
+    bytearray holding many frames). Returns the offset just past it.
+    NOTE: Only valid for ASCII requests, which always take SEND_REQUEST.size bytes
+    """
+    SEND_REQUEST.pack_into(
+        buffer,
+        offset,
+        VERSION_BYTE,
+        req.user_id.encode(),
+        OP_CODE_BYTES["send"],
+        req.recipient_id.encode(),
+        req.text.encode(),
+    )
+    return offset + SEND_REQUEST.size
+
+def unmarshal_request(data: bytes):
+    """
+    Unmarshals a byte string into a Request, following the op's fields
+    NOTE: A non-ASCII request shifts every field after the first multi-byte
+    character, which is always caught when that field is decoded as ASCII.
+    A text field is last, so it is decoded through to the end of the data.
+    """
+    if data[0] != VERSION_BYTE[0]:
+        return coding.unmarshal_request(data)
+    try:
+        user_id = unpad(bytes(data[1:9]))
+        op = find_op(data[BASIC_REQUEST.size - 1])
+        return REQUEST_UNMARSHALERS[data[BASIC_REQUEST.size - 1]](data, user_id), op.name
+    except UnicodeDecodeError:
+        return coding.unmarshal_request(data)
+
+def view_request(data):
+    """
+    Wraps a byte string in a RequestView, like coding.view_request, but
+    every op that doesn't get a view is unmarshaled by this module
+    """
+    if data[0] != VERSION_BYTE[0]:
+        return coding.view_request(data)
+    try:
+        user_id = unpad(bytes(data[1:9]))
+    except UnicodeDecodeError:
+        return coding.unmarshal_request(data)
+    op = find_op(data[BASIC_REQUEST.size - 1])
+    if op.lazy:
+        return RequestView(data, user_id, op.name), op.name
+    return unmarshal_request(data)
+
+def marshal_response(resp: Response):
+    """
+    Marshals a Response into a byte string
+    """
+    suffix = response_suffix(resp.type, resp.success, resp.error_message)
+    if suffix is None or not resp.user_id.isascii():
+        return coding.marshal_response(resp)
+    return RESPONSE.pack(VERSION_BYTE, resp.user_id.encode(), suffix)
+
+def marshal_list_response(resp: ListResponse):
+    """
+    Marshals a ListResponse into a byte string
+    """
+    suffix = response_suffix(resp.type, resp.success, resp.error_message)
+    if suffix is None or not resp.user_id.isascii():
+        return coding.marshal_list_response(resp)
+    return b"".join((
+        RESPONSE.pack(VERSION_BYTE, resp.user_id.encode(), suffix),
+        coding.prep_accounts(resp.accounts).encode(),
+    ))
+
+def marshal_batch_response(resp: BatchResponse):
+    """
+    Marshals a BatchResponse into a byte string
+    """
+    suffix = response_suffix(resp.type, resp.success, resp.error_message)
+    if suffix is None or not resp.user_id.isascii():
+        return coding.marshal_batch_response(resp)
+    return b"".join((
+        RESPONSE.pack(VERSION_BYTE, resp.user_id.encode(), suffix),
+        "".join("1" if status else "0" for status in resp.statuses).encode(),
+    ))
+
+def marshal_stats_response(resp: StatsResponse):
+    """
+    Marshals a StatsResponse into a byte string
+    """
+    suffix = response_suffix(resp.type, resp.success, resp.error_message)
+    if suffix is None or not resp.user_id.isascii():
+        return coding.marshal_stats_response(resp)
+    return RESPONSE.pack(VERSION_BYTE, resp.user_id.encode(), suffix) + resp.text.encode()
+
+def text_bytes(msg: Message):
+    """
+    The encoded text of a Message, without decoding forwarded messages
+    """
+    if msg.text_bytes is not None:
+        return msg.text_bytes
+    return msg.text.encode()
+
+def is_ascii_message(msg: Message):
+    """
+    Whether a Message packs into exactly MESSAGE_RESPONSE.size bytes
+    """
+    if not (msg.recipient_id.isascii() and msg.author_id.isascii()):
+        return False
+    if msg.text_bytes is not None:
+        return msg.text_bytes.isascii()
+    return msg.text.isascii()
+
+def marshal_message_response(msg: Message):
+    """
+    Marshals a Message into a byte string
+    """
+    if not is_ascii_message(msg):
+        return coding.marshal_message_response(msg)
+    return MESSAGE_RESPONSE.pack(
+        VERSION_BYTE,
+        msg.recipient_id.encode(),
+        response_suffix("message", msg.success, ""),
+        msg.author_id.encode(),
+        text_bytes(msg),
+    )
+
+def pack_message_response_into(buffer, offset, msg: Message):
+    """
+    Packs a Message response directly into a writable buffer.
+    Returns the offset just past it.
+    NOTE: Only valid for ASCII messages, which always take MESSAGE_RESPONSE.size bytes
+    """
+    MESSAGE_RESPONSE.pack_into(
+        buffer,
+        offset,
+        VERSION_BYTE,
+        msg.recipient_id.encode(),
+        response_suffix("message", msg.success, ""),
+        msg.author_id.encode(),
+        text_bytes(msg),
+    )
+    return offset + MESSAGE_RESPONSE.size
+
+def marshal_messages_response(resp: MessagesResponse):
+    """
+    Marshals a MessagesResponse into a byte string. Every message is packed
+    straight into one preallocated buffer.
+    """
+    suffix = response_suffix(resp.type, resp.success, resp.error_message)
+    if suffix is None or not resp.user_id.isascii() or not all(is_ascii_message(msg) for msg in resp.messages):
+        return coding.marshal_messages_response(resp)
+    buffer = bytearray(MESSAGES_RESPONSE_HEADER.size + len(resp.messages) * ENTRY.size)
+    MESSAGES_RESPONSE_HEADER.pack_into(
+        buffer,
+        0,
+        VERSION_BYTE,
+        resp.user_id.encode(),
+        suffix,
+        str(len(resp.messages)).encode(),
+    )
+    offset = MESSAGES_RESPONSE_HEADER.size
+    for msg in resp.messages:
+        ENTRY.pack_into(buffer, offset, msg.author_id.encode(), text_bytes(msg))
+        offset += ENTRY.size
+    return bytes(buffer)
+
+def unmarshal_response(data):
+    """
+    Unmarshals a byte string into a Response
+    """
+    if data[0] != VERSION_BYTE[0]:
+        return coding.unmarshal_response(data)
+    try:
+        version, user_id, suffix = RESPONSE.unpack_from(data)
+        resp_code, success, error_message = RESPONSE_SUFFIX.unpack(suffix)
+        resp_type = RESP_FROM_BYTE.get(resp_code[0])
+        user_id = unpad(user_id)
+        success = success == b"1"
+        error_message = unpad(error_message)
+        if resp_type == "basic":
+            return Response(user_id=user_id, success=success, error_message=error_message)
+        elif resp_type == "list":
+            accounts = coding.post_accounts(str(data[RESPONSE.size:], "utf-8"))
+            return ListResponse(user_id=user_id, success=success, error_message=error_message, accounts=accounts)
+        elif resp_type == "message":
+            _, _, _, author_id = MESSAGE_RESPONSE_HEADER.unpack_from(data)
+            text = bytes(data[MESSAGE_RESPONSE_HEADER.size:]).strip(b"\0").decode()
+            return Message(recipient_id=user_id, author_id=unpad(author_id), text=text, success=success)
+        elif resp_type == "messages":
+            _, _, _, count = MESSAGES_RESPONSE_HEADER.unpack_from(data)
+            end = MESSAGES_RESPONSE_HEADER.size + int(unpad(count)) * ENTRY.size
+            messages = [
+                Message(recipient_id=user_id, author_id=unpad(author_id), text=unpad(text), success=True)
+                for author_id, text in ENTRY.iter_unpack(data[MESSAGES_RESPONSE_HEADER.size:end])
+            ]
+            return MessagesResponse(user_id=user_id, success=success, error_message=error_message, messages=messages)
+        elif resp_type == "batch":
+            statuses = [status == ord("1") for status in data[RESPONSE.size:]]
+            return BatchResponse(user_id=user_id, success=success, error_message=error_message, statuses=statuses)
+        elif resp_type == "stats":
+            return StatsResponse(user_id=user_id, success=success, error_message=error_message, text=str(data[RESPONSE.size:], "utf-8"))
+        else:
+            raise Exception("Unknown response type: {}".format(resp_type))
+    except UnicodeDecodeError:
+        return coding.unmarshal_response(data)
@@ -0,0 +1,190 @@
+# A substring index over user_ids, so that list can find a page of matching
+# accounts without scanning every account.
+#
+# Every substring of up to GRAM_LENGTH characters of every user_id maps to a
+# sorted posting list of the user_ids containing it (user_ids are at most 8
+# characters, so that is at most 21 grams each). A wildcard that short is
+# answered by slicing its posting list directly. A longer wildcard can only
+# match user_ids that contain every one of its grams, so only the shortest of
+# those posting lists is scanned, in order, and only until the page is full.
+# Since user_ids come out sorted, the last one of a page is enough to resume
+# the listing after it.
+#
+# The "" and single character posting lists hold nearly every user_id, so
+# each posting list is cut into chunks of at most CHUNK_SIZE sorted user_ids,
+# and adding or removing a user_id only shifts the one chunk it falls in.
+# Each posting list has its own lock, so creates and deletes on different
+# registry shards only meet for as long as one chunk is updated.
+
+import bisect
+import itertools
+from threading import Lock
+
+GRAM_LENGTH = 3
+CHUNK_SIZE = 512
+
+class Posting:
+    """
+    The sorted user_ids containing one gram, in chunks of at most CHUNK_SIZE.
+    maxes holds the last user_id of each chunk, to find a user_id's chunk.
+    NOTE: Only read or changed with its lock held. Once the last user_id is
+    removed it is dropped from the index and marked dead, and an add that
+    still holds it has to look the gram up again.
+    """
+    __slots__ = ("chunks", "maxes", "size", "lock", "dead")
+
+    def __init__(self):
+        self.chunks = []
+        self.maxes = []
+        self.size = 0
+        self.lock = Lock()
+        self.dead = False
+
+    def add(self, user_id):
+        if not self.chunks:
+            self.chunks.append([user_id])
+            self.maxes.append(user_id)
+            self.size = 1
+            return
+        c = min(bisect.bisect_left(self.maxes, user_id), len(self.maxes) - 1)
+        chunk = self.chunks[c]
+        i = bisect.bisect_left(chunk, user_id)
+        if i < len(chunk) and chunk[i] == user_id:
+            return
+        chunk.insert(i, user_id)
+        self.maxes[c] = chunk[-1]
+        self.size += 1
+        if len(chunk) > CHUNK_SIZE:
+            half = len(chunk) // 2
+            self.chunks[c:c + 1] = [chunk[:half], chunk[half:]]
+            self.maxes[c:c + 1] = [chunk[half - 1], chunk[-1]]
+
+    def remove(self, user_id):
+        c = bisect.bisect_left(self.maxes, user_id)
+        if c == len(self.maxes):
+            return
+        chunk = self.chunks[c]
+        i = bisect.bisect_left(chunk, user_id)
+        if i < len(chunk) and chunk[i] == user_id:
+            del chunk[i]
+            self.size -= 1
+            if chunk:
+                self.maxes[c] = chunk[-1]
+            else:
+                del self.chunks[c]
+                del self.maxes[c]
+
+    def chunk_after(self, after):
+        """
+        A copy of the user_ids sorting after the given one (all of them if
+        it is None) in the chunk it falls in, or [] once there are none left
+        """
+        c = 0 if after is None else bisect.bisect_right(self.maxes, after)
+        if c == len(self.chunks):
+            return []
+        chunk = self.chunks[c]
+        return chunk[:] if after is None else chunk[bisect.bisect_right(chunk, after):]
+
+    def slice(self, start, stop, after):
+        """
+        The user_ids sorting after the given one (all of them if it is None),
+        from the start-th up to (not including) the stop-th
+        """
+        out = []
+        while stop is None or start < stop:
+            part = self.chunk_after(after)
+            if not part:
+                break
+            after = part[-1]
+            if start >= len(part):
+                start -= len(part)
+                if stop is not None:
+                    stop -= len(part)
+                continue
+            out += part[start:stop]
+            if stop is not None:
+                stop -= len(part)
+            start = 0
+        return out
+
+class SubstringIndex:
+    """
+    The user_ids containing every short substring, kept sorted
+    NOTE: lock only guards adding and dropping posting lists (looking one
+    up is atomic). Each posting list has its own lock, and lock is only ever
+    taken after a posting list's, never before. Neither is held while taking
+    any other lock.
+    """
+    def __init__(self, gram_length=GRAM_LENGTH):
+        self.gram_length = gram_length
+        self.postings = {"": Posting()} # Every user_id contains the empty wildcard
+        self.lock = Lock()
+
+    def grams(self, text, lengths):
+        """
+        Every distinct substring of text with one of the given lengths
+        """
+        return {text[i:i + n] for n in lengths for i in range(len(text) - n + 1)}
+
+    def add(self, user_id):
+        for gram in self.grams(user_id, range(self.gram_length + 1)):
+            while True:
+                with self.lock:
+                    posting = self.postings.get(gram)
+                    if posting is None:
+                        posting = self.postings[gram] = Posting()
+                with posting.lock:
+                    if not posting.dead:
+                        posting.add(user_id)
+                        break
+
+    def remove(self, user_id):
+        for gram in self.grams(user_id, range(self.gram_length + 1)):
+            posting = self.postings.get(gram)
+            if posting is None:
+                continue
+            with posting.lock:
+                posting.remove(user_id)
+                if posting.size == 0 and gram != "" and not posting.dead:
+                    posting.dead = True
+                    with self.lock:
+                        del self.postings[gram]
+
+    def search(self, wildcard, start=0, stop=None, after=None):
+        """
+        The user_ids containing wildcard, in sorted order, from the start-th
+        match up to (not including) the stop-th. If after is given, only
+        user_ids sorting after it count, so a listing can resume where its
+        last page ended.
+        NOTE: A long wildcard is filtered over the shortest of its posting
+        lists, copying one chunk at a time with the lock held and then
+        filtering it without, and only until stop
+        """
+        if len(wildcard) <= self.gram_length:
+            posting = self.postings.get(wildcard)
+            if posting is None:
+                return []
+            with posting.lock:
+                return posting.slice(start, stop, after)
+        with self.lock:
+            posting = min((self.postings.get(gram) for gram in self.grams(wildcard, [self.gram_length])), key=lambda posting : -1 if posting is None else posting.size)
+        if posting is None:
+            return []
+        return list(itertools.islice(self.matches(wildcard, posting, after), start, stop))
+
+    def matches(self, wildcard, posting, after):
+        """
+        The user_ids in posting sorting after the given one that contain wildcard
+        """
+        while True:
+            with posting.lock:
+                part = posting.chunk_after(after)
+            if not part:
+                return
+            for user_id in part:
+                if wildcard in user_id:
+                    yield user_id
+            after = part[-1]
+
+    def __len__(self):
+        return self.postings[""].size
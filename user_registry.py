@@ -0,0 +1,136 @@
+# The accounts of a server, for both the socket server and the gRPC server in
+# part2.
+#
+# A single lock around every account made a slow list scan hold up every
+# login. UserRegistry stripes its accounts over a number of shards instead,
+# each with its own lock, so operations on users in different shards never
+# wait on each other. A read over every account (e.g. list) takes all the
+# shard locks, always in shard order so two of them can't deadlock, just long
+# enough to copy the accounts out, and then works on that snapshot with no
+# lock held.
+#
+# NOTE: A snapshot lists the accounts shard by shard, oldest first within each
+# shard, rather than in the order they were created. Putting them back in
+# creation order took several times longer than scanning them.
+#
+# Searching by substring doesn't need a snapshot at all: the registry keeps a
+# SubstringIndex of its user_ids up to date as accounts are added and removed
+# (see user_index.py), and find pages through it in user_id order.
+
+from threading import Lock
+
+import user_index
+
+DEFAULT_SHARDS = 16
+
+class Shard:
+    """
+    The accounts whose user_id hashes to one shard
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.accounts = {} # user_id -> Account, oldest first
+
+class UserRegistry:
+    """
+    Every account by user_id, striped over shards. Behaves like a read-only
+    dict of Accounts.
+    NOTE: add and remove require the lock of the user's shard to be held, so
+    that checking for an account and then changing it is atomic (the index
+    lock is always taken after a shard lock, never before)
+    """
+    def __init__(self, shards=DEFAULT_SHARDS):
+        if shards <= 0:
+            raise Exception("A registry needs at least one shard")
+        self.shards = [Shard() for _ in range(shards)]
+        self.index = user_index.SubstringIndex()
+
+    def shard(self, user_id):
+        return self.shards[hash(user_id) % len(self.shards)]
+
+    def lock(self, user_id):
+        """
+        The lock guarding a user's account
+        """
+        return self.shard(user_id).lock
+
+    def add(self, account):
+        """
+        Adds an account, replacing any with the same user_id
+        """
+        accounts = self.shard(account.user_id).accounts
+        accounts.pop(account.user_id, None) # So that it moves to the end
+        accounts[account.user_id] = account
+        self.index.add(account.user_id)
+
+    def remove(self, user_id):
+        del self.shard(user_id).accounts[user_id]
+        self.index.remove(user_id)
+
+    def get(self, user_id):
+        """
+        A user's account, or None if they don't have one
+        """
+        return self.shard(user_id).accounts.get(user_id)
+
+    def __getitem__(self, user_id):
+        return self.shard(user_id).accounts[user_id]
+
+    def __contains__(self, user_id):
+        return user_id in self.shard(user_id).accounts
+
+    def __len__(self):
+        return sum(len(shard.accounts) for shard in self.shards)
+
+    def values(self):
+        """
+        A consistent snapshot of every account, as a list
+        """
+        snapshot = []
+        for shard in self.shards:
+            shard.lock.acquire()
+        try:
+            for shard in self.shards:
+                snapshot.extend(shard.accounts.values())
+        finally:
+            for shard in self.shards:
+                shard.lock.release()
+        return snapshot
+
+    def find(self, wildcard, start=0, stop=None, after=None):
+        """
+        The accounts whose user_id contains wildcard, in user_id order, from
+        the start-th match up to (not including) the stop-th, counting only
+        user_ids after `after` if it is given
+        NOTE: Uses the index, so only the matches up to stop are looked at
+        """
+        accounts = (self.get(user_id) for user_id in self.index.search(wildcard, start, stop, after))
+        return [account for account in accounts if account is not None] # Removed since the search
+
+    def pages(self, wildcard, page_size, after=None):
+        """
+        Yields the accounts whose user_id contains wildcard, in user_id order,
+        a page at a time, as (accounts, resume_after) pairs. Passing
+        resume_after back as after continues right after that page, and it is
+        None on the last page.
+        NOTE: Each page is looked up when it is asked for, so only one page is
+        held at a time, and accounts created behind the listing are skipped
+        """
+        while True:
+            user_ids = self.index.search(wildcard, 0, page_size + 1, after) # One more, to see if this is the last page
+            more = len(user_ids) > page_size
+            user_ids = user_ids[:page_size]
+            accounts = [account for account in map(self.get, user_ids) if account is not None]
+            if user_ids:
+                after = user_ids[-1]
+            yield accounts, after if more else None
+            if not more:
+                return
+
+    def scan(self, wildcard):
+        """
+        Every account whose user_id contains wildcard, in user_id order, found
+        by scanning a snapshot of every account. Slow, but obviously correct.
+        """
+        satisfying = [user for user in self.values() if wildcard in user.user_id]
+        return sorted(satisfying, key=lambda user : user.user_id)